@@ -0,0 +1,89 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from modules.database.connection.connection import ConnectionManager
+from modules.database.database.database import DB
+from modules.database.sensor_reading.sensor_reading import SensorReading
+from modules.database.timestamp.timestamp import Timestamp
+
+# usage: python -m benchmarks.aggregation --rows 10000000 --devices 100
+# SensorReading.statistics (GROUP BY in SQLite) against the same statistics computed in python
+
+
+def fill(path: str, rows: int, devices: int, chunk_size: int = 100000):
+    ConnectionManager.configure(path)
+    DB.initialize()
+
+    generator = random.Random(0)
+    start_ts = Timestamp.from_datetime_string("01.01.2025 00:00:00")
+    for offset in range(0, rows, chunk_size):
+        DB.insert_many(DB.sensor_readings_table_name, [
+            dict(device_id=i % devices, datetime=Timestamp.to_datetime_string(start_ts + i * 1000),
+                 temperature=generator.uniform(-10, 35), humidity=generator.uniform(20, 90),
+                 pressure=generator.uniform(98000, 104000), hydration=generator.random(),
+                 waterlevel=generator.random(), ts=start_ts + i * 1000)
+            for i in range(offset, min(offset + chunk_size, rows))])
+
+    return start_ts
+
+
+def python_device_statistics(start: int, end: int) -> dict:
+    statistics = {}
+    for row in DB.iter_range(DB.sensor_readings_table_name, "ts", start, end, chunk_size=10000):
+        count, total, maximum = statistics.get(row["device_id"], (0, 0.0, None))
+        temperature = row["temperature"]
+        statistics[row["device_id"]] = (count + 1, total + temperature,
+                                        temperature if maximum is None else max(maximum, temperature))
+
+    return {device_id: (total / count, maximum) for device_id, (count, total, maximum) in statistics.items()}
+
+
+def python_count_below(threshold: float) -> int:
+    return sum(1 for row in DB.iter_rows(DB.sensor_readings_table_name, chunk_size=10000)
+               if row["waterlevel"] < threshold)
+
+
+def measure(function):
+    start = time.perf_counter()
+    result = function()
+
+    return result, time.perf_counter() - start
+
+
+def run(rows: int, devices: int):
+    path = os.path.join(tempfile.mkdtemp(), "aggregation.db")
+    print(f"filling {rows} rows of {devices} devices into {path}")
+    start_ts = fill(path, rows, devices)
+
+    # a window over the middle half of the data
+    start = start_ts + rows // 4 * 1000
+    end = start_ts + rows // 4 * 3 * 1000
+
+    cases = [
+        ("avg/max temperature per device, window",
+         lambda: SensorReading.statistics(["avg(temperature)", "max(temperature)"], group_by=["device_id"],
+                                          start=start, end=end),
+         lambda: python_device_statistics(start, end)),
+        ("count waterlevel < 0.1",
+         lambda: SensorReading.statistics(["count(*)"], filters=[("waterlevel", "<", 0.1)]),
+         lambda: python_count_below(0.1)),
+    ]
+
+    for name, sql, python in cases:
+        _, sql_time = measure(sql)
+        _, python_time = measure(python)
+        print(f"{name:40} sql: {sql_time:8.2f}s  python: {python_time:8.2f}s  x{python_time / sql_time:.1f}")
+
+    ConnectionManager.close_all()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=10000000)
+    parser.add_argument("--devices", type=int, default=100)
+    args = parser.parse_args()
+
+    run(args.rows, args.devices)
@@ -0,0 +1,80 @@
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+
+from modules.database.connection.connection import ConnectionManager
+from modules.database.database.database import DB
+
+# usage: python -m benchmarks.connection_pool --rows 5000
+
+reading = dict(device_id=1, datetime="01.01.2025 00:00:00", temperature=22.3, humidity=40.1, pressure=106123.3,
+               hydration=0.1, waterlevel=0.0)
+
+
+def legacy_insert_one(path: str, table_name: str, **kwargs):
+    # connect-per-call, as DB did before ConnectionManager
+    with sqlite3.connect(path) as conn:
+        conn.row_factory = sqlite3.Row
+        cur = conn.cursor()
+        cur.execute(f"INSERT INTO {table_name} {DB.create_insert_request(**kwargs)}", tuple(kwargs.values()))
+        new_id = cur.lastrowid
+
+    conn.close()
+
+    return new_id
+
+
+def legacy_fetch_one(path: str, table_name: str, **kwargs):
+    with sqlite3.connect(path) as conn:
+        conn.row_factory = sqlite3.Row
+        cur = conn.cursor()
+        cur.execute(f"SELECT * FROM {table_name} {DB.create_where_request(**kwargs)}", tuple(kwargs.values()))
+        response = cur.fetchone()
+
+    conn.close()
+
+    return response
+
+
+def measure(function, count: int) -> float:
+    start = time.perf_counter()
+    for i in range(count):
+        function(i)
+
+    return count / (time.perf_counter() - start)
+
+
+def run(rows: int):
+    directory = tempfile.mkdtemp()
+
+    ConnectionManager.configure(os.path.join(directory, "legacy.db"), journal_mode="DELETE", synchronous="FULL")
+    DB.initialize()
+    ConnectionManager.close_all()
+    legacy_path = ConnectionManager.database_path
+
+    legacy_inserts = measure(lambda i: legacy_insert_one(legacy_path, DB.sensor_readings_table_name, **reading), rows)
+    legacy_fetches = measure(lambda i: legacy_fetch_one(legacy_path, DB.sensor_readings_table_name, id=i + 1), rows)
+
+    ConnectionManager.configure(os.path.join(directory, "pooled.db"), journal_mode="WAL", synchronous="NORMAL")
+    DB.initialize()
+
+    pooled_inserts = measure(lambda i: DB.insert_one(DB.sensor_readings_table_name, **reading), rows)
+    pooled_fetches = measure(lambda i: DB.fetch_one(DB.sensor_readings_table_name, id=i + 1), rows)
+
+    ConnectionManager.close_all()
+
+    print(f"rows: {rows}")
+    print(f"inserts/sec  connect-per-call: {legacy_inserts:10.0f}  pooled: {pooled_inserts:10.0f}  "
+          f"x{pooled_inserts / legacy_inserts:.1f}")
+    print(f"fetches/sec  connect-per-call: {legacy_fetches:10.0f}  pooled: {pooled_fetches:10.0f}  "
+          f"x{pooled_fetches / legacy_fetches:.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=5000)
+    args = parser.parse_args()
+
+    run(args.rows)
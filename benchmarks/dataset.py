@@ -0,0 +1,95 @@
+import argparse
+import os
+import random
+import tempfile
+import time
+from typing import Iterator, List
+
+from modules.database.connection.connection import ConnectionManager
+from modules.database.database.database import DB
+from modules.database.device.device import DeviceInserter
+from modules.database.sensor_reading.sensor_reading import SensorReadingInserter
+from modules.database.timestamp.timestamp import Timestamp
+from modules.database.user.user import UserInserter
+
+# usage: python -m benchmarks.dataset --devices 100 --readings 10000 --users 20 [--path data.db]
+# deterministic synthetic dataset: the same arguments and seed always give the same rows
+
+
+class Dataset:
+    start = Timestamp.from_datetime_string("01.01.2025 00:00:00")
+    interval = 60 * 1000
+
+    def __init__(self, devices: int = 100, readings: int = 1000, users: int = 20, seed: int = 0):
+        # readings per device, every user gets devices / users devices, the rest get none
+        self.devices = devices
+        self.readings = readings
+        self.users = users
+        self.seed = seed
+
+        self.devices_id: List[int] = []
+        self.users_id: List[int] = []
+
+    @staticmethod
+    def serial_number(index: int) -> str:
+        return f"bench-{index:06d}"
+
+    @staticmethod
+    def email(index: int) -> str:
+        return f"bench-{index:06d}@example.com"
+
+    def generate(self, path: str = None, chunk_size: int = 10000) -> str:
+        # fills a new database at path (a temporary one by default) through the regular inserters,
+        # so rollups and latest readings are maintained as in production
+        path = path or os.path.join(tempfile.mkdtemp(), "dataset.db")
+        ConnectionManager.configure(path)
+        DB.initialize()
+
+        self.devices_id = DeviceInserter.insert_many([Dataset.serial_number(index) for index in range(self.devices)])
+        self.users_id = [UserInserter.insert(login=f"bench-{index}", email=Dataset.email(index), password="bench").id
+                         for index in range(self.users)]
+
+        with DB.transaction():
+            for index, device_id in enumerate(self.devices_id):
+                if self.users:
+                    UserInserter.insert_device(self.users_id[index % self.users], device_id)
+
+        rows = []
+        for row in self.rows(self.devices_id, self.readings):
+            rows.append(row)
+
+            if len(rows) >= chunk_size:
+                SensorReadingInserter.insert_rows(rows)
+                rows = []
+
+        SensorReadingInserter.insert_rows(rows)
+
+        return path
+
+    def rows(self, devices_id: List[int], readings: int, offset: int = 0) -> Iterator[dict]:
+        # readings of all devices interleaved by time, as they arrive; offset continues a previous series
+        generator = random.Random(f"{self.seed}:{offset}")
+        for step in range(offset, offset + readings):
+            ts = Dataset.start + step * Dataset.interval
+            datetime = Timestamp.to_datetime_string(ts)
+
+            for device_id in devices_id:
+                yield SensorReadingInserter.constructor(
+                    device_id=device_id, datetime=datetime, temperature=round(generator.uniform(-10, 35), 2),
+                    humidity=round(generator.uniform(20, 90), 2), pressure=round(generator.uniform(98000, 104000), 1),
+                    hydration=round(generator.random(), 3), waterlevel=round(generator.random(), 3))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--readings", type=int, default=1000)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--path")
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    path = Dataset(args.devices, args.readings, args.users, args.seed).generate(args.path)
+    print(f"{args.devices} devices x {args.readings} readings, {args.users} users in {path} "
+          f"({time.perf_counter() - start:.1f}s)")
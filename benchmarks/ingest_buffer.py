@@ -0,0 +1,75 @@
+import argparse
+import os
+import tempfile
+import threading
+import time
+
+from modules.database.connection.connection import ConnectionManager
+from modules.database.database.database import DB
+from modules.database.sensor_reading.sensor_reading import SensorReadingInserter
+from modules.database.sensor_reading.ingest_buffer import IngestBuffer
+from modules.database.timestamp.timestamp import Timestamp
+
+# usage: python -m benchmarks.ingest_buffer --rows 20000 --clients 8
+# sustained write rate of many clients: one commit per reading against IngestBuffer group commits
+
+
+def reading(i: int) -> dict:
+    return dict(device_id=i % 100, datetime=Timestamp.to_datetime_string(1735678800000 + i * 1000),
+                temperature=22.3, humidity=40.1, pressure=106123.3, hydration=0.1, waterlevel=0.0)
+
+
+def run_clients(rows: int, clients: int, insert) -> float:
+    def client(index: int):
+        for i in range(index, rows, clients):
+            insert(reading(i))
+
+        ConnectionManager.close()
+
+    threads = [threading.Thread(target=client, args=(index,)) for index in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    return time.perf_counter() - start
+
+
+def run(rows: int, clients: int, max_rows: int, max_delay_ms: int):
+    ConnectionManager.configure(os.path.join(tempfile.mkdtemp(), "ingest.db"))
+    DB.initialize()
+
+    elapsed = run_clients(rows, clients, lambda row: SensorReadingInserter.insert(**row))
+    print(f"commit per reading: {rows / elapsed:10.0f} rows/s")
+
+    buffer = IngestBuffer(max_rows, max_delay_ms).start()
+    # clients keep sending while their ACKs are pending, the time includes the commit of the last reading
+    futures = []
+    elapsed = run_clients(rows, clients, lambda row: futures.append(buffer.put(row)))
+    start = time.perf_counter()
+    for future in futures:
+        future.result()
+
+    elapsed += time.perf_counter() - start
+    buffer.close()
+    print(f"ingest buffer:      {rows / elapsed:10.0f} rows/s")
+
+    metrics = buffer.metrics()
+    print(f"batch size mean {metrics['batch_size']['mean']:.1f} max {metrics['batch_size']['max']:.0f}, "
+          f"commit latency p50 {metrics['commit_latency']['p50'] * 1000:.1f}ms "
+          f"p99 {metrics['commit_latency']['p99'] * 1000:.1f}ms")
+
+    ConnectionManager.close_all()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=20000)
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--max-rows", type=int, default=1000)
+    parser.add_argument("--max-delay-ms", type=int, default=20)
+    args = parser.parse_args()
+
+    run(args.rows, args.clients, args.max_rows, args.max_delay_ms)
@@ -0,0 +1,97 @@
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from modules.database.connection.connection import ConnectionManager
+from modules.database.database.database import DB
+from modules.database.sensor_reading.sensor_reading import SensorReading
+from modules.database.timestamp.timestamp import Timestamp
+
+# usage: python -m benchmarks.streaming_memory --rows 5000000
+# fills a temporary database, then reads it in child processes with iter_all() and with all()
+
+
+def current_rss_mb() -> float:
+    # anonymous memory only, pages of the mmap-ed database file are not python objects
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("RssAnon:"):
+                    return int(line.split()[1]) / 1024
+
+    except OSError:
+        pass
+
+    return peak_rss_mb()
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def fill(path: str, rows: int, chunk_size: int = 100000):
+    ConnectionManager.configure(path)
+    DB.initialize()
+
+    start_ts = Timestamp.from_datetime_string("01.01.2025 00:00:00")
+    for offset in range(0, rows, chunk_size):
+        DB.insert_many(DB.sensor_readings_table_name, [
+            dict(device_id=i % 100, datetime=Timestamp.to_datetime_string(start_ts + i * 1000),
+                 temperature=20.0, humidity=40.0, pressure=101325.0, hydration=0.5, waterlevel=0.1,
+                 ts=start_ts + i * 1000)
+            for i in range(offset, min(offset + chunk_size, rows))])
+
+    ConnectionManager.close_all()
+
+
+def read(path: str, mode: str, rows: int):
+    ConnectionManager.configure(path)
+
+    samples = []
+    count = 0
+    start = time.perf_counter()
+
+    if mode == "stream":
+        for _ in SensorReading.iter_all(chunk_size=1000):
+            count += 1
+            if count % max(rows // 10, 1) == 0:
+                samples.append(current_rss_mb())
+
+    else:
+        sensor_readings = SensorReading.all()
+        count = len(sensor_readings)
+        samples.append(current_rss_mb())
+
+    elapsed = time.perf_counter() - start
+    print(f"{mode:6} rows: {count}  time: {elapsed:.1f}s  anonymous rss samples (MB): "
+          f"{' '.join(f'{sample:.0f}' for sample in samples)}  peak rss: {peak_rss_mb():.0f} MB")
+
+
+def run(rows: int, with_list: bool):
+    path = os.path.join(tempfile.mkdtemp(), "streaming.db")
+    print(f"filling {rows} rows into {path}")
+    fill(path, rows)
+
+    modes = ["stream", "list"] if with_list else ["stream"]
+    for mode in modes:
+        subprocess.run([sys.executable, "-m", "benchmarks.streaming_memory", "--read", mode, "--path", path,
+                        "--rows", str(rows)], check=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=5000000)
+    parser.add_argument("--with-list", action="store_true", help="also read everything with all() for comparison")
+    parser.add_argument("--read", choices=["stream", "list"])
+    parser.add_argument("--path")
+    args = parser.parse_args()
+
+    if args.read:
+        read(args.path, args.read, args.rows)
+
+    else:
+        run(args.rows, args.with_list)
@@ -0,0 +1,291 @@
+import argparse
+import asyncio
+import json
+import math
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, List
+
+from benchmarks.dataset import Dataset
+from modules.database.connection.connection import ConnectionManager
+from modules.database.database.database import DB
+from modules.database.device.device import Device, DeviceFetcher, DeviceCache
+from modules.database.identity_map.identity_map import IdentityMap
+from modules.database.sensor_reading.sensor_reading import SensorReading
+from modules.database.timestamp.timestamp import Timestamp
+from modules.database.user.user import User
+from modules.server.server import IngestServer
+
+# usage: python -m benchmarks.suite [--devices 100 --readings 1000 --users 20] --output results.json
+#                                   [--compare baseline.json --tolerance 0.2]
+# ingest and query benchmarks on a Dataset; the results are JSON, so runs of different commits can be compared:
+# --compare prints every metric against the baseline and exits with 1 when one got worse by more than tolerance
+
+
+def percentiles(samples: List[float]) -> dict:
+    # exact percentiles in microseconds, Histogram buckets are too coarse for cached lookups
+    samples = sorted(samples)
+
+    def quantile(q: float) -> float:
+        return samples[max(0, math.ceil(q * len(samples)) - 1)] * 1e6
+
+    return dict(count=len(samples), mean_us=sum(samples) / len(samples) * 1e6, p50_us=quantile(0.5),
+                p95_us=quantile(0.95), p99_us=quantile(0.99), max_us=samples[-1] * 1e6)
+
+
+def latency(function: Callable[[int], object], count: int) -> dict:
+    samples = []
+    for i in range(count):
+        start = time.perf_counter()
+        function(i)
+        samples.append(time.perf_counter() - start)
+
+    return percentiles(samples)
+
+
+def throughput(function: Callable[[], int]) -> dict:
+    # function returns the number of rows it handled
+    start = time.perf_counter()
+    rows = function()
+    elapsed = time.perf_counter() - start
+
+    return dict(rows=rows, seconds=elapsed, rows_per_s=rows / elapsed)
+
+
+def insert_single(dataset: Dataset, count: int) -> dict:
+    rows = list(dataset.rows(dataset.devices_id[:1], count, offset=dataset.readings))
+
+    def insert():
+        for row in rows:
+            SensorReading.insert(**{key: row[key] for key in row if key != "ts"})
+
+        return len(rows)
+
+    return throughput(insert)
+
+
+def insert_bulk(dataset: Dataset, readings: int, chunk_size: int, single_inserts: int) -> dict:
+    # continues the series after the single_inserts steps of insert_single
+    rows = [{key: row[key] for key in row if key != "ts"}
+            for row in dataset.rows(dataset.devices_id, readings, offset=dataset.readings + single_inserts)]
+
+    def insert():
+        for offset in range(0, len(rows), chunk_size):
+            SensorReading.insert_many(rows[offset:offset + chunk_size])
+
+        return len(rows)
+
+    return dict(throughput(insert), chunk_size=chunk_size)
+
+
+def device_lookup(dataset: Dataset, count: int, identity_map: bool) -> dict:
+    generator = random.Random(dataset.seed)
+    serial_numbers = [Dataset.serial_number(generator.randrange(dataset.devices)) for _ in range(count)]
+
+    previous = DeviceFetcher.identity_map.enabled
+    IdentityMap.configure(enabled=identity_map)
+    IdentityMap.clear_all()
+    try:
+        return latency(lambda i: Device(serial_number=serial_numbers[i]), count)
+
+    finally:
+        IdentityMap.configure(enabled=previous)
+
+
+def user_devices(dataset: Dataset, count: int) -> dict:
+    users = [User(id=user_id) for user_id in dataset.users_id]
+
+    return latency(lambda i: users[i % len(users)].devices, count)
+
+
+def user_devices_with_latest(dataset: Dataset, count: int) -> dict:
+    users = [User(id=user_id) for user_id in dataset.users_id]
+
+    return latency(lambda i: users[i % len(users)].devices_with_latest(), count)
+
+
+def device_sensor_readings(dataset: Dataset, count: int) -> dict:
+    # the whole history of a device, dataset.readings rows per call
+    devices = [Device(id=device_id) for device_id in dataset.devices_id]
+
+    return dict(latency(lambda i: devices[i % len(devices)].sensor_readings, count), rows=dataset.readings)
+
+
+def save_backup(count: int) -> dict:
+    DB.dumps_path = os.path.join(tempfile.mkdtemp(), "database_dumps")
+    samples = []
+    for _ in range(count):
+        start = time.perf_counter()
+        dump_path = DB.save_backup(sleep=0, keep=1)
+        samples.append(time.perf_counter() - start)
+
+    size = sum(os.path.getsize(os.path.join(directory, name))
+               for directory, _, names in os.walk(dump_path) for name in names)
+
+    return dict(count=count, seconds=min(samples), mean_seconds=sum(samples) / count, bytes=size)
+
+
+def server_ingest(dataset: Dataset, messages: int, clients: int, window: int) -> dict:
+    # text protocol over loopback, every client keeps window commands in flight; the server runs in the same loop
+    async def client(index: int, count: int, port: int) -> int:
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        serial_number = Dataset.serial_number(index % dataset.devices).encode()
+        line = b"POST SENSOR READING " + serial_number + b" 21.5 40.1 101325.0 0.3 0.7\n"
+
+        acked = 0
+        sent = 0
+        while sent < count:
+            burst = min(window, count - sent)
+            writer.write(line * burst)
+            sent += burst
+            for _ in range(burst):
+                acked += (await reader.readline()).startswith(b"ACK")
+
+        writer.close()
+        await writer.wait_closed()
+
+        return acked
+
+    async def run() -> dict:
+        server = IngestServer("127.0.0.1", 0, report_interval=None)
+        port = (await server.start()).sockets[0].getsockname()[1]
+
+        start = time.perf_counter()
+        acked = await asyncio.gather(*(client(index, messages // clients, port) for index in range(clients)))
+        elapsed = time.perf_counter() - start
+
+        metrics = server.metrics()
+        await server.stop()
+
+        return dict(messages=messages // clients * clients, acked=sum(acked), seconds=elapsed,
+                    messages_per_s=sum(acked) / elapsed, clients=clients, window=window,
+                    ack_p50_ms=metrics["ack_latency"]["p50"] * 1000, ack_p99_ms=metrics["ack_latency"]["p99"] * 1000,
+                    batch_size_mean=metrics["buffer"]["batch_size"]["mean"])
+
+    return asyncio.run(run())
+
+
+def commit() -> str | None:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args) -> dict:
+    dataset = Dataset(args.devices, args.readings, args.users, args.seed)
+
+    start = time.perf_counter()
+    path = dataset.generate(os.path.join(tempfile.mkdtemp(), "suite.db"))
+    generated = time.perf_counter() - start
+
+    # read benchmarks first, the insert benchmarks grow the dataset
+    benchmarks = [
+        ("device_lookup", lambda: device_lookup(dataset, args.lookups, True)),
+        ("device_lookup_uncached", lambda: device_lookup(dataset, args.lookups, False)),
+        ("user_devices", lambda: user_devices(dataset, args.lookups)),
+        ("user_devices_with_latest", lambda: user_devices_with_latest(dataset, args.lookups)),
+        ("device_sensor_readings", lambda: device_sensor_readings(dataset, args.history_reads)),
+        ("save_backup", lambda: save_backup(args.backups)),
+        ("insert_single", lambda: insert_single(dataset, args.single_inserts)),
+        ("insert_bulk", lambda: insert_bulk(dataset, args.bulk_readings, args.chunk_size,
+                                                args.single_inserts)),
+        ("server_ingest", lambda: server_ingest(dataset, args.messages, args.clients, args.window)),
+    ]
+
+    results = {}
+    for name, benchmark in benchmarks:
+        if args.only and name not in args.only:
+            continue
+
+        DeviceCache.clear()
+        results[name] = benchmark()
+        print(f"{name:26} {summary(results[name])}")
+
+    ConnectionManager.close_all()
+
+    return dict(commit=commit(), created_at=Timestamp.to_datetime_string(Timestamp.now()),
+                python=platform.python_version(), sqlite=sqlite3.sqlite_version, platform=platform.platform(),
+                parameters=dict(devices=args.devices, readings=args.readings, users=args.users, seed=args.seed),
+                dataset=dict(path=path, seconds=generated), results=results)
+
+
+def summary(result: dict) -> str:
+    return ", ".join(f"{key} {value:.4g}" if isinstance(value, float) else f"{key} {value}"
+                     for key, value in result.items())
+
+
+# compared metrics -> whether a larger value is better; max and mean latencies are too noisy to gate on
+directions = {"rows_per_s": True, "messages_per_s": True, "p50_us": False, "p99_us": False, "ack_p99_ms": False,
+              "seconds": False}
+
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    # prints every comparable metric, returns the ones that got worse by more than tolerance
+    if results["parameters"] != baseline.get("parameters"):
+        print(f"parameters differ: {baseline.get('parameters')} -> {results['parameters']}")
+
+    regressions = []
+    for name, result in results["results"].items():
+        for key, value in result.items():
+            previous = baseline.get("results", {}).get(name, {}).get(key)
+            higher = directions.get(key)
+            if higher is None or not isinstance(previous, (int, float)) or not previous:
+                continue
+
+            change = value / previous - 1
+            worse = -change if higher else change
+            flag = "REGRESSION" if worse > tolerance else ""
+            print(f"{name + '.' + key:45} {previous:12.4g} -> {value:12.4g} {change:+8.1%} {flag}")
+
+            if flag:
+                regressions.append(f"{name}.{key}")
+
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--readings", type=int, default=1000, help="readings per device in the dataset")
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--lookups", type=int, default=10000)
+    parser.add_argument("--history-reads", type=int, default=100)
+    parser.add_argument("--backups", type=int, default=3)
+    parser.add_argument("--single-inserts", type=int, default=1000)
+    parser.add_argument("--bulk-readings", type=int, default=100, help="readings per device of insert_bulk")
+    parser.add_argument("--chunk-size", type=int, default=1000)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--clients", type=int, default=20)
+    parser.add_argument("--window", type=int, default=32)
+    parser.add_argument("--only", nargs="*", help="names of the benchmarks to run")
+    parser.add_argument("--output", required=True, help="JSON file of the results")
+    parser.add_argument("--compare", help="JSON results of a previous run")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = run(args)
+
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+
+    if args.compare:
+        with open(args.compare) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+
+        if regressions:
+            print(f"regressions: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
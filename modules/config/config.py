@@ -0,0 +1,30 @@
+import datetime as dt
+
+# format of sensor_readings.datetime, as devices and scripts write it
+datetime_format = "%d.%m.%Y %H:%M:%S"
+
+# readings are stamped with Moscow time (UTC+3, no DST)
+timezone = dt.timezone(dt.timedelta(hours=3), "MSK")
+
+# readings older than this are moved from the database into the compressed archive by the retention job
+retention_days = 365
+
+# ingest server of the devices
+ingest_host = "0.0.0.0"
+ingest_port = 4500
+
+# read-through cache of users and devices by id and unique keys, per process; off by default, a process opts in
+# with IdentityMap.configure(enabled=True). Writes of the process itself are seen at once, changes made by other
+# processes (e.g. the ingest cluster, scripts) only after at most identity_map_ttl seconds: a deleted device or a
+# changed email can be served stale for that long
+identity_map_enabled = False
+identity_map_size = 10000
+identity_map_ttl = 60
+
+# timing of every DB call per table and operation, see Instrumentation; calls slower than slow_query_ms are kept
+# with their query plan (the last slow_query_log_size of them) and also appended to paths.slow_query_log_path
+# when slow_query_log_file is set
+db_instrumentation_enabled = False
+slow_query_ms = 100
+slow_query_log_size = 100
+slow_query_log_file = False
@@ -15,6 +15,7 @@ archive = os.path.join(data_path, "database.tar.gz")
 database_dumps_path = os.path.join(data_path, "database_dumps")
 database_dump_path = os.path.join(database_dumps_path, "database_dump.db")
 config_path = os.path.join(data_path, "config.json")
+slow_query_log_path = os.path.join(data_path, "slow_queries.jsonl")
 
 modules_path = os.path.join(project_path, "modules")
 scripts_path = os.path.join(project_path, "scripts")
@@ -0,0 +1,268 @@
+from __future__ import annotations
+
+import re
+import itertools
+from typing import List, Tuple
+
+from modules.database.database.database import DB
+from modules.database.rollup.rollup import Rollup
+from modules.database.partition.partition import Partition
+from modules.database.archive.archive import Archive
+
+
+class InvalidAggregationArgumentsError(Exception):
+    def __init__(self, argument=None):
+        self.argument = argument
+
+    def __str__(self) -> str:
+        return f"Invalid aggregation argument: {self.argument!r}"
+
+
+class Aggregation:
+    # compiles ad-hoc statistics over sensor_readings into one GROUP BY query; archived readings of the window
+    # are run through the same query chunk by chunk in a temporary table
+    archived_table_name = "sensor_readings_archived"
+    metrics = ["temperature", "humidity", "pressure", "hydration", "waterlevel"]
+    functions = {
+        "avg": "avg({metric})",
+        "min": "min({metric})",
+        "max": "max({metric})",
+        "sum": "sum({metric})",
+        "count": "count({metric})",
+        "last": "last_by_ts(ts, {metric})",
+    }
+    operators = ["<", "<=", ">", ">=", "=", "!="]
+    group_columns = ["device_id", "bucket"]
+
+    @staticmethod
+    def run(aggregations: List[str], group_by: List[str] = None, bucket: str | int = None, start: int = None,
+            end: int = None, devices_id: List[int] = None, filters: List[Tuple[str, str, float]] = None) -> List[dict]:
+        segments = Partition.segments(start, end)
+        archived = [device_id for device_id in Archive.devices(start, end)
+                    if devices_id is None or device_id in devices_id]
+
+        if len(segments) <= 1 and not archived:
+            month, start, end = segments[0] if segments else (None, start, end)
+
+            with Partition.attached(month) as table_name:
+                query, values = Aggregation.compile(aggregations, group_by, bucket, start, end, devices_id, filters,
+                                                    table_name)
+                return [dict(row) for row in DB.fetch_query(query, values)]
+
+        return Aggregation._run_segments(segments, aggregations, group_by, bucket, devices_id, filters, archived,
+                                         start, end)
+
+    @staticmethod
+    def compile(aggregations: List[str], group_by: List[str] = None, bucket: str | int = None, start: int = None,
+                end: int = None, devices_id: List[int] = None, filters: List[Tuple[str, str, float]] = None,
+                table_name: str = DB.sensor_readings_table_name) -> Tuple[str, tuple]:
+        # aggregations: "avg(temperature)", "count(*)", "last(waterlevel)", ...
+        # filters: ("waterlevel", "<", 0.2), all of them must hold
+        group_by = group_by or []
+        columns = []
+        values = []
+
+        for column in group_by:
+            if column not in Aggregation.group_columns:
+                raise InvalidAggregationArgumentsError(column)
+
+        if "device_id" in group_by:
+            columns.append("device_id")
+
+        if "bucket" in group_by:
+            size = Rollup.bucket_size(bucket) if isinstance(bucket, str) else bucket
+            if not isinstance(size, int) or size <= 0:
+                raise InvalidAggregationArgumentsError(bucket)
+
+            columns.append(f"(ts + {Rollup.offset}) / {size} * {size} - {Rollup.offset} AS bucket")
+
+        elif bucket is not None:
+            raise InvalidAggregationArgumentsError(bucket)
+
+        if not aggregations:
+            raise InvalidAggregationArgumentsError(aggregations)
+
+        for aggregation in aggregations:
+            columns.append(f'{Aggregation._compile_aggregation(aggregation)} AS "{aggregation}"')
+
+        conditions = []
+        if devices_id is not None:
+            devices_id = list(devices_id)
+            conditions.append(f"device_id IN ({', '.join('?' for _ in devices_id)})")
+            values.extend(devices_id)
+
+        if start is not None:
+            conditions.append("ts >= ?")
+            values.append(start)
+
+        if end is not None:
+            conditions.append("ts < ?")
+            values.append(end)
+
+        for metric, operator, value in filters or []:
+            if metric not in Aggregation.metrics or operator not in Aggregation.operators:
+                raise InvalidAggregationArgumentsError((metric, operator, value))
+
+            conditions.append(f"{metric} {operator} ?")
+            values.append(value)
+
+        query = f"SELECT {', '.join(columns)} FROM {table_name}"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+
+        group_columns = [column for column in ["device_id", "bucket"] if column in group_by]
+        if group_columns:
+            query += f" GROUP BY {', '.join(group_columns)} ORDER BY {', '.join(group_columns)}"
+
+        return query, tuple(values)
+
+    @staticmethod
+    def _run_segments(segments: list, aggregations: List[str], group_by: List[str], bucket: str | int,
+                      devices_id: List[int], filters: List[Tuple[str, str, float]], archived: List[int] = (),
+                      start: int = None, end: int = None) -> List[dict]:
+        # one query per partition with mergeable parts (avg as sum and count), merged in ts order: the archive
+        # of the archived devices first, it holds their oldest readings, then the segments
+        parts = []
+        for aggregation in aggregations:
+            match = re.fullmatch(r"\s*(\w+)\s*\(\s*(\w+|\*)\s*\)\s*", aggregation)
+            function, metric = match.groups() if match else (None, None)
+            parts += [f"sum({metric})", f"count({metric})"] if function == "avg" else [aggregation]
+
+        # last values of the parts are compared by the time of their last reading
+        if any(part.split("(")[0].strip() == "last" for part in parts) and "max(ts)" not in parts:
+            parts.append("max(ts)")
+
+        group_columns = [column for column in ["device_id", "bucket"] if column in (group_by or [])]
+        rows = []
+        for device_id in archived:
+            rows += Aggregation._fetch_archived(parts, group_by, bucket, device_id, start, end, filters)
+
+        for month, segment_start, segment_end in segments:
+            with Partition.attached(month) as table_name:
+                query, values = Aggregation.compile(parts, group_by, bucket, segment_start, segment_end, devices_id,
+                                                    filters, table_name)
+                rows += DB.fetch_query(query, values)
+
+        groups = {}
+        for row in rows:
+            key = tuple(row[column] for column in group_columns)
+            groups[key] = Aggregation._merge(groups.get(key), dict(row))
+
+        response = []
+        # device_id and bucket are NULL for readings without them, first as in ORDER BY of a single query
+        for key in sorted(groups, key=lambda group: tuple((value is not None, value) for value in group)):
+            merged = groups[key]
+            row = {column: merged[column] for column in group_columns}
+
+            for aggregation in aggregations:
+                match = re.fullmatch(r"\s*(\w+)\s*\(\s*(\w+|\*)\s*\)\s*", aggregation)
+                function, metric = match.groups()
+
+                if function == "avg":
+                    count = merged[f"count({metric})"]
+                    row[aggregation] = merged[f"sum({metric})"] / count if count else None
+
+                else:
+                    row[aggregation] = merged[aggregation]
+
+            response.append(row)
+
+        return response
+
+    @staticmethod
+    def _fetch_archived(parts: List[str], group_by: List[str], bucket: str | int, device_id: int, start: int | None,
+                        end: int | None, filters: List[Tuple[str, str, float]]) -> list:
+        # the parts per chunk of archived readings of the device, in ts order; the archive is unpacked lazily,
+        # so at most Partition.chunk_size readings are held at once
+        readings = Archive.iter_rows(device_id, start, end)
+        columns = ", ".join(Partition.columns)
+        rows = []
+
+        with DB.transaction() as conn:
+            conn.execute(f"""
+                CREATE TEMP TABLE IF NOT EXISTS {Aggregation.archived_table_name} AS
+                SELECT {columns} FROM {DB.sensor_readings_table_name} WHERE 0
+                """)
+
+        try:
+            while True:
+                chunk = list(itertools.islice(readings, Partition.chunk_size))
+                if not chunk:
+                    break
+
+                with DB.transaction() as conn:
+                    conn.execute(f"DELETE FROM temp.{Aggregation.archived_table_name}")
+                    conn.executemany(f"""
+                        INSERT INTO temp.{Aggregation.archived_table_name} ({columns})
+                        VALUES ({", ".join("?" for _ in Partition.columns)})
+                        """, [tuple(reading[column] for column in Partition.columns) for reading in chunk])
+
+                query, values = Aggregation.compile(parts, group_by, bucket, None, None, None, filters,
+                                                    f"temp.{Aggregation.archived_table_name}")
+                rows += DB.fetch_query(query, values)
+
+        finally:
+            with DB.transaction() as conn:
+                conn.execute(f"DROP TABLE IF EXISTS temp.{Aggregation.archived_table_name}")
+
+        return rows
+
+    @staticmethod
+    def _merge(merged: dict | None, row: dict) -> dict:
+        if merged is None:
+            return row
+
+        # equal times keep the order of the parts, a later one holds the later readings
+        later = "max(ts)" not in row or row["max(ts)"] is not None and (
+            merged["max(ts)"] is None or row["max(ts)"] >= merged["max(ts)"])
+
+        for part, value in row.items():
+            function = part.split("(")[0].strip()
+
+            if function not in Aggregation.functions:
+                continue
+
+            if function == "last":
+                if later:
+                    merged[part] = value
+
+            elif value is None:
+                continue
+
+            elif merged[part] is None:
+                merged[part] = value
+
+            elif function in ("sum", "count"):
+                merged[part] += value
+
+            elif function == "min":
+                merged[part] = min(merged[part], value)
+
+            elif function == "max":
+                merged[part] = max(merged[part], value)
+
+        return merged
+
+    @staticmethod
+    def _compile_aggregation(aggregation: str) -> str:
+        match = re.fullmatch(r"\s*(\w+)\s*\(\s*(\w+|\*)\s*\)\s*", aggregation)
+
+        if not match or match.group(1) not in Aggregation.functions:
+            raise InvalidAggregationArgumentsError(aggregation)
+
+        function, metric = match.groups()
+        if metric == "*" and function == "count":
+            return "count(*)"
+
+        # time of the first and the last reading
+        if metric == "ts" and function in ("min", "max"):
+            return f"{function}(ts)"
+
+        if metric not in Aggregation.metrics:
+            raise InvalidAggregationArgumentsError(aggregation)
+
+        return Aggregation.functions[function].format(metric=metric)
+
+
+if __name__ == "__main__":
+    pass
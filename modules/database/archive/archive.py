@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+import io
+import os
+import csv
+import tarfile
+from typing import List, Iterator
+from dataclasses import dataclass
+
+from modules.database.database.database import DB
+
+
+@dataclass
+class DbArchiveChunk:
+    device_id: int
+    month: str
+    start_ts: int
+    end_ts: int
+    count: int
+    offset: int
+    size: int
+
+
+class Archive:
+    # data/database.tar.gz: append-only, every chunk (readings of one device for one month) is a separate
+    # gzip member holding a one-file tar, so a chunk is read by seeking to its offset;
+    # the whole file is unpacked with tar -xzif
+    table_name = "sensor_readings_archive"
+    int_columns = ["id", "device_id", "ts"]
+    float_columns = ["temperature", "humidity", "pressure", "hydration", "waterlevel"]
+    columns = ["id", "device_id", "datetime", "temperature", "humidity", "pressure", "hydration", "waterlevel", "ts"]
+
+    @staticmethod
+    def path() -> str:
+        return DB.archive_path()
+
+    @staticmethod
+    def append(chunks: List[tuple]) -> List[DbArchiveChunk]:
+        # chunks are (device_id, month, start_ts, end_ts, rows); the file is synced before the chunks are
+        # registered, a failure in between leaves only unreferenced bytes behind
+        members = [(device_id, month, start_ts, end_ts, rows, Archive._pack(device_id, month, rows))
+                   for device_id, month, start_ts, end_ts, rows in chunks if rows]
+
+        if not members:
+            return []
+
+        archive_chunks = []
+        with open(Archive.path(), "ab") as file:
+            for device_id, month, start_ts, end_ts, rows, data in members:
+                archive_chunks.append(DbArchiveChunk(device_id, month, start_ts, end_ts, len(rows), file.tell(),
+                                                     len(data)))
+                file.write(data)
+
+            file.flush()
+            os.fsync(file.fileno())
+
+        with DB.transaction() as conn:
+            conn.executemany(f"""
+                INSERT OR REPLACE INTO {Archive.table_name} (device_id, month, start_ts, end_ts, count, offset, size)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, [tuple(chunk.__dict__.values()) for chunk in archive_chunks])
+
+        return archive_chunks
+
+    @staticmethod
+    def chunks(device_id: int, start: int = None, end: int = None) -> List[DbArchiveChunk]:
+        return [DbArchiveChunk(**dict(info)) for info in DB.fetch_query(f"""
+            SELECT * FROM {Archive.table_name} WHERE device_id = ? AND end_ts > ? AND start_ts < ?
+            ORDER BY start_ts, offset
+            """, (device_id, -2 ** 63 if start is None else start, 2 ** 63 - 1 if end is None else end))]
+
+    @staticmethod
+    def devices(start: int = None, end: int = None) -> List[int]:
+        # devices with archived readings that may fall into start <= ts < end
+        return [row["device_id"] for row in DB.fetch_query(f"""
+            SELECT DISTINCT device_id FROM {Archive.table_name} WHERE end_ts > ? AND start_ts < ? ORDER BY device_id
+            """, (-2 ** 63 if start is None else start, 2 ** 63 - 1 if end is None else end))]
+
+    @staticmethod
+    def rows(device_id: int, start: int = None, end: int = None, order: str = "asc") -> List[dict]:
+        return list(Archive.iter_rows(device_id, start, end, order))
+
+    @staticmethod
+    def iter_rows(device_id: int, start: int = None, end: int = None, order: str = "asc") -> Iterator[dict]:
+        # archived readings with start <= ts < end ordered by (ts, id), as the database returns them;
+        # lazy, only the chunks of the month being read are unpacked, so a caller that stops early
+        # does not unpack the rest; a month archived twice (retention rerun after a failure) repeats ids,
+        # they are returned once
+        months = {}
+        for chunk in Archive.chunks(device_id, start, end):
+            months.setdefault(chunk.month, []).append(chunk)
+
+        for month in sorted(months, reverse=order == "desc"):
+            rows = {}
+            for chunk in months[month]:
+                rows.update((row["id"], row) for row in Archive.read(chunk)
+                            if (start is None or row["ts"] >= start) and (end is None or row["ts"] < end))
+
+            yield from sorted(rows.values(), key=lambda row: (row["ts"], row["id"]), reverse=order == "desc")
+
+    @staticmethod
+    def read(chunk: DbArchiveChunk) -> List[dict]:
+        with open(Archive.path(), "rb") as file:
+            file.seek(chunk.offset)
+            data = file.read(chunk.size)
+
+        with tarfile.open(fileobj=io.BytesIO(data), mode="r:gz") as tar:
+            text = tar.extractfile(tar.next()).read().decode()
+
+        return [Archive._row(values) for values in csv.DictReader(io.StringIO(text))]
+
+    @staticmethod
+    def _pack(device_id: int, month: str, rows: list) -> bytes:
+        text = io.StringIO()
+        writer = csv.writer(text)
+        writer.writerow(Archive.columns)
+        writer.writerows([[row[column] for column in Archive.columns] for row in rows])
+        data = text.getvalue().encode()
+
+        info = tarfile.TarInfo(f"{DB.sensor_readings_table_name}/{device_id}/{month}.csv")
+        info.size = len(data)
+
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+            tar.addfile(info, io.BytesIO(data))
+
+        return buffer.getvalue()
+
+    @staticmethod
+    def _row(values: dict) -> dict:
+        row = dict(values)
+        for column in Archive.int_columns:
+            row[column] = int(row[column]) if row[column] != "" else None
+
+        for column in Archive.float_columns:
+            row[column] = float(row[column]) if row[column] != "" else None
+
+        return row
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,210 @@
+from __future__ import annotations
+
+import weakref
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Set
+
+from modules.config.paths import database_path
+
+
+class LastValue:
+    # агрегат last_by_ts(ts, value): value строки с наибольшим ts в группе
+    def __init__(self):
+        self.ts = None
+        self.value = None
+
+    def step(self, ts, value):
+        if ts is not None and (self.ts is None or ts >= self.ts):
+            self.ts = ts
+            self.value = value
+
+    def finalize(self):
+        return self.value
+
+
+class TracedConnection(sqlite3.Connection):
+    # запоминает trace callback приложения: sqlite3 не отдаёт текущий, а инструментирование должно вызывать его
+    # и возвращать на место
+    trace_callback = None
+
+    def set_trace_callback(self, callback):
+        self.trace_callback = callback
+        super().set_trace_callback(callback)
+
+
+class ThreadConnection:
+    # живёт в threading.local потока, пока поток держит соединение; при завершении потока сборщик удаляет его,
+    # и финализатор закрывает соединение
+    pass
+
+
+class ConnectionManager:
+    # одно долгоживущее соединение на поток, настраивается один раз при создании
+    database_path = database_path
+    pragmas = {
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "foreign_keys": "OFF",
+        "temp_store": "MEMORY",
+        "mmap_size": 256 * 1024 * 1024,
+        "cache_size": -64 * 1024,
+        "busy_timeout": 5000,
+    }
+
+    _local = threading.local()
+    # открытые соединения всех потоков
+    _connections: Set[sqlite3.Connection] = set()
+    _generation = 0
+    _lock = threading.Lock()
+
+    @staticmethod
+    def configure(path: str = None, **pragmas):
+        ConnectionManager.close_all()
+
+        if path is not None:
+            ConnectionManager.database_path = path
+
+        ConnectionManager.pragmas = {**ConnectionManager.pragmas, **pragmas}
+
+    @staticmethod
+    def get() -> sqlite3.Connection:
+        conn = getattr(ConnectionManager._local, "conn", None)
+
+        # после close_all поток сам переоткрывает своё соединение, но не посреди транзакции
+        if conn is not None and ConnectionManager._local.generation != ConnectionManager._generation \
+                and not ConnectionManager._local.depth:
+            ConnectionManager.close()
+            conn = None
+
+        if conn is None:
+            conn = ConnectionManager._connect()
+            ConnectionManager._local.conn = conn
+            ConnectionManager._local.depth = 0
+            ConnectionManager._local.generation = ConnectionManager._generation
+
+            owner = ConnectionManager._local.owner = ThreadConnection()
+            ConnectionManager._local.release = weakref.finalize(owner, ConnectionManager._release, conn)
+
+            with ConnectionManager._lock:
+                ConnectionManager._connections.add(conn)
+
+        return conn
+
+    @staticmethod
+    def _release(conn: sqlite3.Connection):
+        with ConnectionManager._lock:
+            ConnectionManager._connections.discard(conn)
+
+        try:
+            conn.close()
+
+        except sqlite3.Error:
+            pass
+
+    @staticmethod
+    def _connect() -> sqlite3.Connection:
+        conn = sqlite3.connect(ConnectionManager.database_path, check_same_thread=False, factory=TracedConnection)
+        conn.row_factory = sqlite3.Row
+
+        for pragma, value in ConnectionManager.pragmas.items():
+            conn.execute(f"PRAGMA {pragma} = {value}")
+
+        conn.create_aggregate("last_by_ts", 2, LastValue)
+
+        return conn
+
+    @staticmethod
+    @contextmanager
+    def transaction():
+        # вложенные транзакции присоединяются к внешней, commit только при выходе из неё
+        conn = ConnectionManager.get()
+        ConnectionManager._local.depth += 1
+
+        try:
+            yield conn
+
+        except BaseException:
+            ConnectionManager._local.depth -= 1
+            if ConnectionManager._local.depth == 0:
+                ConnectionManager._local.on_commit = []
+                conn.rollback()
+            raise
+
+        ConnectionManager._local.depth -= 1
+        if ConnectionManager._local.depth == 0:
+            conn.commit()
+
+            callbacks = getattr(ConnectionManager._local, "on_commit", [])
+            ConnectionManager._local.on_commit = []
+            for callback in callbacks:
+                ConnectionManager._run_callback(callback)
+
+    @staticmethod
+    def on_commit(callback):
+        # callback выполняется после commit внешней транзакции, без транзакции - сразу
+        if not ConnectionManager.in_transaction():
+            ConnectionManager._run_callback(callback)
+            return
+
+        if not hasattr(ConnectionManager._local, "on_commit"):
+            ConnectionManager._local.on_commit = []
+
+        ConnectionManager._local.on_commit.append(callback)
+
+    @staticmethod
+    def _run_callback(callback):
+        # данные уже записаны, ошибка callback не должна выглядеть для вызывающего как неудавшаяся запись
+        try:
+            callback()
+
+        except Exception as error:
+            print(f"On commit callback {getattr(callback, '__qualname__', callback)} failed: {error!r}")
+
+    @staticmethod
+    def in_transaction() -> bool:
+        return getattr(ConnectionManager._local, "depth", 0) > 0
+
+    @staticmethod
+    def is_healthy() -> bool:
+        conn = getattr(ConnectionManager._local, "conn", None)
+
+        if conn is None or ConnectionManager._local.generation != ConnectionManager._generation:
+            return True
+
+        try:
+            conn.execute("SELECT 1").fetchone()
+
+        except sqlite3.Error:
+            return False
+
+        return True
+
+    @staticmethod
+    def check():
+        # закрывает сломанное соединение потока, следующий вызов переподключится
+        if not ConnectionManager.is_healthy():
+            ConnectionManager.close()
+
+    @staticmethod
+    def close():
+        conn = getattr(ConnectionManager._local, "conn", None)
+
+        if conn is None:
+            return
+
+        ConnectionManager._local.conn = None
+        ConnectionManager._local.depth = 0
+        ConnectionManager._local.owner = None
+        ConnectionManager._local.release()
+
+    @staticmethod
+    def close_all():
+        # соединения других потоков не трогаются: они могут быть посреди транзакции; каждый поток закрывает
+        # и переоткрывает своё при следующем get() вне транзакции
+        with ConnectionManager._lock:
+            ConnectionManager._generation += 1
+
+        if not ConnectionManager.in_transaction():
+            ConnectionManager.close()
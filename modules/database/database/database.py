@@ -1,6 +1,15 @@
 import sqlite3
-
-from modules.config.paths import database_path, database_dump_path
+import datetime as dt
+import shutil
+import threading
+from concurrent.futures import Future
+from typing import List, Callable
+
+from modules.config.paths import database_dump_path, database_dumps_path
+from modules.database.connection.connection import ConnectionManager
+from modules.database.instrumentation.instrumentation import Instrumentation
+from modules.database.identity_map.identity_map import IdentityMap
+from modules.database.migration.migration import Migrator
 import re
 import os
 
@@ -10,108 +19,419 @@ class DB:
     users_table_name = "users"
     users_devices_table_name = "users_devices"
     devices_table_name = "devices"
+    users_notifications_table_name = "users_notifications"
+    users_settings_table_name = "users_settings"
+    notification_rules_table_name = "notification_rules"
+
+    dumps_path = database_dumps_path
+    dumps_keep = 5
 
+    @staticmethod
+    def partitions_path() -> str:
+        # запечатанные месяцы sensor_readings лежат отдельными файлами рядом с базой
+        return os.path.join(os.path.dirname(ConnectionManager.database_path), "partitions")
 
+    @staticmethod
+    def archive_path() -> str:
+        return os.path.splitext(ConnectionManager.database_path)[0] + ".tar.gz"
 
     @staticmethod
-    def save_backup():
-        # Убедимся, что исходная база существует
-        if not os.path.exists(database_path):
+    def save_backup(pages: int = 1024, sleep: float = 0.01, progress: Callable[[int, int, int], None] = None,
+                    keep: int = None) -> str:
+        # копия по pages страниц с паузой sleep между шагами, запись в базу между шагами не блокируется;
+        # каждая копия - отдельная папка database_dumps/database_dump_<время>, хранятся последние keep
+        if not os.path.exists(ConnectionManager.database_path):
             raise FileNotFoundError(f"Source database not found")
 
-        with sqlite3.connect(database_path) as src_conn:
-            with sqlite3.connect(database_dump_path) as dest_conn:
-                src_conn.backup(dest_conn, pages=0, progress=None)
+        name = f"database_dump_{dt.datetime.now():%Y%m%d_%H%M%S_%f}"
+        dump_path = os.path.join(DB.dumps_path, name)
+        # недописанная копия остаётся .tmp и не попадает в список копий
+        tmp_path = dump_path + ".tmp"
+        os.makedirs(tmp_path)
+
+        # сначала основная база, потом партиции: строка, перенесённая в партицию во время копии,
+        # окажется в обеих копиях, а не потеряется
+        DB._backup_file(ConnectionManager.database_path, os.path.join(tmp_path, "database.db"),
+                        pages, sleep, progress)
+
+        if os.path.isdir(DB.partitions_path()):
+            os.makedirs(os.path.join(tmp_path, "partitions"))
+            for file_name in sorted(os.listdir(DB.partitions_path())):
+                if file_name.endswith(".db"):
+                    DB._backup_file(os.path.join(DB.partitions_path(), file_name),
+                                    os.path.join(tmp_path, "partitions", file_name), pages, sleep, progress)
+
+        if os.path.exists(DB.archive_path()):
+            # архив только дописывается, куски, не попавшие в индекс копии базы, не читаются
+            shutil.copyfile(DB.archive_path(), os.path.join(tmp_path, os.path.basename(DB.archive_path())))
+
+        os.rename(tmp_path, dump_path)
+
+        for old_dump in DB.list_backups()[:-(keep or DB.dumps_keep)]:
+            shutil.rmtree(old_dump)
+
+        return dump_path
+
+    @staticmethod
+    def backup_async(pages: int = 1024, sleep: float = 0.01, progress: Callable[[int, int, int], None] = None,
+                     keep: int = None) -> Future:
+        # save_backup в фоновом потоке; future получает путь копии или исключение
+        future = Future()
+
+        def run():
+            try:
+                future.set_result(DB.save_backup(pages, sleep, progress, keep))
+
+            except BaseException as error:
+                future.set_exception(error)
+
+        threading.Thread(target=run, name="database-backup", daemon=True).start()
+
+        return future
+
+    @staticmethod
+    def list_backups() -> List[str]:
+        # готовые копии, от старых к новым
+        if not os.path.isdir(DB.dumps_path):
+            return []
+
+        return [os.path.join(DB.dumps_path, name) for name in sorted(os.listdir(DB.dumps_path))
+                if name.startswith("database_dump_") and not name.endswith(".tmp")
+                and os.path.isdir(os.path.join(DB.dumps_path, name))]
 
     @staticmethod
-    def load_backup():
-        if not os.path.exists(database_dump_path):
+    def load_backup(dump_path: str = None):
+        # по умолчанию последняя копия; файлы собираются рядом с живыми и подменяют их через rename,
+        # так что при ошибке до подмены база остаётся прежней
+        if dump_path is None:
+            dumps = DB.list_backups()
+            dump_path = dumps[-1] if dumps else database_dump_path
+
+        if os.path.isdir(dump_path):
+            database_dump = os.path.join(dump_path, "database.db")
+            partitions_dump = os.path.join(dump_path, "partitions")
+            archive_dump = os.path.join(dump_path, os.path.basename(DB.archive_path()))
+
+        else:
+            # копия старого формата: один файл database_dump.db
+            database_dump, partitions_dump, archive_dump = dump_path, None, None
+
+        if not os.path.exists(database_dump):
             raise FileNotFoundError(f"Source dump database not found")
 
-        if os.path.exists(database_path):
-            os.remove(database_path)
+        restored = [(database_dump, ConnectionManager.database_path)]
+        if partitions_dump and os.path.isdir(partitions_dump):
+            restored += [(os.path.join(partitions_dump, file_name), os.path.join(DB.partitions_path(), file_name))
+                         for file_name in sorted(os.listdir(partitions_dump))]
+
+        for source, destination in restored:
+            os.makedirs(os.path.dirname(destination), exist_ok=True)
+            DB._backup_file(source, destination + ".restore", pages=0)
+
+        if archive_dump and os.path.exists(archive_dump):
+            shutil.copyfile(archive_dump, DB.archive_path() + ".restore")
+            restored.append((archive_dump, DB.archive_path()))
+
+        ConnectionManager.close_all()
+        # закэшированные пользователи и устройства относятся к заменяемой базе
+        IdentityMap.clear_all()
+
+        # партиции, которых нет в копии, не должны ожить при следующем запечатывании месяца
+        if os.path.isdir(DB.partitions_path()):
+            for file_name in os.listdir(DB.partitions_path()):
+                path = os.path.join(DB.partitions_path(), file_name)
+                if file_name.endswith(".db") and path not in {destination for _, destination in restored}:
+                    DB._remove_database_file(path)
+
+        for _, destination in restored:
+            # старый -wal нельзя применять к подменённому файлу
+            for suffix in ("-wal", "-shm"):
+                if os.path.exists(destination + suffix):
+                    os.remove(destination + suffix)
+
+            os.replace(destination + ".restore", destination)
+
+    @staticmethod
+    def _backup_file(source: str, destination: str, pages: int = 1024, sleep: float = 0.01,
+                     progress: Callable[[int, int, int], None] = None):
+        src_conn = sqlite3.connect(source, isolation_level=None)
+        dest_conn = sqlite3.connect(destination)
+
+        try:
+            # открытая читающая транзакция держит снимок WAL: без неё шаговая копия начинается заново
+            # после каждой записи в базу и при постоянной записи не заканчивается
+            src_conn.execute("BEGIN")
+            src_conn.execute("SELECT count(*) FROM sqlite_master").fetchone()
+            src_conn.backup(dest_conn, pages=pages, progress=progress, sleep=sleep)
+            src_conn.execute("COMMIT")
+
+        finally:
+            dest_conn.close()
+            src_conn.close()
 
-        with sqlite3.connect(database_dump_path) as src_conn:
-            with sqlite3.connect(database_path) as dest_conn:
-                src_conn.backup(dest_conn, pages=0, progress=None)
+    @staticmethod
+    def _remove_database_file(path: str):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+
+    @staticmethod
+    def transaction():
+        # несколько вызовов DB внутри одного with выполняются одной транзакцией
+        return ConnectionManager.transaction()
+
+    @staticmethod
+    @Instrumentation.operation("fetch_query")
+    def fetch_query(query: str, values: tuple = ()):
+        cur = ConnectionManager.get().execute(query, values)
+
+        response = cur.fetchall()
+
+        return response
 
     @staticmethod
+    @Instrumentation.operation("fetch_one")
     def fetch_one(table_name: str, **kwargs):
         where_request = DB.create_where_request(**kwargs)
 
-        with sqlite3.connect(database_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            cur.execute(f"""
-                SELECT * FROM {table_name} {where_request}
-                """, tuple(kwargs.values()))
+        cur = ConnectionManager.get().execute(f"""
+            SELECT * FROM {table_name} {where_request}
+            """, DB.create_where_values(**kwargs))
 
-            response = cur.fetchone()
+        response = cur.fetchone()
+        cur.close()
 
         return response
 
     @staticmethod
+    @Instrumentation.operation("fetch_many")
     def fetch_many(table_name: str, **kwargs):
-        # не доделано, в значения должно подставляться list[tuple]
-
+        # list/tuple значения превращаются в IN (...), одна выборка на весь набор ключей
         where_request = DB.create_where_request(**kwargs)
 
-        with sqlite3.connect(database_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            cur.execute(f"""
+        cur = ConnectionManager.get().execute(f"""
             SELECT * FROM {table_name} {where_request}
-            """, tuple(kwargs.values()))
+            """, DB.create_where_values(**kwargs))
 
-            response = cur.fetchall()
+        response = cur.fetchall()
 
         return response
 
     @staticmethod
-    def delete_one(table_name: str, **kwargs):
+    @Instrumentation.operation("fetch_linked")
+    def fetch_linked(table_name: str, link_table_name: str, link_column: str, key_column: str,
+                     keys: List[int]) -> List[tuple]:
+        # строки table_name, связанные через link_table_name с каждым из keys, одним JOIN запросом
+        # возвращает [(key, dict строки)], сгруппированные по key в порядке добавления связей
+        if not keys:
+            return []
+
+        cur = ConnectionManager.get().execute(f"""
+            SELECT link.{key_column} AS link_key, {table_name}.*
+            FROM {link_table_name} AS link
+            JOIN {table_name} ON {table_name}.id = link.{link_column}
+            WHERE link.{key_column} IN ({", ".join("?" for _ in keys)})
+            ORDER BY link.{key_column}, link.id
+            """, tuple(keys))
+
+        response = []
+        for row in cur.fetchall():
+            info = dict(row)
+            response.append((info.pop("link_key"), info))
+
+        return response
+
+    @staticmethod
+    @Instrumentation.operation("fetch_range")
+    def fetch_range(table_name: str, column: str, start=None, end=None, order: str = "asc", limit: int = None,
+                    order_by_id: bool = True, **kwargs):
+        # строки с start <= column < end, границы None не ограничивают; порядок по column, затем по id
+        query, values = DB.create_range_query(table_name, column, start, end, order, limit,
+                                              order_by_id=order_by_id, **kwargs)
+
+        cur = ConnectionManager.get().execute(query, values)
+
+        response = cur.fetchall()
+
+        return response
+
+    @staticmethod
+    @Instrumentation.operation("fetch_page")
+    def fetch_page(table_name: str, columns: List[str], after: tuple = None, limit: int = 500, order: str = "asc",
+                   **kwargs):
+        # keyset-пагинация: строки строго после after по ключу columns, стоимость не зависит от глубины страницы
+        if order not in ("asc", "desc"):
+            raise ValueError(f"Unknown order: {order}")
+
+        conditions = [DB._create_condition(arg, value) for arg, value in kwargs.items()]
+        values = list(DB.create_where_values(**kwargs))
+
+        if after is not None:
+            conditions.append(f"({', '.join(columns)}) {'>' if order == 'asc' else '<'} "
+                              f"({', '.join('?' for _ in columns)})")
+            values.extend(after)
+
+        where_request = "WHERE " + " AND ".join(conditions) if conditions else ""
+        order_request = ", ".join(f"{column} {order}" for column in columns)
+
+        cur = ConnectionManager.get().execute(f"""
+            SELECT * FROM {table_name} {where_request} ORDER BY {order_request} LIMIT ?
+            """, tuple(values) + (limit,))
+
+        response = cur.fetchall()
+
+        return response
+
+    @staticmethod
+    @Instrumentation.operation("iter_rows")
+    def iter_rows(table_name: str, chunk_size: int = 1000, **kwargs):
+        # ленивая выборка кусками по chunk_size, в памяти не больше одного куска
         where_request = DB.create_where_request(**kwargs)
 
-        with sqlite3.connect(database_path) as conn:
-            cur = conn.cursor()
-            cur.execute(f"""
-            DELETE FROM {table_name} {where_request}
-            """, tuple(kwargs.values()))
+        cur = ConnectionManager.get().execute(f"""
+            SELECT * FROM {table_name} {where_request} ORDER BY id
+            """, DB.create_where_values(**kwargs))
+
+        yield from DB._iter_cursor(cur, chunk_size)
+
+    @staticmethod
+    @Instrumentation.operation("iter_range")
+    def iter_range(table_name: str, column: str, start=None, end=None, order: str = "asc", limit: int = None,
+                   chunk_size: int = 1000, **kwargs):
+        query, values = DB.create_range_query(table_name, column, start, end, order, limit, **kwargs)
+
+        cur = ConnectionManager.get().execute(query, values)
+
+        yield from DB._iter_cursor(cur, chunk_size)
+
+    @staticmethod
+    @Instrumentation.operation("iter_column_chunks")
+    def iter_column_chunks(table_name: str, columns: List[str], column: str, start=None, end=None,
+                           chunk_size: int = 10000, **kwargs):
+        # колонки кусками: на каждый кусок кортеж (значения columns[0], значения columns[1], ...)
+        # курсор без row_factory, так что sqlite3.Row на каждую строку не создаются
+        query, values = DB.create_range_query(table_name, column, start, end, select=", ".join(columns),
+                                              **kwargs)
+
+        cur = ConnectionManager.get().cursor()
+        cur.row_factory = None
+        cur.execute(query, values)
+
+        for rows in DB._iter_chunks(cur, chunk_size):
+            yield tuple(zip(*rows))
+
+    @staticmethod
+    def _iter_chunks(cur, chunk_size: int):
+        try:
+            while True:
+                rows = cur.fetchmany(chunk_size)
+                if not rows:
+                    break
+
+                yield rows
+
+        finally:
+            cur.close()
+
+    @staticmethod
+    def _iter_cursor(cur, chunk_size: int):
+        for rows in DB._iter_chunks(cur, chunk_size):
+            yield from rows
 
     @staticmethod
-    def delete_many(table_name: str, **kwargs):
-        # не доделано, в значения должно подставляться list[tuple]
+    def create_range_query(table_name: str, column: str, start=None, end=None, order: str = "asc",
+                           limit: int = None, select: str = "*", order_by_id: bool = True, **kwargs):
+        if order not in ("asc", "desc"):
+            raise ValueError(f"Unknown order: {order}")
+
+        conditions = [DB._create_condition(arg, value) for arg, value in kwargs.items()]
+        values = list(DB.create_where_values(**kwargs))
+
+        if start is not None:
+            conditions.append(f"{column} >= ?")
+            values.append(start)
+
+        if end is not None:
+            conditions.append(f"{column} < ?")
+            values.append(end)
+
+        where_request = "WHERE " + " AND ".join(conditions) if conditions else ""
+        order_request = f"{column} {order}, id {order}" if order_by_id else f"{column} {order}"
+        query = f"SELECT {select} FROM {table_name} {where_request} ORDER BY {order_request}"
 
+        if limit is not None:
+            query += " LIMIT ?"
+            values.append(limit)
+
+        return query, tuple(values)
+
+    @staticmethod
+    @Instrumentation.operation("delete_one", writes=True)
+    def delete_one(table_name: str, **kwargs):
         where_request = DB.create_where_request(**kwargs)
 
-        with sqlite3.connect(database_path) as conn:
-            cur = conn.cursor()
-            cur.executemany(f"""
+        with ConnectionManager.transaction() as conn:
+            conn.execute(f"""
             DELETE FROM {table_name} {where_request}
-            """, tuple(kwargs.values()))
+            """, DB.create_where_values(**kwargs))
 
     @staticmethod
+    @Instrumentation.operation("delete_many", writes=True)
+    def delete_many(table_name: str, rows_info: List[dict]):
+        if not rows_info:
+            return
+
+        # list значения дают IN (...) своей длины, поэтому один запрос на каждый вид WHERE
+        requests = {}
+        for row_info in rows_info:
+            requests.setdefault(DB.create_where_request(**row_info), []).append(DB.create_where_values(**row_info))
+
+        with ConnectionManager.transaction() as conn:
+            for where_request, values in requests.items():
+                conn.executemany(f"""
+                DELETE FROM {table_name} {where_request}
+                """, values)
+
+    @staticmethod
+    @Instrumentation.operation("update_one", writes=True)
     def update_one(table_name: str, row_info: dict, new_values: dict):
         where_request = DB.create_where_request(**row_info)
         set_request = DB.create_set_request(**new_values)
-        with sqlite3.connect(database_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            cur.execute(f"""
+        with ConnectionManager.transaction() as conn:
+            conn.execute(f"""
             UPDATE {table_name} {set_request} {where_request}
-            """, tuple(new_values.values()) + tuple(row_info.values()))
+            """, tuple(new_values.values()) + DB.create_where_values(**row_info))
 
     @staticmethod
-    def update_many(table_name: str, row_info: dict, new_values: dict):
-        # не доделано, в значения должно подставляться list[tuple]
+    @Instrumentation.operation("update_many", writes=True)
+    def update_many(table_name: str, rows_info: List[dict], new_values: List[dict]):
+        # rows_info[i] выбирает строку, new_values[i] - её новые значения; ключи одинаковы во всех элементах
+        if len(rows_info) != len(new_values):
+            raise ValueError("rows_info and new_values must have the same length")
 
-        where_request = DB.create_where_request(**row_info)
-        set_request = DB.create_set_request(**new_values)
-        with sqlite3.connect(database_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            cur.executemany(f"""
-            UPDATE {table_name} {set_request} {where_request}
-            """, tuple(new_values.values()) + tuple(row_info.values()))
+        if not rows_info:
+            return
+
+        set_request = DB.create_set_request(**new_values[0])
+        requests = {}
+        for row_info, values in zip(rows_info, new_values):
+            requests.setdefault(DB.create_where_request(**row_info), []).append(
+                tuple(values.values()) + DB.create_where_values(**row_info))
+
+        with ConnectionManager.transaction() as conn:
+            for where_request, values in requests.items():
+                conn.executemany(f"""
+                UPDATE {table_name} {set_request} {where_request}
+                """, values)
+
+    @staticmethod
+    def query_plan(table_name: str, **kwargs) -> List[str]:
+        # план запроса, который выполнят fetch_one/fetch_many с теми же аргументами
+        cur = ConnectionManager.get().execute(f"""
+            EXPLAIN QUERY PLAN SELECT * FROM {table_name} {DB.create_where_request(**kwargs)}
+            """, DB.create_where_values(**kwargs))
+
+        return [row["detail"] for row in cur.fetchall()]
 
     @staticmethod
     def find_pattern(text, patterns):
@@ -122,13 +442,11 @@ class DB:
         return None
 
     @staticmethod
+    @Instrumentation.operation("insert_one", writes=True)
     def insert_one(table_name: str, **kwargs):
         insert_request = DB.create_insert_request(**kwargs)
-        new_id = None
-        with sqlite3.connect(database_path) as conn:
-            conn.row_factory = sqlite3.Row
-            cur = conn.cursor()
-            cur.execute(f"""
+        with ConnectionManager.transaction() as conn:
+            cur = conn.execute(f"""
             INSERT INTO {table_name} {insert_request}
             """, tuple(kwargs.values()))
 
@@ -136,9 +454,46 @@ class DB:
 
         return new_id
 
+    @staticmethod
+    @Instrumentation.operation("insert_many", writes=True)
+    def insert_many(table_name: str, rows: List[dict]) -> List[int]:
+        if not rows:
+            return []
+
+        insert_request = DB.create_insert_request(**rows[0])
+        with ConnectionManager.transaction() as conn:
+            conn.executemany(f"""
+            INSERT INTO {table_name} {insert_request}
+            """, [tuple(row.values()) for row in rows])
+
+            # пока транзакция держит блокировку записи, AUTOINCREMENT выдаёт id подряд
+            last_id = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+
+        return list(range(last_id - len(rows) + 1, last_id + 1))
+
     @staticmethod
     def create_where_request(**kwargs):
-        return "WHERE " + " AND ".join(f"{arg} = ?" for arg in kwargs.keys()) if kwargs else ""
+        return "WHERE " + " AND ".join(DB._create_condition(arg, value) for arg, value in kwargs.items()) \
+            if kwargs else ""
+
+    @staticmethod
+    def _create_condition(arg, value):
+        if isinstance(value, (list, tuple, set)):
+            return f"{arg} IN ({', '.join('?' for _ in value)})"
+
+        return f"{arg} = ?"
+
+    @staticmethod
+    def create_where_values(**kwargs) -> tuple:
+        values = []
+        for value in kwargs.values():
+            if isinstance(value, (list, tuple, set)):
+                values.extend(value)
+
+            else:
+                values.append(value)
+
+        return tuple(values)
 
     @staticmethod
     def create_set_request(**kwargs):
@@ -161,19 +516,19 @@ class DB:
             DB._create_devices_table()
             DB._create_users_table()
             DB._create_users_devices_table()
+            Migrator.migrate()
 
-        except Exception:
-            print("Database initialization failed")
-            return
+        except Exception as error:
+            # с непримененной миграцией схема не совпадает с кодом, работать дальше нельзя
+            print(f"Database initialization failed: {error}")
+            raise
 
         print("Database initialized.")
 
     @staticmethod
     def _create_sensor_readings_table():
-        with sqlite3.connect(database_path) as conn:
-            cur = conn.cursor()
-
-            cur.execute("""
+        with ConnectionManager.transaction() as conn:
+            conn.execute("""
                         CREATE TABLE IF NOT EXISTS sensor_readings
                         (
                             id          INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -188,10 +543,8 @@ class DB:
 
     @staticmethod
     def _create_users_table():
-        with sqlite3.connect(database_path) as conn:
-            cur = conn.cursor()
-
-            cur.execute("""
+        with ConnectionManager.transaction() as conn:
+            conn.execute("""
                         CREATE TABLE IF NOT EXISTS users
                         (
                             id          INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -202,10 +555,8 @@ class DB:
 
     @staticmethod
     def _create_users_devices_table():
-        with sqlite3.connect(database_path) as conn:
-            cur = conn.cursor()
-
-            cur.execute("""
+        with ConnectionManager.transaction() as conn:
+            conn.execute("""
                         CREATE TABLE IF NOT EXISTS users_devices
                         (
                             id          INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -215,10 +566,8 @@ class DB:
 
     @staticmethod
     def _create_devices_table():
-        with sqlite3.connect(database_path) as conn:
-            cur = conn.cursor()
-
-            cur.execute("""
+        with ConnectionManager.transaction() as conn:
+            conn.execute("""
                         CREATE TABLE IF NOT EXISTS devices
                         (
                             id          INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -1,12 +1,19 @@
 from __future__ import annotations
 
-from typing import List
+import time
+import sqlite3
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Iterator, Tuple
 from dataclasses import dataclass
 
-from setools import Devicetreecon
-
 from modules.database.database.database import DB
-from modules.database.sensor_reading.sensor_reading import SensorReading
+from modules.database.connection.connection import ConnectionManager
+from modules.database.identity_map.identity_map import IdentityMap
+from modules.database.notification_rule.notification_rule import NotificationRule
+from modules.database.sensor_reading.sensor_reading import SensorReading, DbSensorReading
+from modules.database.latest_reading.latest_reading import LatestReading
+from modules.database.pagination.pagination import Page, PageCursor
 
 
 class DeviceNotFoundError(Exception):
@@ -36,26 +43,45 @@ class DeviceDeleter:
     def delete(device: DbDevice):
         DB.delete_one(DB.devices_table_name, id=device.id)
         DB.delete_one(DB.users_devices_table_name, device_id=device.id)
+        LatestReading.delete_device(device.id)
+        NotificationRule.changed()
+        DeviceFetcher.identity_map.invalidate(device.id)
+        DeviceCache.invalidate([device.serial_number])
 
 
 class GroupUpdater:
     @staticmethod
     def update_serial_number(device: DbDevice, serial_number: str):
         DB.update_one(DB.devices_table_name, device.__dict__, {"serial_number": serial_number})
+        DeviceFetcher.identity_map.invalidate(device.id)
+        DeviceCache.invalidate([device.serial_number, serial_number])
 
 
 class DeviceFetcher:
+    identity_map = IdentityMap("devices", ["serial_number"])
+
     @staticmethod
     def fetch_all() -> List[DbDevice]:
         return DeviceFetcher.constructor(DB.fetch_many(DB.devices_table_name))
 
     @staticmethod
     def fetch_by_id(id: int) -> DbDevice:
-        return DeviceFetcher.constructor(DB.fetch_one(DB.devices_table_name, id=id))
+        return DeviceFetcher.identity_map.fetch(
+            "id", id, lambda: DeviceFetcher.constructor(DB.fetch_one(DB.devices_table_name, id=id)))
+
+    @staticmethod
+    def fetch_by_ids(ids: List[int]) -> List[DbDevice]:
+        return DeviceFetcher.constructor(DB.fetch_many(DB.devices_table_name, id=list(ids))) or []
 
     @staticmethod
     def fetch_by_serial_number(serial_number: str) -> DbDevice:
-        return DeviceFetcher.constructor(DB.fetch_one(DB.devices_table_name, serial_number=serial_number))
+        return DeviceFetcher.identity_map.fetch(
+            "serial_number", serial_number,
+            lambda: DeviceFetcher.constructor(DB.fetch_one(DB.devices_table_name, serial_number=serial_number)))
+
+    @staticmethod
+    def fetch_page(after: tuple = None, limit: int = 500) -> List[DbDevice]:
+        return DeviceFetcher.constructor(DB.fetch_page(DB.devices_table_name, ["id"], after, limit)) or []
 
     @staticmethod
     def constructor(info) -> DbDevice | List[DbDevice] | None:
@@ -75,17 +101,145 @@ class DeviceFetcher:
 
     @staticmethod
     def fetch_user_devices(user_id: int) -> List[DbDevice]:
-        devices_id = [info["device_id"] for info in DB.fetch_many(DB.users_devices_table_name, user_id=user_id)]
-        if devices_id:
-            return [DeviceFetcher.fetch_by_id(device_id) for device_id in devices_id]
+        return DeviceFetcher.fetch_users_devices([user_id]).get(user_id, [])
 
-        return []
+    @staticmethod
+    def fetch_users_devices(users_id: List[int]) -> Dict[int, List[DbDevice]]:
+        users_devices = {user_id: [] for user_id in users_id}
+        for user_id, device_info in DB.fetch_linked(DB.devices_table_name, DB.users_devices_table_name,
+                                                    "device_id", "user_id", list(users_devices)):
+            users_devices[user_id].append(DeviceFetcher.constructor(device_info))
+
+        return users_devices
+
+    @staticmethod
+    def fetch_user_devices_with_latest(user_id: int) -> List[Tuple[DbDevice, DbSensorReading | None]]:
+        # devices of the user with their latest readings in one query over the primary keys
+        latest_columns = ", ".join(f"latest.{column} AS latest_{column}" for column in LatestReading.columns)
+        rows = DB.fetch_query(f"""
+            SELECT {DB.devices_table_name}.id, {DB.devices_table_name}.serial_number, {latest_columns}
+            FROM {DB.users_devices_table_name} AS link
+            JOIN {DB.devices_table_name} ON {DB.devices_table_name}.id = link.device_id
+            LEFT JOIN {LatestReading.table_name} AS latest ON latest.device_id = link.device_id
+            WHERE link.user_id = ?
+            ORDER BY link.id
+            """, (user_id,))
+
+        return [(DbDevice(id=row["id"], serial_number=row["serial_number"]),
+                 DbSensorReading(**{column: row[f"latest_{column}"] for column in LatestReading.columns})
+                 if row["latest_id"] is not None else None)
+                for row in rows]
 
 
 class DeviceInserter:
     @staticmethod
     def insert(serial_number: str):
-        return DB.insert_one(DB.devices_table_name, serial_number=serial_number)
+        try:
+            device_id = DB.insert_one(DB.devices_table_name, serial_number=serial_number)
+
+        except sqlite3.IntegrityError:
+            raise DeviceAlreadyExistsError
+
+        DeviceFetcher.identity_map.store(DbDevice(id=device_id, serial_number=serial_number))
+        DeviceCache.invalidate([serial_number])
+
+        return device_id
+
+    @staticmethod
+    def insert_many(serial_numbers: List[str]) -> List[int]:
+        try:
+            devices_id = DB.insert_many(DB.devices_table_name,
+                                        [dict(serial_number=serial_number) for serial_number in serial_numbers])
+
+        except sqlite3.IntegrityError:
+            raise DeviceAlreadyExistsError
+
+        for device_id, serial_number in zip(devices_id, serial_numbers):
+            DeviceFetcher.identity_map.store(DbDevice(id=device_id, serial_number=serial_number))
+
+        DeviceCache.invalidate(serial_numbers)
+
+        return devices_id
+
+
+class DeviceCache:
+    # serial number -> device id of the ingest path, LRU bounded; unknown serial numbers are cached for
+    # negative_ttl seconds so a misconfigured device does not cost a query per message.
+    # Changes of this process invalidate their entries after the commit, changes made by other processes
+    # are seen once the entry is older than ttl
+    max_size = 10000
+    ttl = 300.0
+    negative_ttl = 5.0
+
+    hits = 0
+    misses = 0
+    evictions = 0
+
+    _entries: OrderedDict = OrderedDict()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def cached(serial_number: str) -> Tuple[bool, int | None]:
+        # (True, device id or None for an unknown device) on a hit, never touches the database
+        now = time.monotonic()
+
+        with DeviceCache._lock:
+            entry = DeviceCache._entries.get(serial_number)
+            if entry is not None and entry[1] > now:
+                DeviceCache._entries.move_to_end(serial_number)
+                DeviceCache.hits += 1
+
+                return True, entry[0]
+
+            DeviceCache.misses += 1
+
+        return False, None
+
+    @staticmethod
+    def device_id(serial_number: str) -> int | None:
+        hit, device_id = DeviceCache.cached(serial_number)
+
+        return device_id if hit else DeviceCache.load(serial_number)
+
+    @staticmethod
+    def load(serial_number: str) -> int | None:
+        device = DeviceFetcher.fetch_by_serial_number(serial_number)
+        device_id = device.id if device else None
+        expires = time.monotonic() + (DeviceCache.ttl if device else DeviceCache.negative_ttl)
+
+        with DeviceCache._lock:
+            DeviceCache._entries[serial_number] = (device_id, expires)
+            DeviceCache._entries.move_to_end(serial_number)
+
+            while len(DeviceCache._entries) > DeviceCache.max_size:
+                DeviceCache._entries.popitem(last=False)
+                DeviceCache.evictions += 1
+
+        return device_id
+
+    @staticmethod
+    def invalidate(serial_numbers: List[str]):
+        # after the commit, a lookup in between still sees the committed device and would cache it again
+        def drop():
+            with DeviceCache._lock:
+                for serial_number in serial_numbers:
+                    DeviceCache._entries.pop(serial_number, None)
+
+        ConnectionManager.on_commit(drop)
+
+    @staticmethod
+    def clear():
+        with DeviceCache._lock:
+            DeviceCache._entries.clear()
+            DeviceCache.hits = DeviceCache.misses = DeviceCache.evictions = 0
+
+    @staticmethod
+    def metrics() -> dict:
+        with DeviceCache._lock:
+            lookups = DeviceCache.hits + DeviceCache.misses
+
+            return dict(size=len(DeviceCache._entries), hits=DeviceCache.hits, misses=DeviceCache.misses,
+                        evictions=DeviceCache.evictions, hit_ratio=DeviceCache.hits / lookups if lookups else 0.0)
 
 
 class Device:
@@ -118,6 +272,15 @@ class Device:
 
         return []
 
+    @staticmethod
+    def page(after: str | tuple = None, limit: int = 500) -> Page[Device]:
+        devices = DeviceFetcher.fetch_page(PageCursor.decode(after, 1), limit + 1)
+
+        items = [Device(db_device=device_info) for device_info in devices[:limit]]
+        next_cursor = PageCursor.encode((items[-1].id,)) if len(devices) > limit else None
+
+        return Page(items, next_cursor)
+
     @staticmethod
     def user_devices(user_id: int) -> List[Device]:
         devices = DeviceFetcher.fetch_user_devices(user_id)
@@ -127,6 +290,18 @@ class Device:
 
         return []
 
+    @staticmethod
+    def user_devices_with_latest(user_id: int) -> List[Tuple[Device, SensorReading | None]]:
+        return [(Device(db_device=device_info),
+                 SensorReading(db_sensor_reading=sensor_reading_info) if sensor_reading_info else None)
+                for device_info, sensor_reading_info in DeviceFetcher.fetch_user_devices_with_latest(user_id)]
+
+    @staticmethod
+    def for_users(users_id: List[int]) -> Dict[int, List[Device]]:
+        # one query for any number of users
+        return {user_id: [Device(db_device=device_info) for device_info in devices]
+                for user_id, devices in DeviceFetcher.fetch_users_devices(users_id).items()}
+
     @property
     def id(self) -> int:
         return self._device.id
@@ -142,14 +317,28 @@ class Device:
 
     @staticmethod
     def insert(serial_number: str):
-        devices_id = DeviceInserter.insert(serial_number)
+        device_id = DeviceInserter.insert(serial_number)
+
+        return Device(db_device=DbDevice(id=device_id, serial_number=serial_number))
+
+    @staticmethod
+    def insert_many(serial_numbers: List[str]) -> List[Device]:
+        devices_id = DeviceInserter.insert_many(serial_numbers)
 
-        return Device(id=devices_id)
+        return [Device(db_device=DbDevice(id=device_id, serial_number=serial_number))
+                for device_id, serial_number in zip(devices_id, serial_numbers)]
+
+    @property
+    def latest_reading(self) -> SensorReading | None:
+        return SensorReading.latest_by_devices([self.id]).get(self.id)
 
     @property
     def sensor_readings(self) -> List[SensorReading]:
         return SensorReading.by_device(self.id)
 
+    def iter_sensor_readings(self, start=None, end=None) -> Iterator[SensorReading]:
+        return SensorReading.iter_by_device(self.id, start, end)
+
     def delete(self):
         DeviceDeleter.delete(self._device)
 
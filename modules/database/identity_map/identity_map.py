@@ -0,0 +1,154 @@
+from __future__ import annotations
+
+import time
+import threading
+import dataclasses
+from collections import OrderedDict
+from typing import List, Callable, Any
+
+from modules.config.config import identity_map_enabled, identity_map_size, identity_map_ttl
+from modules.database.connection.connection import ConnectionManager
+
+
+class IdentityMap:
+    # read-through cache of Db* records by id and by unique keys, LRU bounded, entries live ttl seconds.
+    # Callers get copies, so a changed record never leaks into the cache before its commit; reads inside
+    # a transaction bypass the cache, writes drop their records after the commit. Other processes are not told
+    # about writes, see config.identity_map_enabled for the staleness window
+    _maps: List[IdentityMap] = []
+
+    def __init__(self, name: str, keys: List[str], max_size: int = identity_map_size, ttl: float = identity_map_ttl,
+                 enabled: bool = identity_map_enabled):
+        self.name = name
+        self.keys = keys
+        self.max_size = max_size
+        self.ttl = ttl
+        self.enabled = enabled
+
+        self.hits = 0
+        self.misses = 0
+
+        # id -> (record, expires), (key, value) -> id
+        self._records = OrderedDict()
+        self._index = {}
+        # bumped by every invalidation, a load that raced with a write is not stored
+        self._generation = 0
+        self._lock = threading.Lock()
+
+        IdentityMap._maps.append(self)
+
+    @staticmethod
+    def configure(enabled: bool = None, max_size: int = None, ttl: float = None):
+        # switches every map of the process
+        for identity_map in IdentityMap._maps:
+            if enabled is not None:
+                identity_map.enabled = enabled
+
+            if max_size is not None:
+                identity_map.max_size = max_size
+
+            if ttl is not None:
+                identity_map.ttl = ttl
+
+            identity_map.clear()
+
+    @staticmethod
+    def clear_all():
+        for identity_map in IdentityMap._maps:
+            identity_map.clear()
+
+    def fetch(self, key: str, value, load: Callable[[], Any]):
+        # cached copy of the record with record.key == value, load() on a miss
+        if not self.enabled or ConnectionManager.in_transaction():
+            return load()
+
+        with self._lock:
+            record = self._get(key, value)
+            if record is not None:
+                self.hits += 1
+
+                return dataclasses.replace(record)
+
+            self.misses += 1
+            generation = self._generation
+
+        record = load()
+        if record is not None:
+            with self._lock:
+                if generation == self._generation:
+                    self._put(dataclasses.replace(record))
+
+        return record
+
+    def store(self, record):
+        # write-through of a record the caller just wrote, cached after the commit
+        if not self.enabled:
+            return
+
+        record = dataclasses.replace(record)
+
+        def put():
+            with self._lock:
+                self._generation += 1
+                self._drop(record.id)
+                self._put(record)
+
+        ConnectionManager.on_commit(put)
+
+    def invalidate(self, id: int):
+        # the record and all its keys are dropped after the commit
+        def drop():
+            with self._lock:
+                self._generation += 1
+                self._drop(id)
+
+        ConnectionManager.on_commit(drop)
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._records.clear()
+            self._index.clear()
+
+    def metrics(self) -> dict:
+        with self._lock:
+            return dict(name=self.name, enabled=self.enabled, size=len(self._records), hits=self.hits,
+                        misses=self.misses)
+
+    def _get(self, key: str, value):
+        id = value if key == "id" else self._index.get((key, value))
+        entry = self._records.get(id)
+        if entry is None:
+            return None
+
+        record, expires = entry
+        if expires <= time.monotonic():
+            self._drop(id)
+            return None
+
+        self._records.move_to_end(id)
+
+        return record
+
+    def _put(self, record):
+        self._drop(record.id)
+        self._records[record.id] = (record, time.monotonic() + self.ttl)
+        for key in self.keys:
+            self._index[(key, getattr(record, key))] = record.id
+
+        while len(self._records) > self.max_size:
+            self._drop(next(iter(self._records)))
+
+    def _drop(self, id: int):
+        entry = self._records.pop(id, None)
+        if entry is None:
+            return
+
+        for key in self.keys:
+            index_key = (key, getattr(entry[0], key))
+            if self._index.get(index_key) == id:
+                del self._index[index_key]
+
+
+if __name__ == "__main__":
+    pass
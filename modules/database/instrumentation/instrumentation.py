@@ -0,0 +1,366 @@
+from __future__ import annotations
+
+import re
+import json
+import time
+import inspect
+import sqlite3
+import functools
+import threading
+from collections import deque
+from dataclasses import dataclass, asdict, field
+from typing import List, Dict, Tuple, Callable
+
+from modules.config.config import db_instrumentation_enabled, slow_query_ms, slow_query_log_size, \
+    slow_query_log_file
+from modules.config.paths import slow_query_log_path
+from modules.database.connection.connection import ConnectionManager
+from modules.metrics.metrics import HdrHistogram
+
+
+@dataclass
+class QueryEvent:
+    table: str
+    operation: str
+    where_keys: Tuple[str, ...]
+    # rows changed by writes, rows returned by reads (chunks for iter_column_chunks)
+    rows: int
+    # seconds
+    acquire: float
+    duration: float
+    error: bool = False
+    # first statement with its values, only for calls slower than the threshold
+    query: str | None = None
+    plan: List[str] = field(default_factory=list)
+
+
+class OperationStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        # microseconds
+        self.duration = HdrHistogram()
+        self.acquire = HdrHistogram()
+        self.slow = 0
+
+    def snapshot(self) -> dict:
+        return dict(count=self.count, errors=self.errors, rows=self.rows, slow=self.slow,
+                    duration_us=self.duration.snapshot(), acquire_us=self.acquire.snapshot())
+
+
+class Instrumentation:
+    # timing of every DB call per (table, operation): DB methods are wrapped by operation(), which costs one flag
+    # check while disabled. Enabled, the wrapper times ConnectionManager.get() and the call, counts rows and
+    # captures the first statement through the sqlite trace callback; calls slower than slow_threshold go to the
+    # slow-query log with their EXPLAIN QUERY PLAN. Hooks get every QueryEvent. A trace callback of the application
+    # keeps getting the statements, and failing hooks or slow-log writes are printed, never raised into the call
+    enabled = db_instrumentation_enabled
+    # seconds
+    slow_threshold = slow_query_ms / 1000
+    slow_log_path = slow_query_log_path if slow_query_log_file else None
+
+    _stats: Dict[Tuple[str, str], OperationStats] = {}
+    _slow = deque(maxlen=slow_query_log_size)
+    _hooks: List[Callable[[QueryEvent], None]] = []
+    _lock = threading.Lock()
+    _local = threading.local()
+
+    @staticmethod
+    def configure(enabled: bool = None, slow_query_ms: float = None, slow_log_size: int = None,
+                  slow_log_path: str | bool = None):
+        # slow_log_path False turns writing the slow-query log to a file off
+        if slow_query_ms is not None:
+            Instrumentation.slow_threshold = slow_query_ms / 1000
+
+        if slow_log_size is not None:
+            with Instrumentation._lock:
+                Instrumentation._slow = deque(Instrumentation._slow, maxlen=slow_log_size)
+
+        if slow_log_path is not None:
+            Instrumentation.slow_log_path = slow_log_path or None
+
+        if enabled is not None:
+            Instrumentation.enabled = enabled
+
+    @staticmethod
+    def add_hook(hook: Callable[[QueryEvent], None]):
+        with Instrumentation._lock:
+            Instrumentation._hooks = Instrumentation._hooks + [hook]
+
+    @staticmethod
+    def remove_hook(hook: Callable[[QueryEvent], None]):
+        with Instrumentation._lock:
+            Instrumentation._hooks = [added for added in Instrumentation._hooks if added is not hook]
+
+    @staticmethod
+    def reset():
+        with Instrumentation._lock:
+            Instrumentation._stats = {}
+            Instrumentation._slow.clear()
+
+    @staticmethod
+    def operation(name: str, writes: bool = False):
+        # decorator of the DB methods; writes - rows are the changes of the connection, otherwise the result size
+        def decorate(function):
+            signature = inspect.signature(function)
+            iterates = inspect.isgeneratorfunction(function)
+
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                # calls made by an instrumented call are part of it
+                if not Instrumentation.enabled or getattr(Instrumentation._local, "active", False):
+                    return function(*args, **kwargs)
+
+                arguments = signature.bind(*args, **kwargs).arguments
+                if iterates:
+                    return Instrumentation._measure_iterator(name, arguments, function(*args, **kwargs))
+
+                return Instrumentation._measure(name, writes, arguments, function, args, kwargs)
+
+            return wrapper
+
+        return decorate
+
+    @staticmethod
+    def _measure(name: str, writes: bool, arguments: dict, function, args, kwargs):
+        start = time.perf_counter()
+        conn = ConnectionManager.get()
+        acquired = time.perf_counter()
+
+        statements = Instrumentation._trace(conn)
+        changes = conn.total_changes
+        error = False
+        result = None
+
+        try:
+            result = function(*args, **kwargs)
+
+            return result
+
+        except BaseException:
+            error = True
+            raise
+
+        finally:
+            duration = time.perf_counter() - acquired
+            Instrumentation._untrace(conn)
+
+            if writes:
+                rows = conn.total_changes - changes
+
+            elif isinstance(result, list):
+                rows = len(result)
+
+            else:
+                rows = int(result is not None)
+
+            Instrumentation._record(conn, name, arguments, rows, acquired - start, duration, error, statements)
+
+    @staticmethod
+    def _measure_iterator(name: str, arguments: dict, iterator):
+        # the time spent producing the rows, not the time the caller spends between them
+        rows = 0
+        acquire = None
+        duration = 0.0
+        error = False
+        statements = []
+        conn = None
+
+        try:
+            while True:
+                start = time.perf_counter()
+                conn = ConnectionManager.get()
+                acquired = time.perf_counter()
+                if acquire is None:
+                    acquire = acquired - start
+
+                Instrumentation._trace(conn, statements)
+                try:
+                    item = next(iterator)
+
+                except StopIteration:
+                    break
+
+                except BaseException:
+                    error = True
+                    raise
+
+                finally:
+                    duration += time.perf_counter() - acquired
+                    Instrumentation._untrace(conn)
+
+                rows += 1
+                yield item
+
+        finally:
+            iterator.close()
+            if conn is not None:
+                Instrumentation._record(conn, name, arguments, rows, acquire, duration, error, statements)
+
+    @staticmethod
+    def _trace(conn: sqlite3.Connection, statements: List[str] = None) -> List[str]:
+        # the first statement of the call with its values inlined, transaction control is left out; the callback
+        # the application set on the connection (TracedConnection) is chained
+        statements = [] if statements is None else statements
+        previous = getattr(conn, "trace_callback", None)
+        Instrumentation._local.active = True
+
+        def trace(statement: str):
+            if previous is not None:
+                previous(statement)
+
+            if not statements and not statement.startswith(("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE")):
+                statements.append(statement)
+
+        # past TracedConnection.set_trace_callback, the callback of the application stays recorded
+        sqlite3.Connection.set_trace_callback(conn, trace)
+
+        return statements
+
+    @staticmethod
+    def _untrace(conn: sqlite3.Connection):
+        Instrumentation._local.active = False
+        try:
+            sqlite3.Connection.set_trace_callback(conn, getattr(conn, "trace_callback", None))
+
+        except sqlite3.ProgrammingError:
+            # the call closed the connection
+            pass
+
+    @staticmethod
+    def _record(conn: sqlite3.Connection, name: str, arguments: dict, rows: int, acquire: float, duration: float,
+                error: bool, statements: List[str]):
+        query = statements[0].strip() if statements else None
+        event = QueryEvent(Instrumentation._table(arguments, query), name, Instrumentation._where_keys(arguments),
+                           rows, acquire, duration, error)
+        slow = duration >= Instrumentation.slow_threshold
+
+        if slow:
+            event.query = query
+            event.plan = Instrumentation._plan(conn, query)
+
+        with Instrumentation._lock:
+            stats = Instrumentation._stats.get((event.table, name))
+            if stats is None:
+                stats = Instrumentation._stats[(event.table, name)] = OperationStats()
+
+            stats.count += 1
+            stats.errors += error
+            stats.rows += max(0, rows)
+            stats.slow += slow
+            stats.duration.record(duration * 1e6)
+            stats.acquire.record(acquire * 1e6)
+
+            if slow:
+                Instrumentation._slow.append(dict(asdict(event), at=time.time()))
+
+        if slow and Instrumentation.slow_log_path:
+            try:
+                with open(Instrumentation.slow_log_path, "a") as file:
+                    file.write(json.dumps(dict(asdict(event), at=time.time()), default=str) + "\n")
+
+            except Exception as error:
+                print(f"Slow query log failed: {error!r}")
+
+        for hook in Instrumentation._hooks:
+            try:
+                hook(event)
+
+            except Exception as error:
+                print(f"Instrumentation hook {getattr(hook, '__qualname__', hook)} failed: {error!r}")
+
+    @staticmethod
+    def _table(arguments: dict, query: str | None) -> str:
+        if "table_name" in arguments:
+            return arguments["table_name"]
+
+        # fetch_query: the first table of the statement
+        match = re.search(r"\b(?:FROM|INTO|UPDATE)\s+(\w+)", query or arguments.get("query", ""), re.IGNORECASE)
+
+        return match.group(1) if match else "unknown"
+
+    @staticmethod
+    def _where_keys(arguments: dict) -> Tuple[str, ...]:
+        keys = []
+        for name in ("column", "key_column"):
+            if name in arguments:
+                keys.append(arguments[name])
+
+        if arguments.get("row_info"):
+            keys += list(arguments["row_info"])
+
+        if arguments.get("rows_info"):
+            keys += list(arguments["rows_info"][0])
+
+        keys += list(arguments.get("kwargs", {}))
+
+        return tuple(keys)
+
+    @staticmethod
+    def _plan(conn: sqlite3.Connection, query: str | None) -> List[str]:
+        if not query:
+            return []
+
+        try:
+            return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {query}").fetchall()]
+
+        except sqlite3.Error as error:
+            return [f"no plan: {error}"]
+
+    @staticmethod
+    def stats() -> dict:
+        # {"table.operation": statistics}, durations in microseconds
+        with Instrumentation._lock:
+            stats = dict(Instrumentation._stats)
+
+        return {f"{table}.{operation}": stats[(table, operation)].snapshot() for table, operation in sorted(stats)}
+
+    @staticmethod
+    def slow_queries() -> List[dict]:
+        with Instrumentation._lock:
+            return list(Instrumentation._slow)
+
+    @staticmethod
+    def to_json(indent: int = None) -> str:
+        return json.dumps(dict(enabled=Instrumentation.enabled, slow_query_ms=Instrumentation.slow_threshold * 1000,
+                               operations=Instrumentation.stats(), slow_queries=Instrumentation.slow_queries()),
+                          indent=indent, default=str)
+
+    @staticmethod
+    def to_prometheus(prefix: str = "zelenka_db") -> str:
+        # text exposition format; latencies as summaries in seconds
+        with Instrumentation._lock:
+            stats = dict(Instrumentation._stats)
+
+        lines = []
+        counters = [("operations_total", "DB calls", lambda s: s.count),
+                    ("errors_total", "DB calls that raised", lambda s: s.errors),
+                    ("rows_total", "rows changed or returned by DB calls", lambda s: s.rows),
+                    ("slow_total", "DB calls slower than the slow query threshold", lambda s: s.slow)]
+
+        for name, help_text, value in counters:
+            lines += [f"# HELP {prefix}_{name} {help_text}", f"# TYPE {prefix}_{name} counter"]
+            for (table, operation), operation_stats in sorted(stats.items()):
+                lines.append(f'{prefix}_{name}{{table="{table}",operation="{operation}"}} {value(operation_stats)}')
+
+        summaries = [("duration_seconds", "execution time of DB calls", lambda s: s.duration),
+                     ("acquire_seconds", "time to get the connection of DB calls", lambda s: s.acquire)]
+
+        for name, help_text, histogram in summaries:
+            lines += [f"# HELP {prefix}_{name} {help_text}", f"# TYPE {prefix}_{name} summary"]
+            for (table, operation), operation_stats in sorted(stats.items()):
+                labels = f'table="{table}",operation="{operation}"'
+                values = histogram(operation_stats)
+                for quantile in (0.5, 0.95, 0.99):
+                    lines.append(f'{prefix}_{name}{{{labels},quantile="{quantile}"}} '
+                                 f'{values.quantile(quantile) / 1e6:.9f}')
+
+                lines += [f"{prefix}_{name}_sum{{{labels}}} {values.sum / 1e6:.9f}",
+                          f"{prefix}_{name}_count{{{labels}}} {values.count}"]
+
+        return "\n".join(lines) + "\n"
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,92 @@
+from __future__ import annotations
+
+from typing import List, Dict, Iterable
+
+from modules.database.database.database import DB
+from modules.database.connection.connection import ConnectionManager
+from modules.database.partition.partition import Partition
+
+
+class LatestReading:
+    # newest reading of every device, one row per device, so current values never scan the history
+    table_name = "device_latest_readings"
+    columns = ["device_id", "id", "datetime", "temperature", "humidity", "pressure", "hydration", "waterlevel", "ts"]
+
+    @staticmethod
+    def apply(rows: Iterable):
+        # rows are inserted readings with their id, callers run it in the transaction of the insert;
+        # an older reading never replaces a newer one
+        newest = {}
+        for row in rows:
+            if row["ts"] is None:
+                continue
+
+            current = newest.get(row["device_id"])
+            if current is None or (row["ts"], row["id"]) > (current["ts"], current["id"]):
+                newest[row["device_id"]] = row
+
+        if not newest:
+            return
+
+        with DB.transaction() as conn:
+            conn.executemany(LatestReading._upsert_request(),
+                             [tuple(row[column] for column in LatestReading.columns) for row in newest.values()])
+
+    @staticmethod
+    def refresh(sensor_reading_id: int, devices_id: Iterable[int]):
+        # after a reading was deleted or changed: it stops being the latest one and the newest reading of each
+        # device is looked up again; runs after the commit, partitions can not be attached inside a transaction
+        devices_id = list(dict.fromkeys(devices_id))
+
+        def refresh():
+            rows = []
+            for device_id in devices_id:
+                rows += Partition.fetch_range(None, None, "desc", 1, device_id=device_id)
+
+            with DB.transaction() as conn:
+                conn.execute(f"DELETE FROM {LatestReading.table_name} WHERE id = ?", (sensor_reading_id,))
+                LatestReading.apply(rows)
+
+        ConnectionManager.on_commit(refresh)
+
+    @staticmethod
+    def delete_device(device_id: int):
+        DB.delete_one(LatestReading.table_name, device_id=device_id)
+
+    @staticmethod
+    def fetch(devices_id: List[int]) -> Dict[int, dict]:
+        # device id -> latest row, devices without readings are missing
+        if not devices_id:
+            return {}
+
+        return {row["device_id"]: dict(row) for row in DB.fetch_many(LatestReading.table_name, device_id=devices_id)}
+
+    @staticmethod
+    def rebuild() -> int:
+        # recomputes the table from the whole history, e.g. after an upgrade of a partitioned database
+        devices_id = [row["id"] for row in DB.fetch_query(f"SELECT id FROM {DB.devices_table_name}")]
+
+        rows = []
+        for device_id in devices_id:
+            rows += Partition.fetch_range(None, None, "desc", 1, device_id=device_id)
+
+        with DB.transaction() as conn:
+            conn.execute(f"DELETE FROM {LatestReading.table_name}")
+            LatestReading.apply(rows)
+
+        return len(rows)
+
+    @staticmethod
+    def _upsert_request() -> str:
+        updates = ", ".join(f"{column} = excluded.{column}" for column in LatestReading.columns[1:])
+
+        return f"""
+            INSERT INTO {LatestReading.table_name} ({", ".join(LatestReading.columns)})
+            VALUES ({", ".join("?" for _ in LatestReading.columns)})
+            ON CONFLICT (device_id) DO UPDATE SET {updates}
+            WHERE (excluded.ts, excluded.id) > ({LatestReading.table_name}.ts, {LatestReading.table_name}.id)
+            """
+
+
+if __name__ == "__main__":
+    pass
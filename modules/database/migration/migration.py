@@ -0,0 +1,288 @@
+from __future__ import annotations
+
+import sqlite3
+import datetime as dt
+from typing import List, Callable
+from dataclasses import dataclass, field
+
+from modules.database.connection.connection import ConnectionManager
+from modules.database.timestamp.timestamp import Timestamp, InvalidTimestampError
+
+
+class MigrationFailedError(Exception):
+    def __init__(self, version: int, name: str, error: Exception):
+        self.version = version
+        self.name = name
+        self.error = error
+
+    def __str__(self) -> str:
+        return f"Migration {self.version} ({self.name}) failed: {self.error}"
+
+
+@dataclass
+class Migration:
+    version: int
+    name: str
+    statements: List[str] = field(default_factory=list)
+    function: Callable[[sqlite3.Connection], None] | None = None
+
+
+class Backfill:
+    chunk_size = 10000
+
+    @staticmethod
+    def sensor_readings_ts(conn: sqlite3.Connection):
+        last_id = 0
+        while True:
+            rows = conn.execute("""
+                SELECT id, datetime FROM sensor_readings WHERE id > ? AND ts IS NULL ORDER BY id LIMIT ?
+                """, (last_id, Backfill.chunk_size)).fetchall()
+
+            if not rows:
+                break
+
+            values = []
+            for row in rows:
+                try:
+                    values.append((Timestamp.from_datetime_string(row["datetime"]), row["id"]))
+
+                except InvalidTimestampError:
+                    # unparseable datetime stays NULL and falls out of range queries
+                    pass
+
+            conn.executemany("UPDATE sensor_readings SET ts = ? WHERE id = ?", values)
+            last_id = rows[-1]["id"]
+
+
+class Migrator:
+    schema_version_table_name = "schema_version"
+
+    # ordered, a step is applied once and never edited afterwards, new changes go to a new step
+    migrations: List[Migration] = [
+        Migration(1, "indexes", [
+            # serial numbers and emails were never unique: the oldest device or user of each duplicate group is
+            # kept, readings and links of the others are moved to it before they are removed
+            """UPDATE sensor_readings
+               SET device_id = (SELECT min(kept.id) FROM devices AS duplicate
+                                JOIN devices AS kept ON kept.serial_number = duplicate.serial_number
+                                WHERE duplicate.id = sensor_readings.device_id)
+               WHERE device_id IN (SELECT id FROM devices WHERE serial_number IS NOT NULL AND id NOT IN
+                                   (SELECT min(id) FROM devices WHERE serial_number IS NOT NULL
+                                    GROUP BY serial_number))""",
+            """UPDATE users_devices
+               SET device_id = (SELECT min(kept.id) FROM devices AS duplicate
+                                JOIN devices AS kept ON kept.serial_number = duplicate.serial_number
+                                WHERE duplicate.id = users_devices.device_id)
+               WHERE device_id IN (SELECT id FROM devices WHERE serial_number IS NOT NULL AND id NOT IN
+                                   (SELECT min(id) FROM devices WHERE serial_number IS NOT NULL
+                                    GROUP BY serial_number))""",
+            """UPDATE users_devices
+               SET user_id = (SELECT min(kept.id) FROM users AS duplicate
+                              JOIN users AS kept ON kept.email = duplicate.email
+                              WHERE duplicate.id = users_devices.user_id)
+               WHERE user_id IN (SELECT id FROM users WHERE email IS NOT NULL AND id NOT IN
+                                 (SELECT min(id) FROM users WHERE email IS NOT NULL GROUP BY email))""",
+            """DELETE FROM devices WHERE serial_number IS NOT NULL AND id NOT IN
+               (SELECT min(id) FROM devices WHERE serial_number IS NOT NULL GROUP BY serial_number)""",
+            """DELETE FROM users WHERE email IS NOT NULL AND id NOT IN
+               (SELECT min(id) FROM users WHERE email IS NOT NULL GROUP BY email)""",
+            # duplicated links, also the ones the merges above made, would break the unique index below
+            """DELETE FROM users_devices
+               WHERE id NOT IN (SELECT min(id) FROM users_devices GROUP BY user_id, device_id)""",
+            "CREATE UNIQUE INDEX IF NOT EXISTS users_devices_user_id_device_id ON users_devices (user_id, device_id)",
+            "CREATE INDEX IF NOT EXISTS users_devices_device_id ON users_devices (device_id)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS users_email ON users (email)",
+            "CREATE INDEX IF NOT EXISTS users_login ON users (login)",
+            "CREATE UNIQUE INDEX IF NOT EXISTS devices_serial_number ON devices (serial_number)",
+            "CREATE INDEX IF NOT EXISTS sensor_readings_device_id_datetime ON sensor_readings (device_id, datetime)",
+        ]),
+        Migration(2, "sensor_readings_ts", [
+            # datetime text is not sortable, readings are ordered by epoch milliseconds instead
+            "ALTER TABLE sensor_readings ADD COLUMN ts INTEGER",
+            "DROP INDEX IF EXISTS sensor_readings_device_id_datetime",
+            "CREATE INDEX IF NOT EXISTS sensor_readings_device_id_ts ON sensor_readings (device_id, ts)",
+        ], Backfill.sensor_readings_ts),
+        Migration(3, "sensor_readings_rollups", [
+            """CREATE TABLE IF NOT EXISTS sensor_readings_rollups
+            (
+                bucket TEXT NOT NULL,
+                device_id INTEGER NOT NULL,
+                bucket_start INTEGER NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                last_ts INTEGER,
+                temperature_count INTEGER NOT NULL DEFAULT 0,
+                temperature_sum FLOAT NOT NULL DEFAULT 0,
+                temperature_min FLOAT,
+                temperature_max FLOAT,
+                temperature_last FLOAT,
+                humidity_count INTEGER NOT NULL DEFAULT 0,
+                humidity_sum FLOAT NOT NULL DEFAULT 0,
+                humidity_min FLOAT,
+                humidity_max FLOAT,
+                humidity_last FLOAT,
+                pressure_count INTEGER NOT NULL DEFAULT 0,
+                pressure_sum FLOAT NOT NULL DEFAULT 0,
+                pressure_min FLOAT,
+                pressure_max FLOAT,
+                pressure_last FLOAT,
+                hydration_count INTEGER NOT NULL DEFAULT 0,
+                hydration_sum FLOAT NOT NULL DEFAULT 0,
+                hydration_min FLOAT,
+                hydration_max FLOAT,
+                hydration_last FLOAT,
+                waterlevel_count INTEGER NOT NULL DEFAULT 0,
+                waterlevel_sum FLOAT NOT NULL DEFAULT 0,
+                waterlevel_min FLOAT,
+                waterlevel_max FLOAT,
+                waterlevel_last FLOAT,
+                PRIMARY KEY (bucket, device_id, bucket_start)
+            ) WITHOUT ROWID""",
+        ]),
+        Migration(4, "sensor_readings_ts_index", [
+            # time windows over all devices, (device_id, ts) only helps when devices are known
+            "CREATE INDEX IF NOT EXISTS sensor_readings_ts ON sensor_readings (ts)",
+        ]),
+        Migration(5, "sensor_readings_partitions", [
+            # sealed months of sensor_readings, each one a separate database file
+            """CREATE TABLE IF NOT EXISTS sensor_readings_partitions
+            (
+                month TEXT PRIMARY KEY,
+                start_ts INTEGER NOT NULL,
+                end_ts INTEGER NOT NULL,
+                min_id INTEGER NOT NULL,
+                max_id INTEGER NOT NULL
+            )""",
+        ]),
+        Migration(6, "sensor_readings_archive", [
+            # chunks of archived readings, one per device and month, at byte offsets of the archive file
+            """CREATE TABLE IF NOT EXISTS sensor_readings_archive
+            (
+                device_id INTEGER NOT NULL,
+                month TEXT NOT NULL,
+                start_ts INTEGER NOT NULL,
+                end_ts INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                offset INTEGER NOT NULL,
+                size INTEGER NOT NULL,
+                PRIMARY KEY (device_id, start_ts, offset)
+            ) WITHOUT ROWID""",
+        ]),
+        Migration(7, "device_latest_readings", [
+            # newest reading of every device, kept up to date in the transaction of every insert
+            """CREATE TABLE IF NOT EXISTS device_latest_readings
+            (
+                device_id INTEGER PRIMARY KEY,
+                id INTEGER NOT NULL,
+                datetime TEXT,
+                temperature FLOAT,
+                humidity FLOAT,
+                pressure FLOAT,
+                hydration FLOAT,
+                waterlevel FLOAT,
+                ts INTEGER NOT NULL
+            )""",
+            # devices with readings only in sealed partitions are filled by scripts/rebuild_rollups.py
+            """INSERT OR REPLACE INTO device_latest_readings
+               (device_id, id, datetime, temperature, humidity, pressure, hydration, waterlevel, ts)
+               SELECT device_id, id, datetime, temperature, humidity, pressure, hydration, waterlevel, ts
+               FROM (SELECT *, row_number() OVER (PARTITION BY device_id ORDER BY ts DESC, id DESC) AS position
+                     FROM sensor_readings WHERE ts IS NOT NULL)
+               WHERE position = 1""",
+        ]),
+        Migration(8, "notifications", [
+            # tables of UserNotification and UserSettings, they were used without ever being created
+            """CREATE TABLE IF NOT EXISTS users_notifications
+            (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL REFERENCES users,
+                value TEXT
+            )""",
+            "CREATE INDEX IF NOT EXISTS users_notifications_user_id ON users_notifications (user_id)",
+            """CREATE TABLE IF NOT EXISTS users_settings
+            (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL UNIQUE REFERENCES users,
+                notifications INTEGER NOT NULL DEFAULT 1,
+                mode TEXT
+            )""",
+            # threshold (above/below) and rate of change per hour (rise/fall) rules on one metric,
+            # device_id NULL means every device of the user
+            """CREATE TABLE IF NOT EXISTS notification_rules
+            (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL REFERENCES users,
+                device_id INTEGER REFERENCES devices,
+                metric TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                threshold FLOAT NOT NULL,
+                hysteresis FLOAT NOT NULL DEFAULT 0,
+                cooldown INTEGER NOT NULL DEFAULT 0
+            )""",
+            "CREATE INDEX IF NOT EXISTS notification_rules_user_id ON notification_rules (user_id)",
+        ]),
+        Migration(9, "users_notifications_delivery", [
+            # delivery workers claim pending notifications for a lease and mark them delivered
+            "ALTER TABLE users_notifications ADD COLUMN created_at INTEGER",
+            "ALTER TABLE users_notifications ADD COLUMN claimed_by TEXT",
+            "ALTER TABLE users_notifications ADD COLUMN claimed_at INTEGER",
+            "ALTER TABLE users_notifications ADD COLUMN delivered_at INTEGER",
+            """CREATE INDEX IF NOT EXISTS users_notifications_pending ON users_notifications (user_id, id)
+               WHERE delivered_at IS NULL""",
+        ]),
+    ]
+
+    @staticmethod
+    def current_version() -> int:
+        Migrator._create_schema_version_table()
+
+        response = ConnectionManager.get().execute(
+            f"SELECT max(version) FROM {Migrator.schema_version_table_name}").fetchone()
+
+        return response[0] or 0
+
+    @staticmethod
+    def pending() -> List[Migration]:
+        version = Migrator.current_version()
+
+        return sorted((migration for migration in Migrator.migrations if migration.version > version),
+                      key=lambda migration: migration.version)
+
+    @staticmethod
+    def migrate() -> int:
+        for migration in Migrator.pending():
+            Migrator._apply(migration)
+
+        return Migrator.current_version()
+
+    @staticmethod
+    def _apply(migration: Migration):
+        conn = ConnectionManager.get()
+
+        # explicit BEGIN, so DDL statements are part of the step transaction as well
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            for statement in migration.statements:
+                conn.execute(statement)
+
+            if migration.function:
+                migration.function(conn)
+
+            conn.execute(f"""
+                INSERT INTO {Migrator.schema_version_table_name} (version, name, applied_at) VALUES (?, ?, ?)
+                """, (migration.version, migration.name, dt.datetime.now().isoformat(timespec="seconds")))
+
+            conn.commit()
+
+        except Exception as error:
+            conn.rollback()
+            raise MigrationFailedError(migration.version, migration.name, error) from error
+
+    @staticmethod
+    def _create_schema_version_table():
+        ConnectionManager.get().execute(f"""
+            CREATE TABLE IF NOT EXISTS {Migrator.schema_version_table_name}
+            (
+                version     INTEGER PRIMARY KEY,
+                name        TEXT,
+                applied_at  TEXT
+            )""")
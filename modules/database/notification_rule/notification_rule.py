@@ -0,0 +1,196 @@
+from __future__ import annotations
+
+from typing import List
+from dataclasses import dataclass
+
+from modules.database.database.database import DB
+from modules.database.connection.connection import ConnectionManager
+
+
+class NotificationRuleNotFoundError(Exception):
+    def __str__(self) -> str:
+        return "Notification rule not found"
+
+
+class InvalidNotificationRuleError(Exception):
+    def __init__(self, field=None, value=None):
+        self.field = field
+        self.value = value
+
+    def __str__(self) -> str:
+        return f"Invalid notification rule {self.field}: {self.value!r}"
+
+
+@dataclass
+class DbNotificationRule:
+    id: int
+    user_id: int
+    device_id: int | None
+    metric: str
+    # above/below compare the value, rise/fall its change per hour since the previous reading of the device
+    kind: str
+    threshold: float
+    # a fired rule fires again only after the value went back past threshold by hysteresis
+    hysteresis: float = 0.0
+    # minimum time between two notifications of the rule for one device, ms
+    cooldown: int = 0
+
+
+class NotificationRuleFetcher:
+    @staticmethod
+    def fetch_by_id(id: int) -> DbNotificationRule:
+        return NotificationRuleFetcher.constructor(DB.fetch_one(DB.notification_rules_table_name, id=id))
+
+    @staticmethod
+    def fetch_by_user_id(user_id: int) -> List[DbNotificationRule]:
+        return NotificationRuleFetcher.constructor(
+            DB.fetch_many(DB.notification_rules_table_name, user_id=user_id)) or []
+
+    @staticmethod
+    def fetch_by_devices() -> List[tuple]:
+        # [(device id, rule)] of every rule for every device it watches, users with notifications turned off
+        # are left out
+        rows = DB.fetch_query(f"""
+            SELECT link.device_id AS watched_device_id, rules.*
+            FROM {DB.notification_rules_table_name} AS rules
+            JOIN {DB.users_devices_table_name} AS link ON link.user_id = rules.user_id
+            LEFT JOIN {DB.users_settings_table_name} AS settings ON settings.user_id = rules.user_id
+            WHERE (rules.device_id IS NULL OR rules.device_id = link.device_id)
+              AND (settings.notifications IS NULL OR settings.notifications != 0)
+            """)
+
+        return [(row["watched_device_id"], NotificationRuleFetcher.constructor(
+                    {key: row[key] for key in row.keys() if key != "watched_device_id"}))
+                for row in rows]
+
+    @staticmethod
+    def constructor(info) -> DbNotificationRule | List[DbNotificationRule] | None:
+        if not info:
+            return None
+
+        if isinstance(info, list):
+            return [NotificationRuleFetcher.constructor(rule_info) for rule_info in info]
+
+        else:
+            return DbNotificationRule(**dict(info))
+
+
+class NotificationRuleInserter:
+    @staticmethod
+    def insert(user_id: int, metric: str, kind: str, threshold: float, hysteresis: float = 0.0, cooldown: int = 0,
+               device_id: int = None) -> int:
+        if metric not in NotificationRule.metrics:
+            raise InvalidNotificationRuleError("metric", metric)
+
+        if kind not in NotificationRule.kinds:
+            raise InvalidNotificationRuleError("kind", kind)
+
+        if hysteresis < 0 or cooldown < 0:
+            raise InvalidNotificationRuleError("hysteresis" if hysteresis < 0 else "cooldown",
+                                               hysteresis if hysteresis < 0 else cooldown)
+
+        rule_id = DB.insert_one(DB.notification_rules_table_name, user_id=user_id, device_id=device_id, metric=metric,
+                                kind=kind, threshold=threshold, hysteresis=hysteresis, cooldown=cooldown)
+        NotificationRule.changed()
+
+        return rule_id
+
+
+class NotificationRuleDeleter:
+    @staticmethod
+    def delete(rule: DbNotificationRule):
+        DB.delete_one(DB.notification_rules_table_name, id=rule.id)
+        NotificationRule.changed()
+
+    @staticmethod
+    def delete_by_user_id(user_id: int):
+        DB.delete_one(DB.notification_rules_table_name, user_id=user_id)
+        NotificationRule.changed()
+
+
+class NotificationRule:
+    metrics = ["temperature", "humidity", "pressure", "hydration", "waterlevel"]
+    kinds = ["above", "below", "rise", "fall"]
+
+    # bumped after every commit that changes which rules watch which device, the rule engine reloads then
+    version = 0
+
+    _notification_rule: DbNotificationRule
+
+    def __init__(self, **kwargs):
+        if set(kwargs.keys()) == {"id"}:
+            self._notification_rule = NotificationRuleFetcher.fetch_by_id(kwargs["id"])
+
+        elif set(kwargs.keys()) == {"db_notification_rule"}:
+            self._notification_rule = kwargs["db_notification_rule"]
+
+        else:
+            raise InvalidNotificationRuleError("arguments", sorted(kwargs.keys()))
+
+        if not self._notification_rule:
+            raise NotificationRuleNotFoundError
+
+    @staticmethod
+    def changed():
+        # rules, links of users and devices or notification settings changed
+        def bump():
+            NotificationRule.version += 1
+
+        ConnectionManager.on_commit(bump)
+
+    @property
+    def id(self) -> int:
+        return self._notification_rule.id
+
+    @property
+    def user_id(self) -> int:
+        return self._notification_rule.user_id
+
+    @property
+    def device_id(self) -> int | None:
+        return self._notification_rule.device_id
+
+    @property
+    def metric(self) -> str:
+        return self._notification_rule.metric
+
+    @property
+    def kind(self) -> str:
+        return self._notification_rule.kind
+
+    @property
+    def threshold(self) -> float:
+        return self._notification_rule.threshold
+
+    @property
+    def hysteresis(self) -> float:
+        return self._notification_rule.hysteresis
+
+    @property
+    def cooldown(self) -> int:
+        return self._notification_rule.cooldown
+
+    @staticmethod
+    def insert(user_id: int, metric: str, kind: str, threshold: float, hysteresis: float = 0.0, cooldown: int = 0,
+               device_id: int = None) -> NotificationRule:
+        rule_id = NotificationRuleInserter.insert(user_id, metric, kind, threshold, hysteresis, cooldown, device_id)
+
+        return NotificationRule(db_notification_rule=DbNotificationRule(
+            id=rule_id, user_id=user_id, device_id=device_id, metric=metric, kind=kind, threshold=threshold,
+            hysteresis=hysteresis, cooldown=cooldown))
+
+    @staticmethod
+    def user_rules(user_id: int) -> List[NotificationRule]:
+        return [NotificationRule(db_notification_rule=rule_info)
+                for rule_info in NotificationRuleFetcher.fetch_by_user_id(user_id)]
+
+    def delete(self):
+        NotificationRuleDeleter.delete(self._notification_rule)
+
+    def __str__(self):
+        return (f"id: {self.id}, user_id: {self.user_id}, device_id: {self.device_id}, {self.metric} {self.kind} "
+                f"{self.threshold} (hysteresis: {self.hysteresis}, cooldown: {self.cooldown} ms)")
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,54 @@
+from __future__ import annotations
+
+import json
+import base64
+import binascii
+from typing import List, Generic, TypeVar
+from dataclasses import dataclass
+
+T = TypeVar("T")
+
+
+class InvalidPageCursorError(Exception):
+    def __str__(self) -> str:
+        return "Invalid page cursor"
+
+
+@dataclass
+class Page(Generic[T]):
+    items: List[T]
+    next_cursor: str | None
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+
+class PageCursor:
+    # opaque for callers, internally the key values of the last row of the previous page
+
+    @staticmethod
+    def encode(key: tuple) -> str:
+        return base64.urlsafe_b64encode(json.dumps(list(key)).encode("utf-8")).decode("ascii")
+
+    @staticmethod
+    def decode(cursor: str | tuple | None, size: int) -> tuple | None:
+        if cursor is None:
+            return None
+
+        if isinstance(cursor, (tuple, list)):
+            key = list(cursor)
+
+        else:
+            try:
+                key = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+
+            except (ValueError, binascii.Error, AttributeError):
+                raise InvalidPageCursorError
+
+        if not isinstance(key, list) or len(key) != size or not all(isinstance(value, int) for value in key):
+            raise InvalidPageCursorError
+
+        return tuple(key)
@@ -0,0 +1,378 @@
+from __future__ import annotations
+
+import os
+import itertools
+import datetime as dt
+from typing import List, Iterator, Tuple
+from contextlib import contextmanager
+from dataclasses import dataclass
+
+from modules.config.config import timezone
+from modules.database.connection.connection import ConnectionManager
+from modules.database.database.database import DB
+from modules.database.archive.archive import Archive
+from modules.database.timestamp.timestamp import Timestamp
+
+
+class PartitionNotFoundError(Exception):
+    def __init__(self, month=None):
+        self.month = month
+
+    def __str__(self) -> str:
+        return f"Partition not found: {self.month!r}"
+
+
+@dataclass
+class DbPartition:
+    month: str
+    start_ts: int
+    end_ts: int
+    min_id: int
+    max_id: int
+
+
+class Partition:
+    # sealed months of sensor_readings live in their own files data/partitions/sensor_readings_YYYY_MM.db,
+    # the sensor_readings table of the main database keeps the readings from the last sealed month on ("hot")
+    # and every ts below the sealed boundary is served from the partitions, attached only for the query;
+    # reads of one device also return its readings moved to the archive by the retention job
+    table_name = "sensor_readings_partitions"
+    columns = ["id", "device_id", "datetime", "temperature", "humidity", "pressure", "hydration", "waterlevel", "ts"]
+    chunk_size = 10000
+
+    @staticmethod
+    def directory() -> str:
+        return DB.partitions_path()
+
+    @staticmethod
+    def path(month: str) -> str:
+        return os.path.join(Partition.directory(), f"{DB.sensor_readings_table_name}_{month}.db")
+
+    @staticmethod
+    def schema(month: str) -> str:
+        return f"p_{month}"
+
+    @staticmethod
+    def month(ts: int) -> str:
+        # months are local, so they consist of whole rollup days
+        datetime = Timestamp.to_datetime(ts)
+
+        return f"{datetime.year:04d}_{datetime.month:02d}"
+
+    @staticmethod
+    def bounds(month: str) -> Tuple[int, int]:
+        year, month = map(int, month.split("_"))
+        next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+
+        return (Timestamp.from_datetime(dt.datetime(year, month, 1, tzinfo=timezone)),
+                Timestamp.from_datetime(dt.datetime(next_year, next_month, 1, tzinfo=timezone)))
+
+    @staticmethod
+    def fetch_all() -> List[DbPartition]:
+        return [DbPartition(**dict(info)) for info in
+                DB.fetch_query(f"SELECT * FROM {Partition.table_name} ORDER BY start_ts")]
+
+    @staticmethod
+    def boundary() -> int | None:
+        # readings with ts below the boundary are sealed, None while nothing is
+        return DB.fetch_query(f"SELECT max(end_ts) FROM {Partition.table_name}")[0][0]
+
+    @staticmethod
+    def segments(start: int = None, end: int = None, order: str = "asc") -> List[Tuple[str | None, int, int]]:
+        # pieces of [start, end) by storage in ts order: (month, start, end), month None is the hot table
+        partitions = Partition.fetch_all()
+        segments = [(partition.month,
+                     partition.start_ts if start is None else max(start, partition.start_ts),
+                     partition.end_ts if end is None else min(end, partition.end_ts)) for partition in partitions
+                    if (start is None or start < partition.end_ts) and (end is None or partition.start_ts < end)]
+
+        hot_start = start
+        if partitions:
+            hot_start = partitions[-1].end_ts if start is None else max(start, partitions[-1].end_ts)
+
+        if end is None or hot_start is None or hot_start < end:
+            segments.append((None, hot_start, end))
+
+        return segments if order == "asc" else segments[::-1]
+
+    @staticmethod
+    @contextmanager
+    def attached(month: str | None, create: bool = False):
+        # yields the sensor_readings table of the month, the hot table for None;
+        # ATTACH is not allowed inside a transaction, so callers attach before they open one
+        if month is None:
+            yield DB.sensor_readings_table_name
+            return
+
+        conn = ConnectionManager.get()
+        schema = Partition.schema(month)
+
+        if schema in [row["name"] for row in conn.execute("PRAGMA database_list")]:
+            yield f"{schema}.{DB.sensor_readings_table_name}"
+            return
+
+        path = Partition.path(month)
+        if not os.path.exists(path):
+            if not create:
+                raise PartitionNotFoundError(month)
+
+            os.makedirs(Partition.directory(), exist_ok=True)
+
+        conn.execute("ATTACH DATABASE ? AS " + schema, (path,))
+        try:
+            if create:
+                Partition._create_table(conn, schema)
+
+            yield f"{schema}.{DB.sensor_readings_table_name}"
+
+        finally:
+            if not conn.in_transaction:
+                conn.execute(f"DETACH DATABASE {schema}")
+
+    @staticmethod
+    def locate(id: int) -> str | None:
+        # month of the partition holding the reading, None for the hot table or an unknown id
+        if DB.fetch_one(DB.sensor_readings_table_name, id=id):
+            return None
+
+        for partition in Partition.fetch_all():
+            if partition.min_id <= id <= partition.max_id:
+                with Partition.attached(partition.month) as table_name:
+                    if DB.fetch_one(table_name, id=id):
+                        return partition.month
+
+        return None
+
+    @staticmethod
+    def target(ts: int | None, boundary: int | None) -> str | None:
+        # where a reading with ts belongs, rows without ts stay in the hot table
+        if ts is None or boundary is None or ts >= boundary:
+            return None
+
+        return Partition.month(ts)
+
+    @staticmethod
+    def seal(before: int = None) -> List[str]:
+        # moves hot readings of the months before `before` (default: the current month) into their files
+        before = Partition.bounds(Partition.month(Timestamp.now() if before is None else before))[0]
+
+        return Partition._move_below(before)
+
+    @staticmethod
+    def relocate() -> List[str]:
+        # moves readings inserted below the boundary after the months were sealed
+        boundary = Partition.boundary()
+
+        return Partition._move_below(boundary) if boundary is not None else []
+
+    @staticmethod
+    def move(id: int, source: str | None, target: str | None):
+        # moves one reading between the hot table and the partitions, e.g. after its ts was changed
+        if source == target:
+            return
+
+        with Partition.attached(source) as source_table, Partition.attached(target, create=True) as target_table:
+            with DB.transaction() as conn:
+                conn.execute(f"""
+                    INSERT OR REPLACE INTO {target_table} ({", ".join(Partition.columns)})
+                    SELECT {", ".join(Partition.columns)} FROM {source_table} WHERE id = ?
+                    """, (id,))
+                conn.execute(f"DELETE FROM {source_table} WHERE id = ?", (id,))
+
+                if target is not None:
+                    Partition._register(conn, target, id, id)
+
+    @staticmethod
+    def drop(month: str):
+        # the whole month goes at once: one registry row and one file, rollups of the month are kept
+        if not DB.fetch_one(Partition.table_name, month=month):
+            raise PartitionNotFoundError(month)
+
+        DB.delete_one(Partition.table_name, month=month)
+
+        # other connections may still have the month attached
+        ConnectionManager.close_all()
+
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(Partition.path(month) + suffix):
+                os.remove(Partition.path(month) + suffix)
+
+    @staticmethod
+    def fetch_range(start: int = None, end: int = None, order: str = "asc", limit: int = None,
+                    **kwargs) -> list:
+        # the archive holds the oldest readings: ascending it is read first, descending only when the hot table
+        # and the partitions did not fill limit, in both cases no further than limit
+        archived = Partition._archived(start, end, order, **kwargs)
+
+        rows = list(itertools.islice(archived, limit)) if order == "asc" else []
+        for month, segment_start, segment_end in Partition.segments(start, end, order):
+            if limit is not None and len(rows) >= limit:
+                break
+
+            with Partition.attached(month) as table_name:
+                rows += DB.fetch_range(table_name, "ts", segment_start, segment_end, order,
+                                       None if limit is None else limit - len(rows), **kwargs)
+
+        if order == "desc" and (limit is None or len(rows) < limit):
+            rows += itertools.islice(archived, None if limit is None else limit - len(rows))
+
+        return rows
+
+    @staticmethod
+    def fetch_page(columns: List[str], after: tuple, limit: int = 500, order: str = "asc", **kwargs) -> list:
+        # keyset page over (ts, ...) columns, segments before the cursor are skipped
+        if order == "asc":
+            start, end = after[0], None
+
+        else:
+            start, end = None, after[0] + 1 if after[0] < 2 ** 63 - 1 else None
+        archived = (row for row in Partition._archived(start, end, order, **kwargs)
+                    if (tuple(row[column] for column in columns) > tuple(after) if order == "asc"
+                        else tuple(row[column] for column in columns) < tuple(after)))
+
+        rows = list(itertools.islice(archived, limit)) if order == "asc" else []
+        for month, _, _ in Partition.segments(start, end, order):
+            if len(rows) >= limit:
+                break
+
+            with Partition.attached(month) as table_name:
+                rows += DB.fetch_page(table_name, columns, after, limit - len(rows), order, **kwargs)
+
+        if order == "desc" and len(rows) < limit:
+            rows += itertools.islice(archived, limit - len(rows))
+
+        return rows
+
+    @staticmethod
+    def fetch_by_id(id: int):
+        month = Partition.locate(id)
+
+        with Partition.attached(month) as table_name:
+            return DB.fetch_one(table_name, id=id)
+
+    @staticmethod
+    def iter_rows(chunk_size: int = 1000, **kwargs) -> Iterator:
+        # sealed months first, by id inside each storage
+        for month, _, _ in Partition.segments():
+            with Partition.attached(month) as table_name:
+                yield from DB.iter_rows(table_name, chunk_size, **kwargs)
+
+    @staticmethod
+    def iter_range(start: int = None, end: int = None, order: str = "asc", chunk_size: int = 1000,
+                   **kwargs) -> Iterator:
+        # the archive is unpacked month by month as the caller gets to it
+        archived = Partition._archived(start, end, order, **kwargs)
+
+        if order == "asc":
+            yield from archived
+
+        for month, segment_start, segment_end in Partition.segments(start, end, order):
+            with Partition.attached(month) as table_name:
+                yield from DB.iter_range(table_name, "ts", segment_start, segment_end, order,
+                                         chunk_size=chunk_size, **kwargs)
+
+        if order == "desc":
+            yield from archived
+
+    @staticmethod
+    def iter_column_chunks(columns: List[str], start: int = None, end: int = None, chunk_size: int = 10000,
+                           **kwargs) -> Iterator[tuple]:
+        archived = Partition._archived(start, end, **kwargs)
+
+        while True:
+            rows = list(itertools.islice(archived, chunk_size))
+            if not rows:
+                break
+
+            yield tuple(zip(*([row[column] for column in columns] for row in rows)))
+
+        for month, segment_start, segment_end in Partition.segments(start, end):
+            with Partition.attached(month) as table_name:
+                yield from DB.iter_column_chunks(table_name, columns, "ts", segment_start, segment_end,
+                                                 chunk_size=chunk_size, **kwargs)
+
+    @staticmethod
+    def _archived(start: int = None, end: int = None, order: str = "asc", **kwargs) -> Iterator[dict]:
+        # archived readings are kept per device, reads of a device reach into them transparently;
+        # lazy, nothing is read before the first row is taken
+        if set(kwargs) != {"device_id"} or isinstance(kwargs["device_id"], (list, tuple, set)):
+            return iter(())
+
+        return Archive.iter_rows(kwargs["device_id"], start, end, order)
+
+    @staticmethod
+    def _move_below(limit: int) -> List[str]:
+        months = []
+        while True:
+            first_ts = DB.fetch_query(f"SELECT min(ts) FROM {DB.sensor_readings_table_name} WHERE ts < ?",
+                                      (limit,))[0][0]
+            if first_ts is None:
+                break
+
+            month = Partition.month(first_ts)
+            Partition._move_month(month)
+            months.append(month)
+
+        return months
+
+    @staticmethod
+    def _move_month(month: str):
+        # chunked, so the write lock is released between chunks; INSERT OR IGNORE makes a rerun after
+        # a failure between the two files harmless
+        start, end = Partition.bounds(month)
+        columns = ", ".join(Partition.columns)
+
+        with Partition.attached(month, create=True) as table_name:
+            while True:
+                with DB.transaction() as conn:
+                    ids = [row[0] for row in conn.execute(f"""
+                        SELECT id FROM {DB.sensor_readings_table_name} WHERE ts >= ? AND ts < ? ORDER BY id LIMIT ?
+                        """, (start, end, Partition.chunk_size))]
+
+                    if not ids:
+                        break
+
+                    conn.execute(f"""
+                        INSERT OR IGNORE INTO {table_name} ({columns})
+                        SELECT {columns} FROM {DB.sensor_readings_table_name}
+                        WHERE ts >= ? AND ts < ? AND id <= ?
+                        """, (start, end, ids[-1]))
+                    conn.execute(f"""
+                        DELETE FROM {DB.sensor_readings_table_name} WHERE ts >= ? AND ts < ? AND id <= ?
+                        """, (start, end, ids[-1]))
+
+                    Partition._register(conn, month, ids[0], ids[-1])
+
+    @staticmethod
+    def _register(conn, month: str, min_id: int, max_id: int):
+        start, end = Partition.bounds(month)
+
+        conn.execute(f"""
+            INSERT INTO {Partition.table_name} (month, start_ts, end_ts, min_id, max_id) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (month) DO UPDATE SET min_id = min(min_id, excluded.min_id),
+                                              max_id = max(max_id, excluded.max_id)
+            """, (month, start, end, min_id, max_id))
+
+    @staticmethod
+    def _create_table(conn, schema: str):
+        conn.execute(f"PRAGMA {schema}.journal_mode = WAL")
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {schema}.{DB.sensor_readings_table_name}
+            (
+                id          INTEGER PRIMARY KEY,
+                device_id INTEGER,
+                datetime TEXT,
+                temperature FLOAT,
+                humidity FLOAT,
+                pressure FLOAT,
+                hydration FLOAT,
+                waterlevel FLOAT,
+                ts INTEGER
+            )""")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {schema}.sensor_readings_device_id_ts "
+                     f"ON {DB.sensor_readings_table_name} (device_id, ts)")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS {schema}.sensor_readings_ts ON {DB.sensor_readings_table_name} (ts)")
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,50 @@
+from __future__ import annotations
+
+from typing import List
+
+from modules.config.config import retention_days
+from modules.database.database.database import DB
+from modules.database.archive.archive import Archive
+from modules.database.partition.partition import Partition
+from modules.database.timestamp.timestamp import Timestamp
+
+
+class Retention:
+    # keeps the database bounded: whole months older than retention_days go to the archive
+    day = 24 * 60 * 60 * 1000
+
+    @staticmethod
+    def run(days: int = retention_days, now: int = None) -> List[str]:
+        # returns the archived months; a month is archived once all of it is older than the cutoff
+        cutoff = (Timestamp.now() if now is None else now) - days * Retention.day
+
+        # old hot readings go to their month partitions first, in chunked transactions
+        Partition.seal(cutoff)
+
+        months = []
+        for partition in Partition.fetch_all():
+            if partition.end_ts <= cutoff:
+                Retention.archive(partition.month)
+                months.append(partition.month)
+
+        return months
+
+    @staticmethod
+    def archive(month: str):
+        # one chunk per device, the partition file is dropped only after all chunks are registered;
+        # a rerun after a failure appends the month again, readers skip the repeated ids
+        start, end = Partition.bounds(month)
+
+        with Partition.attached(month) as table_name:
+            devices_id = [row["device_id"] for row in DB.fetch_query(
+                f"SELECT DISTINCT device_id FROM {table_name} WHERE ts IS NOT NULL ORDER BY device_id")]
+
+            for device_id in devices_id:
+                Archive.append([(device_id, month, start, end, [dict(row) for row in DB.fetch_range(
+                    table_name, "ts", start, end, device_id=device_id)])])
+
+        Partition.drop(month)
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,361 @@
+from __future__ import annotations
+
+import math
+from typing import List, Dict, Iterable
+from dataclasses import dataclass, field
+
+from modules.config.config import timezone
+from modules.database.connection.connection import ConnectionManager
+from modules.database.database.database import DB
+from modules.database.partition.partition import Partition
+
+
+class InvalidRollupBucketError(Exception):
+    def __init__(self, bucket=None):
+        self.bucket = bucket
+
+    def __str__(self) -> str:
+        return f"Invalid rollup bucket: {self.bucket!r}"
+
+
+@dataclass
+class SensorReadingAggregate:
+    device_id: int
+    bucket: str
+    bucket_start: int
+    count: int = 0
+    last_ts: int | None = None
+    counts: Dict[str, int] = field(default_factory=dict)
+    sums: Dict[str, float] = field(default_factory=dict)
+    minimums: Dict[str, float | None] = field(default_factory=dict)
+    maximums: Dict[str, float | None] = field(default_factory=dict)
+    lasts: Dict[str, float | None] = field(default_factory=dict)
+
+    def mean(self, metric: str) -> float:
+        return self.sums[metric] / self.counts[metric] if self.counts.get(metric) else math.nan
+
+    def add(self, ts: int, values: Dict[str, float | None]):
+        self.count += 1
+        is_last = self.last_ts is None or ts >= self.last_ts
+
+        for metric, value in values.items():
+            if value is not None:
+                self.counts[metric] = self.counts.get(metric, 0) + 1
+                self.sums[metric] = self.sums.get(metric, 0.0) + value
+                minimum = self.minimums.get(metric)
+                maximum = self.maximums.get(metric)
+                self.minimums[metric] = value if minimum is None else min(minimum, value)
+                self.maximums[metric] = value if maximum is None else max(maximum, value)
+
+            else:
+                self.counts.setdefault(metric, 0)
+                self.sums.setdefault(metric, 0.0)
+                self.minimums.setdefault(metric, None)
+                self.maximums.setdefault(metric, None)
+
+            if is_last:
+                self.lasts[metric] = value
+
+        if is_last:
+            self.last_ts = ts
+
+
+class Rollup:
+    # per device aggregates of sensor readings by minute, hour and day, kept up to date on insert, delete and update
+    table_name = "sensor_readings_rollups"
+    metrics = ["temperature", "humidity", "pressure", "hydration", "waterlevel"]
+    buckets = {
+        "1m": 60 * 1000,
+        "1h": 60 * 60 * 1000,
+        "1d": 24 * 60 * 60 * 1000,
+    }
+    # days start at local midnight
+    offset = int(timezone.utcoffset(None).total_seconds() * 1000)
+
+    @staticmethod
+    def bucket_size(bucket: str) -> int:
+        if bucket not in Rollup.buckets:
+            raise InvalidRollupBucketError(bucket)
+
+        return Rollup.buckets[bucket]
+
+    @staticmethod
+    def bucket_start(bucket: str, ts: int) -> int:
+        size = Rollup.bucket_size(bucket)
+
+        return (ts + Rollup.offset) // size * size - Rollup.offset
+
+    @staticmethod
+    def aggregate_rows(rows: Iterable, buckets: List[str] = None) -> List[SensorReadingAggregate]:
+        # rows are mappings with device_id, ts and the metrics, rows without ts are skipped
+        aggregates = {}
+        for row in rows:
+            ts = row["ts"]
+            if ts is None:
+                continue
+
+            values = {metric: row[metric] for metric in Rollup.metrics}
+            for bucket in buckets or Rollup.buckets:
+                bucket_start = Rollup.bucket_start(bucket, ts)
+                key = (bucket, row["device_id"], bucket_start)
+
+                if key not in aggregates:
+                    aggregates[key] = SensorReadingAggregate(device_id=row["device_id"], bucket=bucket,
+                                                             bucket_start=bucket_start)
+
+                aggregates[key].add(ts, values)
+
+        return list(aggregates.values())
+
+    @staticmethod
+    def apply(rows: Iterable):
+        # merges new readings into the rollups, callers run it in the transaction of the insert
+        aggregates = Rollup.aggregate_rows(rows)
+
+        if not aggregates:
+            return
+
+        with DB.transaction() as conn:
+            conn.executemany(Rollup._upsert_request(), [Rollup._upsert_values(aggregate)
+                                                        for aggregate in aggregates])
+
+    @staticmethod
+    def retract(rows: Iterable) -> List[SensorReadingAggregate]:
+        # takes deleted or replaced readings out of the rollups, callers run it in the transaction of the change;
+        # count and sums are reversed at once, returns the buckets whose minimums, maximums or last values the
+        # readings may have held, refresh() recomputes them
+        aggregates = Rollup.aggregate_rows(rows)
+
+        if not aggregates:
+            return []
+
+        with DB.transaction() as conn:
+            conn.executemany(Rollup._retract_request(), [Rollup._retract_values(aggregate)
+                                                         for aggregate in aggregates])
+
+            stale = []
+            for aggregate in aggregates:
+                key = (aggregate.bucket, aggregate.device_id, aggregate.bucket_start)
+                info = conn.execute(f"""
+                    SELECT * FROM {Rollup.table_name} WHERE bucket = ? AND device_id = ? AND bucket_start = ?
+                    """, key).fetchone()
+
+                if info is not None and info["count"] <= 0:
+                    conn.execute(f"""
+                        DELETE FROM {Rollup.table_name} WHERE bucket = ? AND device_id = ? AND bucket_start = ?
+                        """, key)
+
+                elif info is not None and Rollup._holds_extremes(aggregate, Rollup.constructor(info)):
+                    stale.append(aggregate)
+
+        return stale
+
+    @staticmethod
+    def refresh(aggregates: List[SensorReadingAggregate]):
+        # recomputes minimums, maximums and last values of the buckets from the raw readings; runs after the
+        # commit, partitions can not be attached inside a transaction
+        if not aggregates:
+            return
+
+        def refresh():
+            rebuilt = []
+            for aggregate in aggregates:
+                start = aggregate.bucket_start
+                end = start + Rollup.bucket_size(aggregate.bucket)
+                rebuilt += Rollup.aggregate_rows(Partition.iter_range(start, end, device_id=aggregate.device_id),
+                                                 [aggregate.bucket])
+
+            with DB.transaction() as conn:
+                conn.executemany(Rollup._refresh_request(), [Rollup._refresh_values(aggregate)
+                                                             for aggregate in rebuilt])
+
+        ConnectionManager.on_commit(refresh)
+
+    @staticmethod
+    def fetch(device_id: int, bucket: str, start: int = None, end: int = None) -> List[SensorReadingAggregate]:
+        return [Rollup.constructor(info) for info in
+                DB.fetch_range(Rollup.table_name, "bucket_start", start, end, order_by_id=False,
+                               bucket=bucket, device_id=device_id)]
+
+    @staticmethod
+    def aggregate(device_id: int, bucket: str = "1h", start: int = None,
+                  end: int = None) -> List[SensorReadingAggregate]:
+        # whole buckets come from the rollups, buckets cut by start/end are computed from raw readings
+        size = Rollup.bucket_size(bucket)
+
+        full_start = start if start is None else Rollup.bucket_start(bucket, start + size - 1)
+        full_end = end if end is None else Rollup.bucket_start(bucket, end)
+
+        if full_start is not None and full_end is not None and full_start >= full_end:
+            return Rollup._aggregate_raw(device_id, bucket, start, end)
+
+        aggregates = []
+        if start is not None and start < full_start:
+            aggregates += Rollup._aggregate_raw(device_id, bucket, start, full_start)
+
+        aggregates += Rollup.fetch(device_id, bucket, full_start, full_end)
+
+        if end is not None and full_end < end:
+            aggregates += Rollup._aggregate_raw(device_id, bucket, full_end, end)
+
+        return aggregates
+
+    @staticmethod
+    def rebuild(device_id: int = None, chunk_size: int = 10000) -> int:
+        # recomputes rollups from raw readings, one transaction per device and month partition; rollups of
+        # dropped partitions are kept; returns the number of devices
+        segments = Partition.segments()
+
+        if device_id is None:
+            devices_id = set()
+            for month, _, _ in segments:
+                with Partition.attached(month) as table_name:
+                    devices_id.update(row["device_id"] for row in DB.fetch_query(
+                        f"SELECT DISTINCT device_id FROM {table_name}"))
+
+            devices_id = sorted(devices_id)
+
+        else:
+            devices_id = [device_id]
+
+        for device_id in devices_id:
+            for month, start, end in segments:
+                # months start at local midnight, so every rollup bucket belongs to exactly one segment
+                with Partition.attached(month) as table_name, DB.transaction() as conn:
+                    conn.execute(f"""
+                        DELETE FROM {Rollup.table_name}
+                        WHERE device_id = ? AND bucket_start >= ? AND bucket_start < ?
+                        """, (device_id, -2 ** 63 if start is None else start, 2 ** 63 - 1 if end is None else end))
+
+                    rows = []
+                    for row in DB.iter_range(table_name, "ts", -2 ** 63 if start is None else start, end,
+                                             chunk_size=chunk_size, device_id=device_id):
+                        rows.append(row)
+
+                        if len(rows) >= chunk_size:
+                            Rollup.apply(rows)
+                            rows = []
+
+                    Rollup.apply(rows)
+
+        return len(devices_id)
+
+    @staticmethod
+    def constructor(info) -> SensorReadingAggregate:
+        return SensorReadingAggregate(
+            device_id=info["device_id"],
+            bucket=info["bucket"],
+            bucket_start=info["bucket_start"],
+            count=info["count"],
+            last_ts=info["last_ts"],
+            counts={metric: info[f"{metric}_count"] for metric in Rollup.metrics},
+            sums={metric: info[f"{metric}_sum"] for metric in Rollup.metrics},
+            minimums={metric: info[f"{metric}_min"] for metric in Rollup.metrics},
+            maximums={metric: info[f"{metric}_max"] for metric in Rollup.metrics},
+            lasts={metric: info[f"{metric}_last"] for metric in Rollup.metrics})
+
+    @staticmethod
+    def _aggregate_raw(device_id: int, bucket: str, start: int | None, end: int | None):
+        if start is None:
+            start = -2 ** 63
+
+        return Rollup.aggregate_rows(Partition.iter_range(start, end, device_id=device_id), [bucket])
+
+    @staticmethod
+    def _columns() -> List[str]:
+        columns = ["bucket", "device_id", "bucket_start", "count", "last_ts"]
+        for metric in Rollup.metrics:
+            columns += [f"{metric}_count", f"{metric}_sum", f"{metric}_min", f"{metric}_max", f"{metric}_last"]
+
+        return columns
+
+    @staticmethod
+    def _upsert_values(aggregate: SensorReadingAggregate) -> tuple:
+        values = [aggregate.bucket, aggregate.device_id, aggregate.bucket_start, aggregate.count, aggregate.last_ts]
+        for metric in Rollup.metrics:
+            values += [aggregate.counts.get(metric, 0), aggregate.sums.get(metric, 0.0),
+                       aggregate.minimums.get(metric), aggregate.maximums.get(metric), aggregate.lasts.get(metric)]
+
+        return tuple(values)
+
+    @staticmethod
+    def _holds_extremes(removed: SensorReadingAggregate, stored: SensorReadingAggregate) -> bool:
+        # a removed value equal to the stored minimum or maximum, or a removed reading at the last ts
+        if stored.last_ts is None or removed.last_ts >= stored.last_ts:
+            return True
+
+        for metric in Rollup.metrics:
+            if not removed.counts.get(metric):
+                continue
+
+            if stored.minimums[metric] is None or removed.minimums[metric] <= stored.minimums[metric] \
+                    or removed.maximums[metric] >= stored.maximums[metric]:
+                return True
+
+        return False
+
+    @staticmethod
+    def _retract_values(aggregate: SensorReadingAggregate) -> tuple:
+        values = [aggregate.count]
+        for metric in Rollup.metrics:
+            values += [aggregate.counts.get(metric, 0), aggregate.sums.get(metric, 0.0)]
+
+        return tuple(values) + (aggregate.bucket, aggregate.device_id, aggregate.bucket_start)
+
+    @staticmethod
+    def _retract_request() -> str:
+        updates = ["count = count - ?"]
+        for metric in Rollup.metrics:
+            updates += [f"{metric}_count = {metric}_count - ?", f"{metric}_sum = {metric}_sum - ?"]
+
+        return f"""
+            UPDATE {Rollup.table_name} SET {", ".join(updates)}
+            WHERE bucket = ? AND device_id = ? AND bucket_start = ?
+            """
+
+    @staticmethod
+    def _refresh_values(aggregate: SensorReadingAggregate) -> tuple:
+        values = [aggregate.last_ts]
+        for metric in Rollup.metrics:
+            values += [aggregate.minimums.get(metric), aggregate.maximums.get(metric), aggregate.lasts.get(metric)]
+
+        return tuple(values) + (aggregate.bucket, aggregate.device_id, aggregate.bucket_start)
+
+    @staticmethod
+    def _refresh_request() -> str:
+        # count and sums stay as the transactions left them
+        updates = ["last_ts = ?"]
+        for metric in Rollup.metrics:
+            updates += [f"{metric}_min = ?", f"{metric}_max = ?", f"{metric}_last = ?"]
+
+        return f"""
+            UPDATE {Rollup.table_name} SET {", ".join(updates)}
+            WHERE bucket = ? AND device_id = ? AND bucket_start = ?
+            """
+
+    @staticmethod
+    def _upsert_request() -> str:
+        # set expressions read the old row, so last values are compared against the old last_ts
+        updates = ["count = count + excluded.count",
+                   "last_ts = max(last_ts, excluded.last_ts)"]
+        for metric in Rollup.metrics:
+            updates += [
+                f"{metric}_count = {metric}_count + excluded.{metric}_count",
+                f"{metric}_sum = {metric}_sum + excluded.{metric}_sum",
+                f"{metric}_min = coalesce(min({metric}_min, excluded.{metric}_min), {metric}_min, "
+                f"excluded.{metric}_min)",
+                f"{metric}_max = coalesce(max({metric}_max, excluded.{metric}_max), {metric}_max, "
+                f"excluded.{metric}_max)",
+                f"{metric}_last = CASE WHEN excluded.last_ts >= last_ts THEN excluded.{metric}_last "
+                f"ELSE {metric}_last END",
+            ]
+
+        columns = Rollup._columns()
+        return f"""
+            INSERT INTO {Rollup.table_name} ({", ".join(columns)}) VALUES ({", ".join("?" for _ in columns)})
+            ON CONFLICT (bucket, device_id, bucket_start) DO UPDATE SET {", ".join(updates)}
+            """
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,150 @@
+from __future__ import annotations
+
+import time
+import threading
+from typing import List, Dict, Iterable, Tuple
+
+from modules.database.connection.connection import ConnectionManager
+from modules.database.notification_rule.notification_rule import NotificationRule, NotificationRuleFetcher, \
+    DbNotificationRule
+from modules.database.sensor_reading.user_notification import UserNotificationInserter
+
+
+class RuleEngine:
+    # notification rules checked incrementally on ingest: rules are indexed by the devices they watch, so a reading
+    # is only compared with the rules of the users linked to its device. Per (rule, device) the engine keeps
+    # whether the rule fired and when it notified last (hysteresis and cooldown), per device the previous reading
+    # for rise/fall rules; the state lives in the writing process and starts empty after a restart
+    # rules changed by other processes are picked up after reload_interval seconds
+    reload_interval = 60.0
+
+    # device id -> rules watching it
+    _index: Dict[int, List[DbNotificationRule]] = {}
+    _version = None
+    _loaded = 0.0
+    # (rule id, device id) -> (fired, ts of the last notification)
+    _states: Dict[Tuple[int, int], Tuple[bool, int | None]] = {}
+    # device id -> (ts, values) of the last evaluated reading
+    _previous: Dict[int, Tuple[int, dict]] = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def apply(rows: Iterable) -> int:
+        # rows are inserted readings, callers run it in the transaction of the insert; notifications are written
+        # with one insert, the new state is kept after the commit; returns the number of notifications
+        index = RuleEngine._rules()
+        rows = sorted((row for row in rows if row["ts"] is not None and row["device_id"] in index),
+                      key=lambda row: row["ts"])
+
+        if not rows:
+            return 0
+
+        with RuleEngine._lock:
+            states = {}
+            previous = {}
+            notifications = []
+
+            for row in rows:
+                device_id = row["device_id"]
+                last = previous.get(device_id) or RuleEngine._previous.get(device_id)
+                # a late reading would flip rules back to an old state
+                if last is not None and row["ts"] < last[0]:
+                    continue
+
+                for rule in index[device_id]:
+                    key = (rule.id, device_id)
+                    state = states.get(key) or RuleEngine._states.get(key, (False, None))
+                    state, notify = RuleEngine._check(rule, state, row, last)
+                    states[key] = state
+
+                    if notify:
+                        notifications.append(dict(user_id=rule.user_id, value=RuleEngine._message(rule, row, last)))
+
+                previous[device_id] = (row["ts"], {metric: row[metric] for metric in NotificationRule.metrics})
+
+        UserNotificationInserter.insert_many(notifications)
+
+        def keep():
+            with RuleEngine._lock:
+                RuleEngine._states.update(states)
+                RuleEngine._previous.update(previous)
+
+        ConnectionManager.on_commit(keep)
+
+        return len(notifications)
+
+    @staticmethod
+    def reset():
+        with RuleEngine._lock:
+            RuleEngine._index = {}
+            RuleEngine._version = None
+            RuleEngine._states.clear()
+            RuleEngine._previous.clear()
+
+    @staticmethod
+    def _rules() -> Dict[int, List[DbNotificationRule]]:
+        if RuleEngine._version == NotificationRule.version and \
+                time.monotonic() - RuleEngine._loaded < RuleEngine.reload_interval:
+            return RuleEngine._index
+
+        version = NotificationRule.version
+        index = {}
+        for device_id, rule in NotificationRuleFetcher.fetch_by_devices():
+            index.setdefault(device_id, []).append(rule)
+
+        with RuleEngine._lock:
+            RuleEngine._index = index
+            RuleEngine._version = version
+            RuleEngine._loaded = time.monotonic()
+
+        return index
+
+    @staticmethod
+    def _check(rule: DbNotificationRule, state: Tuple[bool, int | None], row, last) -> Tuple[tuple, bool]:
+        # (new state, notify)
+        measure = RuleEngine._measure(rule, row, last)
+        if measure is None:
+            return state, False
+
+        fired, notified = state
+        # distance past the threshold in the direction of the rule
+        excess = rule.threshold - measure if rule.kind == "below" else measure - rule.threshold
+
+        if fired:
+            return (excess >= -rule.hysteresis, notified), False
+
+        if excess <= 0:
+            return state, False
+
+        if notified is not None and row["ts"] - notified < rule.cooldown:
+            return (True, notified), False
+
+        return (True, row["ts"]), True
+
+    @staticmethod
+    def _measure(rule: DbNotificationRule, row, last) -> float | None:
+        value = row[rule.metric]
+        if rule.kind in ("above", "below") or value is None:
+            return value
+
+        if last is None or last[1][rule.metric] is None or row["ts"] == last[0]:
+            return None
+
+        # change per hour in the direction of the rule, thresholds of rise and fall rules are positive
+        change = (value - last[1][rule.metric]) * 3600000 / (row["ts"] - last[0])
+
+        return change if rule.kind == "rise" else -change
+
+    @staticmethod
+    def _message(rule: DbNotificationRule, row, last) -> str:
+        measure = RuleEngine._measure(rule, row, last)
+        if rule.kind in ("above", "below"):
+            return (f"Device {row['device_id']}: {rule.metric} {measure:g} is {rule.kind} {rule.threshold:g} "
+                    f"at {row['datetime']}")
+
+        return (f"Device {row['device_id']}: {rule.metric} {'rises' if rule.kind == 'rise' else 'falls'} "
+                f"{measure:g} per hour at {row['datetime']}, threshold {rule.threshold:g}")
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,206 @@
+from __future__ import annotations
+
+import time
+import atexit
+import threading
+from collections import deque
+from concurrent.futures import Future
+from typing import List, Callable
+
+from modules.database.connection.connection import ConnectionManager
+from modules.database.sensor_reading.sensor_reading import SensorReadingInserter
+from modules.metrics.metrics import Histogram
+
+
+class IngestBufferFullError(Exception):
+    def __str__(self) -> str:
+        return "Ingest buffer is full"
+
+
+class IngestBufferClosedError(Exception):
+    def __str__(self) -> str:
+        return "Ingest buffer is closed"
+
+
+class IngestBuffer:
+    # write-behind group commit: readings from any thread are queued and one writer thread commits them
+    # with a single insert_rows transaction once max_rows are queued or the oldest one waited max_delay_ms;
+    # put returns a Future resolved with the reading id after its commit
+    def __init__(self, max_rows: int = 1000, max_delay_ms: int = 50, capacity: int = 100000,
+                 write: Callable[[List[dict]], List[int]] = SensorReadingInserter.insert_rows):
+        self.max_rows = max_rows
+        self.max_delay = max_delay_ms / 1000
+        self.capacity = capacity
+        self.write = write
+
+        self.batch_sizes = Histogram([1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000])
+        self.commit_latency = Histogram()
+        self.rows_written = 0
+        self.rows_failed = 0
+
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = threading.Condition(self._lock)
+        self._flushed = threading.Condition(self._lock)
+        self._flush_requested = False
+        self._closed = False
+        self._thread = None
+
+    def start(self) -> IngestBuffer:
+        with self._lock:
+            if self._thread is None:
+                self._closed = False
+                self._thread = threading.Thread(target=self._run, name="ingest-buffer", daemon=True)
+                self._thread.start()
+
+                # readings accepted before the interpreter exits are committed
+                atexit.register(self.close)
+
+        return self
+
+    def put(self, reading: dict, timeout: float = None) -> Future:
+        # reading as for SensorReading.insert; blocks while the buffer is full, IngestBufferFullError after timeout
+        return self.put_many([reading], timeout)[0]
+
+    def put_many(self, readings: List[dict], timeout: float = None) -> List[Future]:
+        # invalid readings are rejected here, so a batch never fails because of one of them
+        return self.put_rows([SensorReadingInserter.constructor(**reading) for reading in readings], timeout)
+
+    def put_rows(self, rows: List[dict], timeout: float = None) -> List[Future]:
+        # rows already built by SensorReadingInserter.constructor
+        futures = [Future() for _ in rows]
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        # all readings or none of them are queued
+        if len(rows) > self.capacity:
+            raise IngestBufferFullError
+
+        with self._lock:
+            while len(self._queue) + len(rows) > self.capacity and not self._closed:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise IngestBufferFullError
+
+                self._not_full.wait(remaining)
+
+            if self._closed:
+                raise IngestBufferClosedError
+
+            queued = time.monotonic()
+            self._queue.extend((queued, row, future) for row, future in zip(rows, futures))
+            self._not_empty.notify()
+
+        return futures
+
+    def flush(self, timeout: float = None) -> bool:
+        # commits everything queued so far; False when the timeout passed first
+        with self._lock:
+            if self._thread is None:
+                return not self._queue
+
+            self._flush_requested = True
+            self._not_empty.notify()
+
+            return self._flushed.wait_for(lambda: not self._queue and not self._flush_requested, timeout)
+
+    def close(self, timeout: float = None):
+        # stops accepting readings and waits until the queued ones are committed
+        with self._lock:
+            if self._thread is None:
+                return
+
+            self._closed = True
+            self._not_empty.notify()
+            self._not_full.notify_all()
+            thread = self._thread
+
+        thread.join(timeout)
+
+        with self._lock:
+            if not thread.is_alive():
+                self._thread = None
+
+        atexit.unregister(self.close)
+
+    def __len__(self):
+        return len(self._queue)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def metrics(self) -> dict:
+        return dict(queued=len(self._queue), rows_written=self.rows_written, rows_failed=self.rows_failed,
+                    batch_size=self.batch_sizes.snapshot(), commit_latency=self.commit_latency.snapshot())
+
+    def _run(self):
+        try:
+            while True:
+                batch = self._next_batch()
+                if batch is None:
+                    break
+
+                self._commit(batch)
+
+        finally:
+            ConnectionManager.close()
+
+    def _next_batch(self) -> list | None:
+        with self._lock:
+            while True:
+                if len(self._queue) >= self.max_rows or (self._queue and (self._closed or self._flush_requested)):
+                    break
+
+                if not self._queue:
+                    if self._flush_requested:
+                        self._flush_requested = False
+                        self._flushed.notify_all()
+
+                    if self._closed:
+                        return None
+
+                    self._not_empty.wait()
+                    continue
+
+                remaining = self._queue[0][0] + self.max_delay - time.monotonic()
+                if remaining <= 0:
+                    break
+
+                self._not_empty.wait(remaining)
+
+            batch = [self._queue.popleft() for _ in range(min(self.max_rows, len(self._queue)))]
+            self._not_full.notify_all()
+
+        return batch
+
+    def _commit(self, batch: list):
+        rows = [row for _, row, _ in batch]
+        start = time.perf_counter()
+
+        try:
+            sensor_readings_id = self.write(rows)
+
+        except Exception as error:
+            self.rows_failed += len(batch)
+            for _, _, future in batch:
+                future.set_exception(error)
+
+        else:
+            self.rows_written += len(batch)
+            for (_, _, future), sensor_reading_id in zip(batch, sensor_readings_id):
+                future.set_result(sensor_reading_id)
+
+        self.commit_latency.observe(time.perf_counter() - start)
+        self.batch_sizes.observe(len(batch))
+
+        with self._lock:
+            if not self._queue and self._flush_requested:
+                self._flush_requested = False
+                self._flushed.notify_all()
+
+
+if __name__ == "__main__":
+    pass
@@ -1,9 +1,18 @@
 from __future__ import annotations
 
-from typing import List
+from typing import List, Dict, Iterator, Tuple
 from dataclasses import dataclass
 from datetime import datetime
 from modules.database.database.database import DB
+from modules.database.connection.connection import ConnectionManager
+from modules.database.timestamp.timestamp import Timestamp
+from modules.database.pagination.pagination import Page, PageCursor
+from modules.database.sensor_reading.sensor_reading_batch import SensorReadingBatch
+from modules.database.rollup.rollup import Rollup, SensorReadingAggregate
+from modules.database.aggregation.aggregation import Aggregation
+from modules.database.partition.partition import Partition
+from modules.database.latest_reading.latest_reading import LatestReading
+from modules.database.rule_engine.rule_engine import RuleEngine
 
 
 class SensorReadingNotFoundError(Exception):
@@ -31,16 +40,44 @@ class DbSensorReading:
     pressure: float
     hydration: float
     waterlevel: float
+    ts: int = None
 
 
 class SensorReadingFetcher:
     @staticmethod
     def fetch_all() -> List[DbSensorReading]:
-        return SensorReadingFetcher.constructor(DB.fetch_many(DB.sensor_readings_table_name))
+        return SensorReadingFetcher.constructor(list(Partition.iter_rows()))
 
     @staticmethod
     def fetch_by_id(id: int) -> DbSensorReading:
-        return SensorReadingFetcher.constructor(DB.fetch_one(DB.sensor_readings_table_name, id=id))
+        return SensorReadingFetcher.constructor(Partition.fetch_by_id(id))
+
+    @staticmethod
+    def fetch_between(device_id: int, start: int = None, end: int = None, limit: int = None,
+                      order: str = "asc") -> List[DbSensorReading]:
+        return SensorReadingFetcher.constructor(
+            Partition.fetch_range(start, end, order, limit, device_id=device_id))
+
+    @staticmethod
+    def fetch_page(device_id: int, after: tuple = None, limit: int = 500,
+                   order: str = "asc") -> List[DbSensorReading]:
+        if after is None:
+            # also skips rows without ts, they can not be compared with a cursor
+            after = (-2 ** 63, 0) if order == "asc" else (2 ** 63 - 1, 2 ** 63 - 1)
+
+        return SensorReadingFetcher.constructor(
+            Partition.fetch_page(["ts", "id"], after, limit, order, device_id=device_id)) or []
+
+    @staticmethod
+    def iter_all(chunk_size: int = 1000) -> Iterator[DbSensorReading]:
+        for sensor_reading_info in Partition.iter_rows(chunk_size):
+            yield SensorReadingFetcher.constructor(sensor_reading_info)
+
+    @staticmethod
+    def iter_between(device_id: int, start: int = None, end: int = None,
+                     chunk_size: int = 1000) -> Iterator[DbSensorReading]:
+        for sensor_reading_info in Partition.iter_range(start, end, chunk_size=chunk_size, device_id=device_id):
+            yield SensorReadingFetcher.constructor(sensor_reading_info)
 
     @staticmethod
     def constructor(info) -> DbSensorReading | List[DbSensorReading] | None:
@@ -54,64 +91,142 @@ class SensorReadingFetcher:
             return DbSensorReading(**dict(info))
 
     @staticmethod
-    def fetch_device_sensor_readings(device_id: int) -> List[DbSensorReading]:
-        sensor_readings_id = [info["device_id"] for info in
-                              DB.fetch_many(DB.sensor_readings_table_name, device_id=device_id)]
-        if sensor_readings_id:
-            return [SensorReadingFetcher.fetch_by_id(sensor_reading_id) for sensor_reading_id in sensor_readings_id]
+    def fetch_latest(devices_id: List[int]) -> Dict[int, DbSensorReading]:
+        return {device_id: SensorReadingFetcher.constructor(info)
+                for device_id, info in LatestReading.fetch(devices_id).items()}
 
-        return []
+    @staticmethod
+    def fetch_device_sensor_readings(device_id: int) -> List[DbSensorReading]:
+        return SensorReadingFetcher.fetch_between(device_id) or []
 
 
 class SensorReadingDeleter:
     @staticmethod
     def delete(sensor_reading: DbSensorReading):
-        DB.delete_one(DB.sensor_readings_table_name, id=sensor_reading.id)
+        # the stored row is taken out of the rollups in the transaction of the delete
+        with Partition.attached(Partition.locate(sensor_reading.id)) as table_name, DB.transaction():
+            rows = DB.fetch_many(table_name, id=sensor_reading.id)
+            DB.delete_one(table_name, id=sensor_reading.id)
+            stale = Rollup.retract(rows)
+
+        Rollup.refresh(stale)
+        LatestReading.refresh(sensor_reading.id, [sensor_reading.device_id])
 
 
 class SensorReadingInserter:
     @staticmethod
     def insert(device_id: int, datetime: str, temperature: float, humidity: float, pressure: float, hydration: float,
                waterlevel: float):
-        sensor_reading_id = DB.insert_one(DB.sensor_readings_table_name,
-                                          device_id=device_id,
-                                          datetime=datetime,
-                                          temperature=temperature,
-                                          humidity=humidity,
-                                          pressure=pressure,
-                                          hydration=hydration,
-                                          waterlevel=waterlevel)
+        row = SensorReadingInserter.constructor(device_id=device_id,
+                                                datetime=datetime,
+                                                temperature=temperature,
+                                                humidity=humidity,
+                                                pressure=pressure,
+                                                hydration=hydration,
+                                                waterlevel=waterlevel)
+
+        with DB.transaction():
+            sensor_reading_id = DB.insert_one(DB.sensor_readings_table_name, **row)
+            Rollup.apply([row])
+            LatestReading.apply([dict(row, id=sensor_reading_id)])
+            RuleEngine.apply([row])
+            SensorReadingInserter._route([row])
+
         return sensor_reading_id
 
+    @staticmethod
+    def insert_many(sensor_readings: List[dict]) -> List[int]:
+        return SensorReadingInserter.insert_rows([SensorReadingInserter.constructor(**sensor_reading)
+                                                  for sensor_reading in sensor_readings])
+
+    @staticmethod
+    def insert_rows(rows: List[dict]) -> List[int]:
+        # rows built by constructor; readings and their rollups are written in one transaction
+        with DB.transaction():
+            sensor_readings_id = DB.insert_many(DB.sensor_readings_table_name, rows)
+            Rollup.apply(rows)
+            LatestReading.apply(dict(row, id=sensor_reading_id)
+                                for row, sensor_reading_id in zip(rows, sensor_readings_id))
+            RuleEngine.apply(rows)
+            SensorReadingInserter._route(rows)
+
+        return sensor_readings_id
+
+    @staticmethod
+    def _route(rows: List[dict]):
+        # readings always land in the hot table, late ones of sealed months are moved to their partition
+        # right after the commit; a failed move leaves them in the hot table for the next relocate
+        boundary = Partition.boundary()
+        if any(Partition.target(row["ts"], boundary) for row in rows):
+            ConnectionManager.on_commit(Partition.relocate)
+
+    @staticmethod
+    def constructor(device_id: int, datetime: str, temperature: float, humidity: float, pressure: float,
+                    hydration: float, waterlevel: float, ts: int = None) -> dict:
+        # ts in ms when the source has it, datetime keeps whole seconds
+        return dict(device_id=device_id,
+                    datetime=datetime,
+                    temperature=temperature,
+                    humidity=humidity,
+                    pressure=pressure,
+                    hydration=hydration,
+                    waterlevel=waterlevel,
+                    ts=Timestamp.from_datetime_string(datetime) if ts is None else ts)
+
 
 class SensorReadingUpdater:
     @staticmethod
     def update_device_id(sensor_reading: DbSensorReading, device_id: int):
-        DB.update_one(DB.sensor_readings_table_name, dict(id=sensor_reading.id), dict(device_id=device_id))
+        SensorReadingUpdater._update(sensor_reading, device_id=device_id)
 
     @staticmethod
     def update_datetime(sensor_reading: DbSensorReading, datetime: str):
-        DB.update_one(DB.sensor_readings_table_name, dict(id=sensor_reading.id), dict(datetime=datetime))
+        ts = Timestamp.from_datetime_string(datetime)
+        month = SensorReadingUpdater._update(sensor_reading, datetime=datetime, ts=ts)
+
+        Partition.move(sensor_reading.id, month, Partition.target(ts, Partition.boundary()))
+        LatestReading.refresh(sensor_reading.id, [sensor_reading.device_id])
 
     @staticmethod
     def update_temperature(sensor_reading: DbSensorReading, temperature: float):
-        DB.update_one(DB.sensor_readings_table_name, dict(id=sensor_reading.id), dict(temperature=temperature))
+        SensorReadingUpdater._update(sensor_reading, temperature=temperature)
 
     @staticmethod
     def update_humidity(sensor_reading: DbSensorReading, humidity: float):
-        DB.update_one(DB.sensor_readings_table_name, dict(id=sensor_reading.id), dict(humidity=humidity))
+        SensorReadingUpdater._update(sensor_reading, humidity=humidity)
 
     @staticmethod
     def update_pressure(sensor_reading: DbSensorReading, pressure: float):
-        DB.update_one(DB.sensor_readings_table_name, dict(id=sensor_reading.id), dict(pressure=pressure))
+        SensorReadingUpdater._update(sensor_reading, pressure=pressure)
 
     @staticmethod
     def update_hydration(sensor_reading: DbSensorReading, hydration: float):
-        DB.update_one(DB.sensor_readings_table_name, dict(id=sensor_reading.id), dict(hydration=hydration))
+        SensorReadingUpdater._update(sensor_reading, hydration=hydration)
 
     @staticmethod
     def update_waterlevel(sensor_reading: DbSensorReading, waterlevel: float):
-        DB.update_one(DB.sensor_readings_table_name, dict(id=sensor_reading.id), dict(waterlevel=waterlevel))
+        SensorReadingUpdater._update(sensor_reading, waterlevel=waterlevel)
+
+    @staticmethod
+    def _update(sensor_reading: DbSensorReading, **new_values) -> str | None:
+        # updates the reading where it is stored, returns the month of its partition
+        month = Partition.locate(sensor_reading.id)
+
+        # the old row leaves the rollups and the new one enters them in the transaction of the update
+        with Partition.attached(month) as table_name, DB.transaction():
+            rows = DB.fetch_many(table_name, id=sensor_reading.id)
+            DB.update_one(table_name, dict(id=sensor_reading.id), new_values)
+            stale = Rollup.retract(rows)
+            Rollup.apply(dict(row, **new_values) for row in rows)
+
+        Rollup.refresh(stale)
+
+        # a new ts is only known after the reading moved to its partition, update_datetime refreshes then
+        if "ts" not in new_values:
+            LatestReading.refresh(sensor_reading.id,
+                                  [sensor_reading.device_id, new_values.get("device_id", sensor_reading.device_id)])
+
+        return month
 
 
 class SensorReading:
@@ -149,9 +264,14 @@ class SensorReading:
     def datetime(self):
         return self._sensor_reading.datetime
 
+    @property
+    def ts(self) -> int:
+        return self._sensor_reading.ts
+
     @datetime.setter
     def datetime(self, datetime: str):
         self._sensor_reading.datetime = datetime
+        self._sensor_reading.ts = Timestamp.from_datetime_string(datetime)
 
     @property
     def temperature(self):
@@ -202,6 +322,53 @@ class SensorReading:
 
         return []
 
+    @staticmethod
+    def page(device_id: int, after: str | tuple = None, limit: int = 500, order: str = "asc") -> Page[SensorReading]:
+        # after is the next_cursor of the previous page (or a (ts, id) tuple), None for the first page
+        sensor_readings = SensorReadingFetcher.fetch_page(device_id, PageCursor.decode(after, 2), limit + 1, order)
+
+        items = [SensorReading(db_sensor_reading=sensor_reading_info)
+                 for sensor_reading_info in sensor_readings[:limit]]
+        next_cursor = PageCursor.encode((items[-1].ts, items[-1].id)) if len(sensor_readings) > limit else None
+
+        return Page(items, next_cursor)
+
+    @staticmethod
+    def columns(device_id: int, start=None, end=None) -> SensorReadingBatch:
+        # columnar history for analytics, no SensorReading objects are created
+        return SensorReadingBatch.load(device_id, Timestamp.convert(start), Timestamp.convert(end))
+
+    @staticmethod
+    def from_batch(batch: SensorReadingBatch) -> List[SensorReading]:
+        return [SensorReading(db_sensor_reading=DbSensorReading(**row)) for row in batch.to_rows()]
+
+    @staticmethod
+    def aggregate(device_id: int, bucket: str = "1h", start=None, end=None) -> List[SensorReadingAggregate]:
+        # per bucket count/sum/min/max/last of every metric, bucket is "1m", "1h" or "1d"
+        return Rollup.aggregate(device_id, bucket, Timestamp.convert(start), Timestamp.convert(end))
+
+    @staticmethod
+    def statistics(aggregations: List[str], group_by: List[str] = None, bucket: str | int = None, start=None,
+                   end=None, devices_id: List[int] = None,
+                   filters: List[Tuple[str, str, float]] = None) -> List[dict]:
+        # ad-hoc statistics computed by SQLite in one GROUP BY query, e.g.
+        # statistics(["avg(temperature)", "max(temperature)"], group_by=["device_id"], start=..., end=...)
+        # statistics(["count(*)"], filters=[("waterlevel", "<", 0.2)])
+        return Aggregation.run(aggregations, group_by, bucket, Timestamp.convert(start), Timestamp.convert(end),
+                               devices_id, filters)
+
+    @staticmethod
+    def iter_all(chunk_size: int = 1000) -> Iterator[SensorReading]:
+        # lazy counterpart of all() for large tables, memory is bounded by chunk_size
+        for sensor_reading_info in SensorReadingFetcher.iter_all(chunk_size):
+            yield SensorReading(db_sensor_reading=sensor_reading_info)
+
+    @staticmethod
+    def iter_by_device(device_id: int, start=None, end=None, chunk_size: int = 1000) -> Iterator[SensorReading]:
+        for sensor_reading_info in SensorReadingFetcher.iter_between(device_id, Timestamp.convert(start),
+                                                                     Timestamp.convert(end), chunk_size):
+            yield SensorReading(db_sensor_reading=sensor_reading_info)
+
     @staticmethod
     def by_device(device_id: int):
         sensor_readings = SensorReadingFetcher.fetch_device_sensor_readings(device_id=device_id)
@@ -210,6 +377,27 @@ class SensorReading:
 
         return []
 
+    @staticmethod
+    def between(device_id: int, start, end, limit: int = None, order: str = "asc") -> List[SensorReading]:
+        # start <= ts < end; bounds are epoch ms, datetime or "%d.%m.%Y %H:%M:%S" strings, None is unbounded
+        sensor_readings = SensorReadingFetcher.fetch_between(device_id, Timestamp.convert(start),
+                                                             Timestamp.convert(end), limit, order)
+        if sensor_readings:
+            return [SensorReading(db_sensor_reading=sensor_reading_info) for sensor_reading_info in sensor_readings]
+
+        return []
+
+    @staticmethod
+    def latest(device_id: int, n: int = 1) -> List[SensorReading]:
+        # newest first
+        return SensorReading.between(device_id, None, None, limit=n, order="desc")
+
+    @staticmethod
+    def latest_by_devices(devices_id: List[int]) -> Dict[int, SensorReading]:
+        # current values of many devices in one query, devices without readings are missing
+        return {device_id: SensorReading(db_sensor_reading=sensor_reading_info)
+                for device_id, sensor_reading_info in SensorReadingFetcher.fetch_latest(devices_id).items()}
+
     @staticmethod
     def insert(device_id: int, datetime: str, temperature: float, humidity: float, pressure: float, hydration: float,
                waterlevel: float) -> SensorReading:
@@ -227,6 +415,15 @@ class SensorReading:
 
         return SensorReading(id=sensor_reading_id)
 
+    @staticmethod
+    def insert_many(sensor_readings: List[dict]) -> List[SensorReading]:
+        # one transaction for the whole batch, objects are built from the input without fetching rows back
+        rows = [SensorReadingInserter.constructor(**sensor_reading) for sensor_reading in sensor_readings]
+        sensor_readings_id = SensorReadingInserter.insert_rows(rows)
+
+        return [SensorReading(db_sensor_reading=DbSensorReading(id=sensor_reading_id, **row))
+                for sensor_reading_id, row in zip(sensor_readings_id, rows)]
+
     def delete(self):
         SensorReadingDeleter.delete(self._sensor_reading)
 
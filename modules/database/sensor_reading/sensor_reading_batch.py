@@ -0,0 +1,315 @@
+from __future__ import annotations
+
+import math
+from array import array
+from typing import List, Dict, Iterable
+
+from modules.database.partition.partition import Partition
+from modules.database.rollup.rollup import Rollup
+from modules.database.timestamp.timestamp import Timestamp
+
+try:
+    import numpy as np
+
+except ImportError:
+    np = None
+
+
+class InvalidSensorReadingBatchArgumentsError(Exception):
+    def __str__(self) -> str:
+        return "Invalid sensor reading batch arguments"
+
+
+class SensorReadingBatch:
+    # columnar readings of one device: int64 id/device_id/ts and float64 measurements,
+    # numpy arrays when numpy is installed, array("q")/array("d") otherwise
+    metrics = ["temperature", "humidity", "pressure", "hydration", "waterlevel"]
+    int_columns = ["id", "device_id", "ts"]
+    aggregations = ["mean", "min", "max", "sum", "count", "last"]
+
+    def __init__(self, columns: Dict[str, Iterable]):
+        self._columns = {}
+
+        for column in SensorReadingBatch.int_columns:
+            if columns.get(column) is not None:
+                self._columns[column] = SensorReadingBatch._int_array(columns[column])
+
+        for column in SensorReadingBatch.metrics:
+            self._columns[column] = SensorReadingBatch._float_array(columns.get(column, []))
+
+        if "ts" not in self._columns or any(len(values) != len(self._columns["ts"])
+                                            for values in self._columns.values()):
+            raise InvalidSensorReadingBatchArgumentsError
+
+    @staticmethod
+    def load(device_id: int, start: int = None, end: int = None, chunk_size: int = 10000) -> SensorReadingBatch:
+        columns = SensorReadingBatch.int_columns + SensorReadingBatch.metrics
+        chunks = {column: [] for column in columns}
+
+        if start is None:
+            # readings without ts can not be placed on the time axis
+            start = -2 ** 63
+
+        for chunk in Partition.iter_column_chunks(columns, start, end, chunk_size=chunk_size, device_id=device_id):
+            for column, values in zip(columns, chunk):
+                chunks[column].append(values)
+
+        return SensorReadingBatch({column: SensorReadingBatch._concatenate(column, values)
+                                   for column, values in chunks.items()})
+
+    @staticmethod
+    def from_db_sensor_readings(sensor_readings: Iterable) -> SensorReadingBatch:
+        sensor_readings = list(sensor_readings)
+        columns = SensorReadingBatch.int_columns + SensorReadingBatch.metrics
+
+        return SensorReadingBatch({column: [getattr(sensor_reading, column) for sensor_reading in sensor_readings]
+                                   for column in columns})
+
+    def to_rows(self) -> List[dict]:
+        # rows in the shape of DbSensorReading fields, for small results
+        columns = [column for column in SensorReadingBatch.int_columns if column in self._columns]
+        columns += SensorReadingBatch.metrics
+
+        rows = []
+        for values in zip(*(self._columns[column] for column in columns)):
+            row = {column: SensorReadingBatch._python_value(value) for column, value in zip(columns, values)}
+            row["datetime"] = Timestamp.to_datetime_string(row["ts"])
+            rows.append(row)
+
+        return rows
+
+    def __len__(self):
+        return len(self._columns["ts"])
+
+    def __getitem__(self, column: str):
+        return self._columns[column]
+
+    @property
+    def id(self):
+        return self._columns.get("id")
+
+    @property
+    def device_id(self):
+        return self._columns.get("device_id")
+
+    @property
+    def ts(self):
+        return self._columns["ts"]
+
+    @property
+    def temperature(self):
+        return self._columns["temperature"]
+
+    @property
+    def humidity(self):
+        return self._columns["humidity"]
+
+    @property
+    def pressure(self):
+        return self._columns["pressure"]
+
+    @property
+    def hydration(self):
+        return self._columns["hydration"]
+
+    @property
+    def waterlevel(self):
+        return self._columns["waterlevel"]
+
+    # missing measurements are NaN and are skipped by all statistics
+
+    def min(self, metric: str) -> float:
+        values = self._metric(metric)
+
+        if np is not None:
+            return float(np.nanmin(values)) if self._has_values(values) else math.nan
+
+        values = SensorReadingBatch._present(values)
+        return min(values) if values else math.nan
+
+    def max(self, metric: str) -> float:
+        values = self._metric(metric)
+
+        if np is not None:
+            return float(np.nanmax(values)) if self._has_values(values) else math.nan
+
+        values = SensorReadingBatch._present(values)
+        return max(values) if values else math.nan
+
+    def mean(self, metric: str) -> float:
+        values = self._metric(metric)
+
+        if np is not None:
+            return float(np.nanmean(values)) if self._has_values(values) else math.nan
+
+        values = SensorReadingBatch._present(values)
+        return math.fsum(values) / len(values) if values else math.nan
+
+    def std(self, metric: str) -> float:
+        # population standard deviation, as numpy.std
+        values = self._metric(metric)
+
+        if np is not None:
+            return float(np.nanstd(values)) if self._has_values(values) else math.nan
+
+        values = SensorReadingBatch._present(values)
+        if not values:
+            return math.nan
+
+        mean = math.fsum(values) / len(values)
+        return math.sqrt(math.fsum((value - mean) ** 2 for value in values) / len(values))
+
+    def resample(self, bucket_ms: int, how: str = "mean") -> SensorReadingBatch:
+        # one row per non-empty bucket, ts is the bucket start; readings are expected ordered by ts;
+        # buckets are aligned as the rollups, so days start at local midnight
+        if how not in SensorReadingBatch.aggregations or bucket_ms <= 0:
+            raise InvalidSensorReadingBatchArgumentsError
+
+        if np is not None:
+            return self._resample_numpy(bucket_ms, how)
+
+        return self._resample_python(bucket_ms, how)
+
+    def _resample_numpy(self, bucket_ms: int, how: str) -> SensorReadingBatch:
+        if not len(self):
+            return SensorReadingBatch({"ts": []})
+
+        buckets = (self.ts + Rollup.offset) // bucket_ms
+        starts = np.concatenate(([0], np.flatnonzero(np.diff(buckets)) + 1))
+        ends = np.concatenate((starts[1:], [len(buckets)]))
+
+        columns = {"ts": buckets[starts] * bucket_ms - Rollup.offset}
+        for metric in SensorReadingBatch.metrics:
+            values = self._columns[metric]
+            present = ~np.isnan(values)
+            counts = np.add.reduceat(present.astype(np.int64), starts)
+
+            if how == "count":
+                columns[metric] = counts.astype(np.float64)
+
+            elif how == "min":
+                columns[metric] = np.fmin.reduceat(values, starts)
+
+            elif how == "max":
+                columns[metric] = np.fmax.reduceat(values, starts)
+
+            elif how == "last":
+                columns[metric] = values[ends - 1]
+
+            else:
+                sums = np.add.reduceat(np.where(present, values, 0.0), starts)
+
+                if how == "sum":
+                    columns[metric] = sums
+
+                else:
+                    with np.errstate(invalid="ignore", divide="ignore"):
+                        columns[metric] = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+
+        return SensorReadingBatch(columns)
+
+    def _resample_python(self, bucket_ms: int, how: str) -> SensorReadingBatch:
+        columns = {column: [] for column in ["ts"] + SensorReadingBatch.metrics}
+
+        start = 0
+        ts = self.ts
+        while start < len(ts):
+            bucket = (ts[start] + Rollup.offset) // bucket_ms
+            end = start
+            while end < len(ts) and (ts[end] + Rollup.offset) // bucket_ms == bucket:
+                end += 1
+
+            columns["ts"].append(bucket * bucket_ms - Rollup.offset)
+            for metric in SensorReadingBatch.metrics:
+                bucket_values = self._columns[metric][start:end]
+                present = SensorReadingBatch._present(bucket_values)
+
+                if how == "count":
+                    value = float(len(present))
+
+                elif how == "sum":
+                    value = math.fsum(present)
+
+                elif how == "last":
+                    value = bucket_values[-1]
+
+                elif not present:
+                    value = math.nan
+
+                elif how == "min":
+                    value = min(present)
+
+                elif how == "max":
+                    value = max(present)
+
+                else:
+                    value = math.fsum(present) / len(present)
+
+                columns[metric].append(value)
+
+            start = end
+
+        return SensorReadingBatch(columns)
+
+    def _metric(self, metric: str):
+        if metric not in SensorReadingBatch.metrics:
+            raise InvalidSensorReadingBatchArgumentsError
+
+        return self._columns[metric]
+
+    @staticmethod
+    def _has_values(values) -> bool:
+        return bool(len(values)) and not np.isnan(values).all()
+
+    @staticmethod
+    def _present(values) -> list:
+        return [value for value in values if value == value]
+
+    @staticmethod
+    def _concatenate(column: str, chunks: list):
+        if np is not None:
+            dtype = np.int64 if column in SensorReadingBatch.int_columns else np.float64
+            return np.concatenate([SensorReadingBatch._numpy_array(chunk, dtype) for chunk in chunks]) \
+                if chunks else np.empty(0, dtype=dtype)
+
+        result = array("q") if column in SensorReadingBatch.int_columns else array("d")
+        for chunk in chunks:
+            result.extend(SensorReadingBatch._without_none(chunk, column in SensorReadingBatch.int_columns))
+
+        return result
+
+    @staticmethod
+    def _numpy_array(values, dtype):
+        if None in values:
+            values = SensorReadingBatch._without_none(values, dtype == np.int64)
+
+        return np.asarray(values, dtype=dtype)
+
+    @staticmethod
+    def _without_none(values, integer: bool):
+        if None not in values:
+            return values
+
+        return [(0 if integer else math.nan) if value is None else value for value in values]
+
+    @staticmethod
+    def _int_array(values):
+        if np is not None:
+            return values if isinstance(values, np.ndarray) and values.dtype == np.int64 \
+                else SensorReadingBatch._numpy_array(list(values), np.int64)
+
+        return values if isinstance(values, array) and values.typecode == "q" \
+            else array("q", SensorReadingBatch._without_none(list(values), True))
+
+    @staticmethod
+    def _float_array(values):
+        if np is not None:
+            return values if isinstance(values, np.ndarray) and values.dtype == np.float64 \
+                else SensorReadingBatch._numpy_array(list(values), np.float64)
+
+        return values if isinstance(values, array) and values.typecode == "d" \
+            else array("d", SensorReadingBatch._without_none(list(values), False))
+
+    @staticmethod
+    def _python_value(value):
+        return value.item() if hasattr(value, "item") else value
@@ -3,6 +3,7 @@ from __future__ import annotations
 from typing import List
 from dataclasses import dataclass
 from modules.database.database.database import DB
+from modules.database.timestamp.timestamp import Timestamp
 
 
 
@@ -21,6 +22,11 @@ class DbUserNotification:
     id: int
     user_id: int
     value: str
+    created_at: int | None = None
+    # worker holding the notification and since when, a lease older than the claim lease is free again
+    claimed_by: str | None = None
+    claimed_at: int | None = None
+    delivered_at: int | None = None
 
 
 class UserNotificationFetcher:
@@ -36,6 +42,11 @@ class UserNotificationFetcher:
     def fetch_by_user_id(user_id: int) -> List[DbUserNotification] | None:
         return UserNotificationFetcher.constructor(DB.fetch_many(DB.users_notifications_table_name, user_id=user_id))
 
+    @staticmethod
+    def fetch_page(user_id: int, after: tuple = None, limit: int = 500) -> List[DbUserNotification]:
+        return UserNotificationFetcher.constructor(
+            DB.fetch_page(DB.users_notifications_table_name, ["id"], after, limit, user_id=user_id)) or []
+
     @staticmethod
     def constructor(info):
         if not info:
@@ -45,13 +56,23 @@ class UserNotificationFetcher:
             return [UserNotificationFetcher.constructor(notification_info) for notification_info in info]
 
         else:
-            return DbUserNotification(id=info["id"],user_id=info["user_id"], value=info["value"])
+            return DbUserNotification(**dict(info))
 
 
 class UserNotificationInserter:
     @staticmethod
     def insert(user_id: int, value: str):
-        DB.insert_one(DB.users_notifications_table_name, user_id=user_id, value=value)
+        return DB.insert_one(DB.users_notifications_table_name, user_id=user_id, value=value,
+                             created_at=Timestamp.now())
+
+    @staticmethod
+    def insert_many(notifications: List[dict]) -> List[int]:
+        created_at = Timestamp.now()
+
+        return DB.insert_many(DB.users_notifications_table_name,
+                              [dict(user_id=notification["user_id"], value=notification["value"],
+                                    created_at=created_at)
+                               for notification in notifications])
 
 
 class UserNotificationDeleter:
@@ -59,10 +80,89 @@ class UserNotificationDeleter:
     def delete(notification: DbUserNotification):
         DB.delete_one(DB.users_notifications_table_name, id=notification.id)
 
+    @staticmethod
+    def delete_many(notifications: List[DbUserNotification]):
+        if notifications:
+            DB.delete_one(DB.users_notifications_table_name, id=[notification.id for notification in notifications])
+
     @staticmethod
     def delete_by_user_id(user_id: int):
         DB.delete_one(DB.users_notifications_table_name, user_id=user_id)
 
+    @staticmethod
+    def delete_delivered(before: int) -> int:
+        with DB.transaction() as conn:
+            return conn.execute(f"""
+                DELETE FROM {DB.users_notifications_table_name} WHERE delivered_at < ?
+                """, (before,)).rowcount
+
+
+class UserNotificationDelivery:
+    # pending notifications are claimed by one worker at a time: one UPDATE ... WHERE id IN (SELECT ...) RETURNING
+    # statement, so parallel workers never get the same row. Users with notifications claimed by another worker are
+    # skipped until these are delivered or their lease ran out, so each user gets notifications in id order
+    @staticmethod
+    def claim(users_id: List[int] | None, limit: int, worker: str, lease: int = 60000) -> List[DbUserNotification]:
+        # up to limit pending notifications of users_id (None - of every user), oldest first
+        now = Timestamp.now()
+        users_condition = f"AND user_id IN ({', '.join('?' for _ in users_id)})" if users_id is not None else ""
+
+        with DB.transaction() as conn:
+            rows = conn.execute(f"""
+                UPDATE {DB.users_notifications_table_name} SET claimed_by = ?, claimed_at = ?
+                WHERE id IN (
+                    SELECT id FROM {DB.users_notifications_table_name}
+                    WHERE delivered_at IS NULL {users_condition}
+                      AND (claimed_at IS NULL OR claimed_at < ? OR claimed_by = ?)
+                      AND user_id NOT IN (
+                          SELECT user_id FROM {DB.users_notifications_table_name}
+                          WHERE delivered_at IS NULL AND claimed_at >= ? AND claimed_by != ?)
+                    ORDER BY id
+                    LIMIT ?)
+                RETURNING *
+                """, (worker, now, *(users_id or []), now - lease, worker, now - lease, worker, limit)).fetchall()
+
+        return sorted(UserNotificationFetcher.constructor(rows) or [], key=lambda notification: notification.id)
+
+    @staticmethod
+    def drain(users_id: List[int] | None, limit: int) -> List[DbUserNotification]:
+        # claim and delete in one statement, for consumers that do not need delivery state
+        users_condition = f"AND user_id IN ({', '.join('?' for _ in users_id)})" if users_id is not None else ""
+
+        with DB.transaction() as conn:
+            rows = conn.execute(f"""
+                DELETE FROM {DB.users_notifications_table_name}
+                WHERE id IN (
+                    SELECT id FROM {DB.users_notifications_table_name}
+                    WHERE delivered_at IS NULL AND claimed_at IS NULL {users_condition}
+                    ORDER BY id
+                    LIMIT ?)
+                RETURNING *
+                """, (*(users_id or []), limit)).fetchall()
+
+        return sorted(UserNotificationFetcher.constructor(rows) or [], key=lambda notification: notification.id)
+
+    @staticmethod
+    def delivered(notifications: List[DbUserNotification], worker: str) -> int:
+        # only notifications still claimed by worker are marked, returns their number
+        return UserNotificationDelivery._finish(notifications, worker, "delivered_at = ?", (Timestamp.now(),))
+
+    @staticmethod
+    def release(notifications: List[DbUserNotification], worker: str) -> int:
+        # delivery failed, the notifications are pending again
+        return UserNotificationDelivery._finish(notifications, worker, "claimed_by = NULL, claimed_at = NULL", ())
+
+    @staticmethod
+    def _finish(notifications: List[DbUserNotification], worker: str, set_request: str, values: tuple) -> int:
+        if not notifications:
+            return 0
+
+        with DB.transaction() as conn:
+            return conn.execute(f"""
+                UPDATE {DB.users_notifications_table_name} SET {set_request}
+                WHERE id IN ({', '.join('?' for _ in notifications)}) AND claimed_by = ? AND delivered_at IS NULL
+                """, (*values, *(notification.id for notification in notifications), worker)).rowcount
+
 
 class UserNotification:
     _user_notification: DbUserNotification
@@ -88,10 +188,26 @@ class UserNotification:
     def id(self) -> int:
         return self._user_notification.id
 
+    @property
+    def user_id(self) -> int:
+        return self._user_notification.user_id
+
+    @property
+    def created_at(self) -> int | None:
+        return self._user_notification.created_at
+
+    @property
+    def delivered_at(self) -> int | None:
+        return self._user_notification.delivered_at
+
     @staticmethod
     def insert(user_id: int, value: str):
         UserNotificationInserter.insert(user_id, value)
 
+    @staticmethod
+    def insert_many(notifications: List[dict]) -> List[int]:
+        return UserNotificationInserter.insert_many(notifications)
+
     def delete(self):
         UserNotificationDeleter.delete(self._user_notification)
 
@@ -113,6 +229,37 @@ class UserNotification:
 
         return []
 
+    @staticmethod
+    def page(user_id: int, after: int = None, limit: int = 500) -> List[UserNotification]:
+        # oldest first, after is the id of the last notification of the previous page
+        return [UserNotification(db_user_notification=notification) for notification in
+                UserNotificationFetcher.fetch_page(user_id, None if after is None else (after,), limit)]
+
+    @staticmethod
+    def claim(users_id: List[int] | None, limit: int, worker: str, lease: int = 60000) -> List[UserNotification]:
+        # delivery workers: claim, send, then delivered() or release(); lease in ms
+        return [UserNotification(db_user_notification=notification)
+                for notification in UserNotificationDelivery.claim(users_id, limit, worker, lease)]
+
+    @staticmethod
+    def drain(users_id: List[int] | None, limit: int) -> List[UserNotification]:
+        return [UserNotification(db_user_notification=notification)
+                for notification in UserNotificationDelivery.drain(users_id, limit)]
+
+    @staticmethod
+    def delivered(notifications: List[UserNotification], worker: str) -> int:
+        return UserNotificationDelivery.delivered([notification._user_notification
+                                                   for notification in notifications], worker)
+
+    @staticmethod
+    def release(notifications: List[UserNotification], worker: str) -> int:
+        return UserNotificationDelivery.release([notification._user_notification
+                                                 for notification in notifications], worker)
+
+    @staticmethod
+    def delete_delivered(before) -> int:
+        return UserNotificationDeleter.delete_delivered(Timestamp.convert(before))
+
     @staticmethod
     def delete_user_notifications(user_id: int):
         UserNotificationDeleter.delete_by_user_id(user_id)
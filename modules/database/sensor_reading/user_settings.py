@@ -2,6 +2,7 @@ from __future__ import annotations
 from typing import List
 from dataclasses import dataclass
 from modules.database.database.database import DB
+from modules.database.notification_rule.notification_rule import NotificationRule
 
 
 @dataclass
@@ -38,6 +39,7 @@ class UserSettingsDeleter:
     @staticmethod
     def delete(user_settings: DbUserSettings):
         DB.delete_one(DB.users_settings_table_name, user_id=user_settings.user_id)
+        NotificationRule.changed()
 
 
 class UserSettingsUpdater:
@@ -47,10 +49,12 @@ class UserSettingsUpdater:
                       dict(id=user_settings.id),
                       dict(notifications=int(user_settings.notifications))
                       )
+        NotificationRule.changed()
 
     @staticmethod
     def update_notifications(user_settings: DbUserSettings, notifications: int):
         DB.update_one(DB.users_settings_table_name, dict(id=user_settings.id), dict(notifications=notifications))
+        NotificationRule.changed()
 
     @staticmethod
     def update_mode(user_settings: DbUserSettings, mode: str):
@@ -91,7 +95,7 @@ class UserSettings:
                 raise InvalidUserSettingsArgumentsError
 
         if "db_user_settings" in kwargs:
-            _user_settings = kwargs["db_user_settings"]
+            self._user_settings = kwargs["db_user_settings"]
 
         elif "id" in kwargs:
             self._user_settings = UserSettingsFetcher.fetch_by_id(kwargs["id"])
@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import datetime as dt
+
+from modules.config.config import datetime_format, timezone
+
+
+class InvalidTimestampError(Exception):
+    def __init__(self, value=None):
+        self.value = value
+
+    def __str__(self) -> str:
+        return f"Invalid timestamp: {self.value!r}"
+
+
+class Timestamp:
+    # sensor readings are ordered and range-scanned by integer epoch milliseconds
+
+    @staticmethod
+    def from_datetime_string(datetime: str) -> int:
+        try:
+            value = dt.datetime.strptime(datetime, datetime_format)
+
+        except (TypeError, ValueError):
+            raise InvalidTimestampError(datetime)
+
+        return Timestamp.from_datetime(value)
+
+    @staticmethod
+    def from_datetime(datetime: dt.datetime) -> int:
+        if datetime.tzinfo is None:
+            datetime = datetime.replace(tzinfo=timezone)
+
+        return int(datetime.timestamp() * 1000)
+
+    @staticmethod
+    def to_datetime(ts: int) -> dt.datetime:
+        return dt.datetime.fromtimestamp(ts / 1000, tz=timezone)
+
+    @staticmethod
+    def to_datetime_string(ts: int) -> str:
+        return Timestamp.to_datetime(ts).strftime(datetime_format)
+
+    @staticmethod
+    def now() -> int:
+        return Timestamp.from_datetime(dt.datetime.now(tz=timezone))
+
+    @staticmethod
+    def convert(value: int | str | dt.datetime | None) -> int | None:
+        # bounds of range queries may be given as ms, datetime string or datetime
+        if value is None:
+            return None
+
+        if isinstance(value, dt.datetime):
+            return Timestamp.from_datetime(value)
+
+        if isinstance(value, str):
+            return Timestamp.from_datetime_string(value)
+
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            return int(value)
+
+        raise InvalidTimestampError(value)
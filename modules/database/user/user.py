@@ -1,9 +1,14 @@
 from __future__ import annotations
 
-from typing import List
+import sqlite3
+from typing import List, Dict, Tuple
 from dataclasses import dataclass
 from modules.database.database.database import DB
+from modules.database.identity_map.identity_map import IdentityMap
+from modules.database.notification_rule.notification_rule import NotificationRule, NotificationRuleDeleter
 from modules.database.device.device import Device
+from modules.database.sensor_reading.sensor_reading import SensorReading
+from modules.database.pagination.pagination import Page, PageCursor
 
 
 class UserNotFoundError(Exception):
@@ -30,17 +35,22 @@ class DbUser:
 
 
 class UserFetcher:
+    # login is not unique, only id and email lookups are cached
+    identity_map = IdentityMap("users", ["email"])
+
     @staticmethod
     def fetch_all() -> List[DbUser]:
         return UserFetcher.constructor(DB.fetch_many(DB.users_table_name))
 
     @staticmethod
     def fetch_by_id(id: int) -> DbUser:
-        return UserFetcher.constructor(DB.fetch_one(DB.users_table_name, id=id))
+        return UserFetcher.identity_map.fetch(
+            "id", id, lambda: UserFetcher.constructor(DB.fetch_one(DB.users_table_name, id=id)))
 
     @staticmethod
     def fetch_by_email(email: str):
-        return UserFetcher.constructor(DB.fetch_one(DB.users_table_name, email=email))
+        return UserFetcher.identity_map.fetch(
+            "email", email, lambda: UserFetcher.constructor(DB.fetch_one(DB.users_table_name, email=email)))
 
     @staticmethod
     def fetch_by_login(login: str) -> DbUser:
@@ -48,11 +58,20 @@ class UserFetcher:
 
     @staticmethod
     def fetch_by_device_id(device_id: int) -> List[DbUser]:
-        users_id = [info["user_id"] for info in DB.fetch_many(DB.users_devices_table_name, device_id=device_id)]
-        if users_id:
-            return [UserFetcher.fetch_by_id(id) for id in users_id]
+        return UserFetcher.fetch_by_devices_id([device_id]).get(device_id, [])
 
-        return []
+    @staticmethod
+    def fetch_by_devices_id(devices_id: List[int]) -> Dict[int, List[DbUser]]:
+        devices_users = {device_id: [] for device_id in devices_id}
+        for device_id, user_info in DB.fetch_linked(DB.users_table_name, DB.users_devices_table_name,
+                                                    "user_id", "device_id", list(devices_users)):
+            devices_users[device_id].append(UserFetcher.constructor(user_info))
+
+        return devices_users
+
+    @staticmethod
+    def fetch_page(after: tuple = None, limit: int = 500) -> List[DbUser]:
+        return UserFetcher.constructor(DB.fetch_page(DB.users_table_name, ["id"], after, limit)) or []
 
     @staticmethod
     def constructor(info) -> DbUser | List[DbUser] | None:
@@ -71,38 +90,62 @@ class UserDeleter:
     @staticmethod
     def delete(user: DbUser):
         DB.delete_one(DB.users_table_name, id=user.id)
+        NotificationRuleDeleter.delete_by_user_id(user.id)
+        UserFetcher.identity_map.invalidate(user.id)
 
     @staticmethod
     def delete_device(user_id: int, device_id: int):
         pass
         DB.delete_one(DB.users_devices_table_name, user_id=user_id, device_id=device_id)
+        NotificationRule.changed()
 
 
 class UserInserter:
     @staticmethod
     def insert(login: str, email: str, password: str) -> DbUser:
-        DB.insert_one(DB.users_table_name, login=login, email=email, password=password)
-        user = UserFetcher.fetch_by_email(email=email)
+        try:
+            user_id = DB.insert_one(DB.users_table_name, login=login, email=email, password=password)
+
+        except sqlite3.IntegrityError:
+            raise UserAlreadyExistsError
+
+        user = DbUser(id=user_id, login=login, email=email, password=password)
+        UserFetcher.identity_map.store(user)
 
         return user
 
     @staticmethod
     def insert_device(user_id, device_id):
-        DB.insert_one(DB.users_devices_table_name, user_id=user_id, device_id=device_id)
+        try:
+            DB.insert_one(DB.users_devices_table_name, user_id=user_id, device_id=device_id)
+            NotificationRule.changed()
+
+        except sqlite3.IntegrityError:
+            # the device is already linked to the user
+            pass
 
 
 class UserUpdater:
     @staticmethod
     def update_login(user: DbUser, login: str):
-        DB.update_one(DB.users_table_name, dict(user_id=user.id), dict(login=login))
+        UserUpdater._update(user, login=login)
 
     @staticmethod
     def update_email(user: DbUser, email: str):
-        DB.update_one(DB.users_table_name, dict(user_id=user.id), dict(email=email))
+        try:
+            UserUpdater._update(user, email=email)
+
+        except sqlite3.IntegrityError:
+            raise UserAlreadyExistsError
 
     @staticmethod
     def update_password(user: DbUser, password: str):
-        DB.update_one(DB.users_table_name, dict(user_id=user.id), dict(password=password))
+        UserUpdater._update(user, password=password)
+
+    @staticmethod
+    def _update(user: DbUser, **new_values):
+        DB.update_one(DB.users_table_name, dict(id=user.id), new_values)
+        UserFetcher.identity_map.invalidate(user.id)
 
 
 class User:
@@ -138,6 +181,15 @@ class User:
 
         return []
 
+    @staticmethod
+    def page(after: str | tuple = None, limit: int = 500) -> Page[User]:
+        users = UserFetcher.fetch_page(PageCursor.decode(after, 1), limit + 1)
+
+        items = [User(db_user=user_info) for user_info in users[:limit]]
+        next_cursor = PageCursor.encode((items[-1].id,)) if len(users) > limit else None
+
+        return Page(items, next_cursor)
+
     @property
     def id(self) -> int:
         return self._user.id
@@ -149,6 +201,7 @@ class User:
     @login.setter
     def login(self, login: str):
         UserUpdater.update_login(self._user, login)
+        self._user.login = login
 
     @property
     def email(self):
@@ -157,6 +210,7 @@ class User:
     @email.setter
     def email(self, email: str):
         UserUpdater.update_email(self._user, email)
+        self._user.email = email
 
     @property
     def password(self) -> str:
@@ -165,11 +219,16 @@ class User:
     @password.setter
     def password(self, password: str):
         UserUpdater.update_password(self._user, password)
+        self._user.password = password
 
     @property
     def devices(self) -> List[Device]:
         return Device.user_devices(user_id=self.id)
 
+    def devices_with_latest(self) -> List[Tuple[Device, SensorReading | None]]:
+        # current values of every device of the user, one query regardless of the history size
+        return Device.user_devices_with_latest(self.id)
+
     @staticmethod
     def by_device(device_id: int):
         users = UserFetcher.fetch_by_device_id(device_id=device_id)
@@ -178,27 +237,24 @@ class User:
 
         return []
 
+    @staticmethod
+    def for_devices(devices_id: List[int]) -> Dict[int, List[User]]:
+        # one query for any number of devices
+        return {device_id: [User(db_user=user_info) for user_info in users]
+                for device_id, users in UserFetcher.fetch_by_devices_id(devices_id).items()}
+
     @staticmethod
     def safe_insert(login: str, email: str, password: str) :
         try:
-            User.insert(login=login, email=email, password=password)
-
-            return UserFetcher.fetch_by_email(email=email)
+            return User.insert(login=login, email=email, password=password)._user
 
         except UserAlreadyExistsError:
             pass
 
     @staticmethod
     def insert(login: str, email: str, password: str) -> User:
-        try:
-            User(email=email)
-
-            raise UserAlreadyExistsError
-
-        except UserNotFoundError:
-            UserInserter.insert(login=login, email=email, password=password)
-
-            return User(email=email)
+        # email is unique, an existing user fails the insert itself
+        return User(db_user=UserInserter.insert(login=login, email=email, password=password))
 
     def delete(self):
         UserDeleter.delete(self._user)
@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+import math
+import bisect
+import threading
+from typing import List
+
+
+class Histogram:
+    # fixed buckets, observe is O(log buckets) and thread safe; quantiles are bucket upper bounds
+    default_buckets = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+    def __init__(self, buckets: List[float] = None):
+        self.buckets = sorted(buckets or Histogram.default_buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # the last counter is the +Inf bucket
+            self._counts = [0] * (len(self.buckets) + 1)
+            self.count = 0
+            self.sum = 0.0
+            self.min = math.inf
+            self.max = -math.inf
+
+    def observe(self, value: float):
+        with self._lock:
+            self._counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.count += 1
+            self.sum += value
+            self.min = min(self.min, value)
+            self.max = max(self.max, value)
+
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else math.nan
+
+    def quantile(self, q: float) -> float:
+        # upper bound of the bucket holding the q-th observation, max for the +Inf bucket
+        with self._lock:
+            if not self.count:
+                return math.nan
+
+            rank = max(1, math.ceil(q * self.count))
+            seen = 0
+            for index, count in enumerate(self._counts):
+                seen += count
+                if seen >= rank:
+                    return min(self.buckets[index], self.max) if index < len(self.buckets) else self.max
+
+        return self.max
+
+    def cumulative(self) -> List[tuple]:
+        # [(upper bound, observations <= bound)], the last bound is inf
+        with self._lock:
+            response = []
+            seen = 0
+            for bound, count in zip(self.buckets + [math.inf], self._counts):
+                seen += count
+                response.append((bound, seen))
+
+        return response
+
+    def snapshot(self) -> dict:
+        return dict(count=self.count, sum=self.sum, mean=self.mean(),
+                    min=self.min if self.count else math.nan, max=self.max if self.count else math.nan,
+                    p50=self.quantile(0.5), p95=self.quantile(0.95), p99=self.quantile(0.99))
+
+
+class HdrHistogram:
+    # log-linear buckets as in HdrHistogram: every power of two is split into equal sub buckets, so any recorded
+    # value is reported within 10 ** -significant_figures of itself at any magnitude; values are non-negative ints
+    # (e.g. microseconds), only buckets that were hit take memory
+    def __init__(self, significant_figures: int = 2):
+        # sub buckets per power of two, 2 ** magnitude >= 2 * 10 ** significant_figures
+        self.magnitude = math.ceil(math.log2(2 * 10 ** significant_figures))
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            # (shift, value >> shift) -> count, tuples sort in the order of the values
+            self._counts = {}
+            self.count = 0
+            self.sum = 0
+            self.min = None
+            self.max = None
+
+    def record(self, value: int, count: int = 1):
+        value = max(0, int(value))
+        shift = max(0, value.bit_length() - self.magnitude)
+        key = (shift, value >> shift)
+
+        with self._lock:
+            self._counts[key] = self._counts.get(key, 0) + count
+            self.count += count
+            self.sum += value * count
+            self.min = value if self.min is None else min(self.min, value)
+            self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other: HdrHistogram):
+        with other._lock:
+            counts = dict(other._counts)
+            count, total, minimum, maximum = other.count, other.sum, other.min, other.max
+
+        if not count:
+            return
+
+        with self._lock:
+            for key, bucket_count in counts.items():
+                self._counts[key] = self._counts.get(key, 0) + bucket_count
+
+            self.count += count
+            self.sum += total
+            self.min = minimum if self.min is None else min(self.min, minimum)
+            self.max = maximum if self.max is None else max(self.max, maximum)
+
+    def mean(self) -> float:
+        return self.sum / self.count if self.count else math.nan
+
+    def quantile(self, q: float) -> float:
+        # highest value equivalent to the q-th observation, never above max
+        with self._lock:
+            if not self.count:
+                return math.nan
+
+            rank = max(1, math.ceil(q * self.count))
+            seen = 0
+            for shift, sub_bucket in sorted(self._counts):
+                seen += self._counts[(shift, sub_bucket)]
+                if seen >= rank:
+                    return min(((sub_bucket + 1) << shift) - 1, self.max)
+
+        return self.max
+
+    def snapshot(self) -> dict:
+        return dict(count=self.count, mean=self.mean(), min=self.min if self.count else math.nan,
+                    max=self.max if self.count else math.nan, p50=self.quantile(0.5), p95=self.quantile(0.95),
+                    p99=self.quantile(0.99), p999=self.quantile(0.999))
+
+
+if __name__ == "__main__":
+    pass
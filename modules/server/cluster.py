@@ -0,0 +1,388 @@
+from __future__ import annotations
+
+import os
+import time
+import signal
+import asyncio
+import argparse
+import itertools
+import threading
+import multiprocessing
+from multiprocessing.connection import wait, Connection
+from concurrent.futures import Future
+from typing import List
+
+from modules.config.config import ingest_host, ingest_port
+from modules.database.connection.connection import ConnectionManager
+from modules.database.sensor_reading.sensor_reading import SensorReadingInserter
+from modules.database.sensor_reading.ingest_buffer import IngestBuffer, IngestBufferFullError, \
+    IngestBufferClosedError
+from modules.server.server import IngestServer
+
+
+class WriterError(Exception):
+    def __init__(self, message=None):
+        self.message = message
+
+    def __str__(self) -> str:
+        return f"Writer error: {self.message}"
+
+
+class WriterProxy:
+    # IngestBuffer interface of a worker process: readings are validated here and sent in batches to the writer
+    # process over the request pipe of this process, the futures resolve when the writer answers with their ids
+    # over its response pipe
+    def __init__(self, worker: int, requests: Connection, responses: Connection, capacity: int = 10000):
+        self.worker = worker
+        self.capacity = capacity
+        self.rows_written = 0
+        self.rows_failed = 0
+
+        self._requests = requests
+        self._responses = responses
+        # a send blocks while the pipe is full, answers must still be received meanwhile
+        self._send_lock = threading.Lock()
+        self._pending = {}
+        self._pending_rows = 0
+        self._ids = itertools.count()
+        self._lock = threading.Lock()
+        self._drained = threading.Condition(self._lock)
+        self._closed = False
+        self._thread = None
+
+    def start(self) -> WriterProxy:
+        with self._lock:
+            if self._thread is None:
+                self._closed = False
+                self._thread = threading.Thread(target=self._receive, name="writer-proxy", daemon=True)
+                self._thread.start()
+
+        return self
+
+    def put(self, reading: dict, timeout: float = None) -> Future:
+        return self.put_many([reading], timeout)[0]
+
+    def put_many(self, readings: List[dict], timeout: float = None) -> List[Future]:
+        # never blocks, at most capacity rows per worker wait for the writer
+        rows = [SensorReadingInserter.constructor(**reading) for reading in readings]
+        futures = [Future() for _ in rows]
+
+        with self._lock:
+            if self._closed or self._thread is None:
+                raise IngestBufferClosedError
+
+            if self._pending_rows + len(rows) > self.capacity:
+                raise IngestBufferFullError
+
+            request_id = next(self._ids)
+            self._pending[request_id] = futures
+            self._pending_rows += len(rows)
+
+        with self._send_lock:
+            self._requests.send((request_id, rows))
+
+        return futures
+
+    def close(self, timeout: float = None):
+        # waits for the answers of everything sent so far
+        with self._lock:
+            if self._thread is None:
+                return
+
+            self._closed = True
+            self._drained.wait_for(lambda: not self._pending, timeout)
+            thread = self._thread
+            self._thread = None
+
+        thread.join(timeout)
+
+    def __len__(self):
+        return self._pending_rows
+
+    def metrics(self) -> dict:
+        return dict(queued=self._pending_rows, rows_written=self.rows_written, rows_failed=self.rows_failed)
+
+    def _receive(self):
+        while True:
+            with self._lock:
+                if self._closed and not self._pending:
+                    break
+
+            if not self._responses.poll(0.1):
+                continue
+
+            try:
+                request_id, results = self._responses.recv()
+
+            except (EOFError, OSError):
+                # the writer is gone, the cluster is stopping
+                break
+
+            with self._lock:
+                futures = self._pending.pop(request_id)
+                self._pending_rows -= len(futures)
+                if not self._pending:
+                    self._drained.notify_all()
+
+            for future, result in zip(futures, results):
+                if isinstance(result, str):
+                    self.rows_failed += 1
+                    future.set_exception(WriterError(result))
+
+                else:
+                    self.rows_written += 1
+                    future.set_result(result)
+
+
+class IngestCluster:
+    # N worker processes accept connections on one port with SO_REUSEPORT, parse and validate the commands and
+    # send the readings to the single writer process that owns the IngestBuffer, SQLite allows one writer anyway;
+    # every worker process has its own request and response pipes, so a worker killed mid message breaks only its
+    # own pipes; crashed workers are restarted, a crashed writer stops the cluster
+    def __init__(self, workers: int = os.cpu_count(), host: str = ingest_host, port: int = ingest_port,
+                 max_rows: int = 1000, max_delay_ms: int = 50, capacity: int = 10000, report_interval: float = 60):
+        self.workers = workers
+        self.host = host
+        self.port = port
+        self.max_rows = max_rows
+        self.max_delay_ms = max_delay_ms
+        # unanswered rows per worker
+        self.capacity = capacity
+        self.report_interval = report_interval
+
+        self._context = multiprocessing.get_context("fork")
+        # the launcher hands the writer the pipes of every started worker process, None stops the writer
+        self._control_reader, self._control = self._context.Pipe(duplex=False)
+        # acked, nacked, connections of every worker, published by the workers themselves
+        self._counters = self._context.Array("q", workers * 3, lock=False)
+        self._processes: List[multiprocessing.Process | None] = [None] * workers
+        self._restarts = [0] * workers
+        # acks of the previous processes of a restarted worker
+        self._retired = [0] * workers
+        self._writer = None
+        self._stopping = False
+
+    def run(self) -> int:
+        # connections must not be shared with the forked processes
+        ConnectionManager.close_all()
+
+        self._writer = self._context.Process(target=self._run_writer, name="ingest-writer")
+        self._writer.start()
+        for worker in range(self.workers):
+            self._start_worker(worker)
+
+        for stop_signal in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(stop_signal, lambda *_: self.stop())
+
+        print(f"Ingest cluster: {self.workers} workers on {self.host}:{self.port}, writer pid {self._writer.pid}")
+
+        code = 0
+        previous = self._acked()
+        reported = time.monotonic()
+        while not self._stopping:
+            wait([self._writer.sentinel] + [process.sentinel for process in self._processes], timeout=0.5)
+
+            if not self._writer.is_alive():
+                print(f"Writer exited with code {self._writer.exitcode}, stopping")
+                code = 1
+                break
+
+            for worker, process in enumerate(self._processes):
+                if not process.is_alive() and not self._stopping:
+                    print(f"Worker {worker} (pid {process.pid}) exited with code {process.exitcode}, restarting")
+                    self._retired[worker] += self._counters[worker * 3]
+                    self._restarts[worker] += 1
+                    self._start_worker(worker)
+
+            if self.report_interval and time.monotonic() - reported >= self.report_interval:
+                acked = self._acked()
+                self._report(previous, acked, time.monotonic() - reported)
+                previous = acked
+                reported = time.monotonic()
+
+        self._shutdown()
+
+        return code
+
+    def stop(self):
+        self._stopping = True
+
+    def metrics(self) -> List[dict]:
+        return [dict(worker=worker, pid=process.pid if process else None, acked=self._retired[worker] + acked,
+                     nacked=nacked, connections=connections, restarts=self._restarts[worker])
+                for worker, (process, (acked, nacked, connections))
+                in enumerate(zip(self._processes, self._worker_counters()))]
+
+    def _start_worker(self, worker: int):
+        for index in range(3):
+            self._counters[worker * 3 + index] = 0
+
+        # fresh pipes for every process, a crashed predecessor may have left the old ones mid message
+        requests, requests_sender = self._context.Pipe(duplex=False)
+        responses, responses_sender = self._context.Pipe(duplex=False)
+
+        process = self._context.Process(target=self._run_worker, args=(worker, requests_sender, responses),
+                                        name=f"ingest-worker-{worker}")
+        process.start()
+        self._processes[worker] = process
+
+        self._control.send(("connect", worker, process.pid, requests, responses_sender))
+        # only the worker and the writer keep their ends, so a dead worker reads as EOF in the writer
+        for connection in (requests, requests_sender, responses, responses_sender):
+            connection.close()
+
+    def _shutdown(self):
+        # workers stop accepting and wait for the answers they owe, then the writer commits what is left
+        for process in self._processes:
+            if process.is_alive():
+                process.terminate()
+
+        for process in self._processes:
+            process.join()
+
+        self._control.send(None)
+        self._writer.join()
+
+        for worker in self.metrics():
+            print(f"worker {worker['worker']}: acked {worker['acked']}, nacked {worker['nacked']}, "
+                  f"restarts {worker['restarts']}")
+
+    def _run_worker(self, worker: int, requests: Connection, responses: Connection):
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+        buffer = WriterProxy(worker, requests, responses, self.capacity)
+        server = IngestServer(self.host, self.port, buffer, report_interval=None, reuse_port=True)
+
+        asyncio.run(self._serve_worker(worker, server))
+
+    async def _serve_worker(self, worker: int, server: IngestServer):
+        publisher = asyncio.create_task(self._publish(worker, server))
+        try:
+            await server.serve()
+
+        finally:
+            publisher.cancel()
+            self._publish_counters(worker, server)
+
+    async def _publish(self, worker: int, server: IngestServer):
+        while True:
+            self._publish_counters(worker, server)
+            await asyncio.sleep(0.5)
+
+    def _publish_counters(self, worker: int, server: IngestServer):
+        self._counters[worker * 3:worker * 3 + 3] = [server.acked, server.nacked, server.connections]
+
+    def _run_writer(self):
+        # the launcher decides when the writer stops, after the workers are gone
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+        # worker -> (pid, response pipe) of its current process
+        connections = {}
+        # request pipe -> (worker, pid), pipes of exited processes are read to the end
+        requests = {}
+        lock = threading.Lock()
+
+        buffer = IngestBuffer(self.max_rows, self.max_delay_ms).start()
+        stopping = False
+        while not stopping:
+            for ready in wait([self._control_reader] + list(requests)):
+                if ready is not self._control_reader:
+                    IngestCluster._read_request(ready, requests, buffer, connections, lock)
+                    continue
+
+                message = self._control_reader.recv()
+                if message is None:
+                    stopping = True
+                    continue
+
+                _, worker, pid, request_pipe, response_pipe = message
+                requests[request_pipe] = (worker, pid)
+                with lock:
+                    previous = connections.get(worker)
+                    connections[worker] = (pid, response_pipe)
+
+                if previous is not None:
+                    previous[1].close()
+
+        # the workers are stopped, what they sent is still in their pipes
+        while requests:
+            for request_pipe in list(requests):
+                IngestCluster._read_request(request_pipe, requests, buffer, connections, lock)
+
+        buffer.close()
+
+    @staticmethod
+    def _read_request(request_pipe: Connection, requests: dict, buffer: IngestBuffer, connections: dict,
+                      lock: threading.Lock):
+        worker, pid = requests[request_pipe]
+        try:
+            request_id, rows = request_pipe.recv()
+
+        except (EOFError, OSError):
+            # the process exited, a message it was killed in the middle of is lost with it
+            del requests[request_pipe]
+            request_pipe.close()
+            return
+
+        futures = buffer.put_rows(rows)
+        IngestCluster._answer(connections, lock, worker, pid, request_id, futures)
+
+    @staticmethod
+    def _answer(connections: dict, lock: threading.Lock, worker: int, pid: int, request_id: int,
+                futures: List[Future]):
+        # one response per request once all of its rows are committed, ids or error messages
+        remaining = [len(futures)]
+
+        def done(_):
+            with lock:
+                remaining[0] -= 1
+                if remaining[0]:
+                    return
+
+                # answers to a crashed process are dropped, its connections are gone
+                connection = connections.get(worker)
+                if connection is None or connection[0] != pid:
+                    return
+
+                results = [str(future.exception()) if future.exception() else future.result() for future in futures]
+                try:
+                    connection[1].send((request_id, results))
+
+                except (BrokenPipeError, ConnectionError, OSError):
+                    pass
+
+        for future in futures:
+            future.add_done_callback(done)
+
+    def _worker_counters(self) -> List[tuple]:
+        counters = list(self._counters)
+
+        return [tuple(counters[worker * 3:worker * 3 + 3]) for worker in range(self.workers)]
+
+    def _acked(self) -> List[int]:
+        return [self._retired[worker] + acked for worker, (acked, _, _) in enumerate(self._worker_counters())]
+
+    def _report(self, previous: List[int], acked: List[int], elapsed: float):
+        for worker, (process, (_, nacked, connections)) in enumerate(zip(self._processes, self._worker_counters())):
+            print(f"worker {worker} (pid {process.pid}): {(acked[worker] - previous[worker]) / elapsed:.0f} acks/s, "
+                  f"acked: {acked[worker]}, nacked: {nacked}, connections: {connections}, "
+                  f"restarts: {self._restarts[worker]}")
+
+        print(f"total: {(sum(acked) - sum(previous)) / elapsed:.0f} acks/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--workers", type=int, default=os.cpu_count())
+    parser.add_argument("--host", default=ingest_host)
+    parser.add_argument("--port", type=int, default=ingest_port)
+    parser.add_argument("--report-interval", type=float, default=60)
+    args = parser.parse_args()
+
+    raise SystemExit(IngestCluster(args.workers, args.host, args.port, report_interval=args.report_interval).run())
+
+
+if __name__ == "__main__":
+    main()
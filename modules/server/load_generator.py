@@ -0,0 +1,383 @@
+from __future__ import annotations
+
+import json
+import random
+import asyncio
+import argparse
+from collections import deque
+from typing import List
+
+from modules.config.config import ingest_port
+from modules.database.device.device import DeviceFetcher, DeviceInserter
+from modules.metrics.metrics import HdrHistogram
+from modules.server.protocol import BinaryProtocol
+
+
+class LoadGeneratorError(Exception):
+    def __init__(self, reason=None):
+        self.reason = reason
+
+    def __str__(self) -> str:
+        return f"Load generator error: {self.reason}"
+
+
+class SimulatedDevice:
+    # readings drift as a random walk around plausible values of a greenhouse sensor
+    limits = dict(temperature=(-10.0, 45.0), humidity=(5.0, 100.0), pressure=(95000.0, 106000.0),
+                  hydration=(0.0, 1.0), waterlevel=(0.0, 1.0))
+    steps = dict(temperature=0.1, humidity=0.3, pressure=15.0, hydration=0.005, waterlevel=0.005)
+
+    def __init__(self, serial_number: str, device_id: int | None, generator: random.Random):
+        self.serial_number = serial_number
+        self.device_id = device_id
+        self.generator = generator
+        self.values = dict(temperature=generator.uniform(15, 28), humidity=generator.uniform(30, 70),
+                           pressure=generator.uniform(99000, 102500), hydration=generator.random(),
+                           waterlevel=generator.random())
+
+    def step(self) -> List[float]:
+        for metric, (low, high) in SimulatedDevice.limits.items():
+            value = self.values[metric] + self.generator.gauss(0, SimulatedDevice.steps[metric])
+            self.values[metric] = min(high, max(low, value))
+
+        return list(self.values.values())
+
+    def text(self) -> bytes:
+        temperature, humidity, pressure, hydration, waterlevel = self.step()
+
+        return (f"POST SENSOR READING {self.serial_number} {temperature:.2f} {humidity:.2f} {pressure:.1f} "
+                f"{hydration:.3f} {waterlevel:.3f}\n").encode()
+
+    def frame(self) -> bytes:
+        # ts 0 - the server stamps the reading
+        return BinaryProtocol.encode(self.device_id, 0, *self.step())
+
+
+class LoadConnection:
+    # one client connection shared by several devices, as behind a gateway; responses come in the order of the
+    # commands, so the scheduled send times of the outstanding commands are a queue
+    def __init__(self, generator: LoadGenerator, index: int):
+        self.generator = generator
+        self.index = index
+        self.ready = asyncio.Event()
+        self.pending = deque()
+        self.closing = asyncio.Event()
+
+        self._writer = None
+        self._drained = asyncio.Event()
+
+    async def run(self):
+        # connects, serves for a random lifetime (churn) and reconnects until the generator stops
+        generator = self.generator
+        while not self.closing.is_set():
+            try:
+                reader, self._writer = await asyncio.wait_for(
+                    asyncio.open_connection(generator.host, generator.port), generator.timeout)
+
+                if generator.protocol == "binary":
+                    self._writer.write(BinaryProtocol.negotiation + b"\n")
+                    answer = await asyncio.wait_for(reader.readline(), generator.timeout)
+                    if answer.strip() != BinaryProtocol.negotiated:
+                        raise LoadGeneratorError(f"binary protocol refused: {answer!r}")
+
+            except (OSError, asyncio.TimeoutError, LoadGeneratorError) as error:
+                generator.connect_errors += 1
+                generator.last_error = str(error) or type(error).__name__
+                await asyncio.sleep(generator.generator.uniform(0.1, 0.5))
+                continue
+
+            generator.connects += 1
+            responses = asyncio.create_task(self._read(reader))
+            self.ready.set()
+
+            lifetime = generator.generator.expovariate(1 / generator.churn) if generator.churn else None
+            closed = await self._serve(responses, lifetime)
+
+            # a churning device stops sending and waits for the answers it is owed before it hangs up
+            self.ready.clear()
+            if not closed:
+                await self._drain(responses)
+
+            responses.cancel()
+            await asyncio.gather(responses, return_exceptions=True)
+            self._writer.close()
+            await asyncio.gather(self._writer.wait_closed(), return_exceptions=True)
+
+            generator.lost += len(self.pending)
+            self.pending.clear()
+
+    async def send(self, payload: bytes, readings: int, scheduled: float):
+        try:
+            await asyncio.wait_for(self.ready.wait(), self.generator.timeout)
+
+        except asyncio.TimeoutError:
+            # the server does not take connections, the readings are dropped
+            self.generator.sent += readings
+            self.generator.lost += readings
+            return
+
+        self.pending.extend([scheduled] * readings)
+        self.generator.sent += readings
+        self._drained.clear()
+
+        try:
+            self._writer.write(payload)
+            await self._writer.drain()
+
+        except ConnectionError:
+            # the readings stay pending and are counted as lost when the connection is closed
+            pass
+
+    def close(self):
+        self.closing.set()
+
+    async def _serve(self, responses: asyncio.Task, lifetime: float | None) -> bool:
+        # True when the server closed the connection
+        waiters = [responses, asyncio.create_task(self.closing.wait())]
+        if lifetime is not None:
+            waiters.append(asyncio.create_task(asyncio.sleep(lifetime)))
+
+        done, running = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        for waiter in running:
+            if waiter is not responses:
+                waiter.cancel()
+
+        return responses in done
+
+    async def _drain(self, responses: asyncio.Task):
+        if not self.pending:
+            return
+
+        drained = asyncio.create_task(self._drained.wait())
+        await asyncio.wait([drained, responses], timeout=self.generator.timeout, return_when=asyncio.FIRST_COMPLETED)
+        drained.cancel()
+
+    async def _read(self, reader: asyncio.StreamReader):
+        generator = self.generator
+        loop = asyncio.get_running_loop()
+        size = BinaryProtocol.response.size
+
+        while True:
+            if generator.protocol == "binary":
+                try:
+                    data = await reader.readexactly(size)
+
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    return
+
+                acknowledged = BinaryProtocol.response.unpack(data)[1] == BinaryProtocol.OK
+
+            else:
+                try:
+                    line = await reader.readline()
+
+                except ConnectionError:
+                    return
+
+                if not line:
+                    return
+
+                acknowledged = line.startswith(b"ACK")
+                if not acknowledged and generator.last_nack is None:
+                    generator.last_nack = line.strip().decode(errors="replace")
+
+            if not self.pending:
+                # an answer to nothing, e.g. an error about a line the server could not parse
+                generator.unexpected += 1
+                continue
+
+            scheduled = self.pending.popleft()
+            # from the time the reading was due, not the time it was written: a stalled connection delays
+            # the sends as well and would hide the stall otherwise (coordinated omission)
+            generator.latency.record((loop.time() - scheduled) * 1e6)
+            if acknowledged:
+                generator.acked += 1
+
+            else:
+                generator.nacked += 1
+
+            if not self.pending:
+                self._drained.set()
+
+
+class LoadGenerator:
+    # simulated devices against an ingest server: every device sends burst readings every burst / rate seconds
+    # (+- jitter of the interval) over one of the connections; ACK latency goes to an HdrHistogram in microseconds
+    def __init__(self, host: str = "127.0.0.1", port: int = ingest_port, devices: int = 1000, connections: int = 100,
+                 rate: float = 1.0, burst: int = 1, jitter: float = 0.1, duration: float = 30.0, churn: float = None,
+                 protocol: str = "text", prefix: str = "load-", seed: int = 0, timeout: float = 10.0,
+                 report_interval: float = 5.0):
+        if protocol not in ("text", "binary"):
+            raise LoadGeneratorError(f"unknown protocol {protocol!r}")
+
+        if devices < 1 or connections < 1 or rate <= 0 or burst < 1 or not 0 <= jitter <= 1:
+            raise LoadGeneratorError("devices, connections, rate and burst must be positive, jitter within 0..1")
+
+        self.host = host
+        self.port = port
+        self.devices = devices
+        self.connections = min(connections, devices)
+        # readings per second of one device
+        self.rate = rate
+        self.burst = burst
+        self.jitter = jitter
+        self.duration = duration
+        # mean lifetime of a connection in seconds, None - connections live for the whole run
+        self.churn = churn
+        self.protocol = protocol
+        self.prefix = prefix
+        self.timeout = timeout
+        self.report_interval = report_interval
+        self.generator = random.Random(seed)
+
+        self.latency = HdrHistogram()
+        self.sent = 0
+        self.acked = 0
+        self.nacked = 0
+        # sent, but the connection closed before the answer
+        self.lost = 0
+        self.unexpected = 0
+        self.connects = 0
+        self.connect_errors = 0
+        self.last_error = None
+        self.last_nack = None
+        self.elapsed = None
+
+    def serial_numbers(self) -> List[str]:
+        return [f"{self.prefix}{index:06d}" for index in range(self.devices)]
+
+    def register(self) -> int:
+        # creates the simulated devices missing from the local database, the server rejects unknown devices;
+        # returns the number of created devices
+        missing = [serial_number for serial_number in self.serial_numbers()
+                   if DeviceFetcher.fetch_by_serial_number(serial_number) is None]
+        if missing:
+            DeviceInserter.insert_many(missing)
+
+        return len(missing)
+
+    def simulated_devices(self) -> List[SimulatedDevice]:
+        devices = []
+        for serial_number in self.serial_numbers():
+            device_id = None
+            if self.protocol == "binary":
+                # frames carry device ids, they are taken from the local database the server uses
+                device = DeviceFetcher.fetch_by_serial_number(serial_number)
+                if device is None:
+                    raise LoadGeneratorError(f"device {serial_number} is not registered, run with --register")
+
+                device_id = device.id
+
+            devices.append(SimulatedDevice(serial_number, device_id, random.Random(self.generator.random())))
+
+        return devices
+
+    async def run(self) -> dict:
+        loop = asyncio.get_running_loop()
+        connections = [LoadConnection(self, index) for index in range(self.connections)]
+        devices = self.simulated_devices()
+
+        connection_tasks = [asyncio.create_task(connection.run()) for connection in connections]
+        reporter = asyncio.create_task(self._report()) if self.report_interval else None
+
+        start = loop.time()
+        await asyncio.gather(*(self._device(device, connections[index % len(connections)], start)
+                               for index, device in enumerate(devices)))
+
+        # the answers to the last readings are part of the run
+        for connection in connections:
+            connection.close()
+
+        await asyncio.gather(*connection_tasks)
+        self.elapsed = loop.time() - start
+
+        if reporter is not None:
+            reporter.cancel()
+
+        return self.summary()
+
+    async def _device(self, device: SimulatedDevice, connection: LoadConnection, start: float):
+        loop = asyncio.get_running_loop()
+        interval = self.burst / self.rate
+        # devices are spread over the first interval instead of all sending at once
+        phase = self.generator.random() * interval
+
+        tick = 0
+        while True:
+            scheduled = start + phase + (tick + self.jitter * self.generator.uniform(-1, 1)) * interval
+            if scheduled - start >= self.duration:
+                return
+
+            await asyncio.sleep(max(0.0, scheduled - loop.time()))
+            if self.protocol == "binary":
+                payload = b"".join(device.frame() for _ in range(self.burst))
+
+            else:
+                payload = b"".join(device.text() for _ in range(self.burst))
+
+            await connection.send(payload, self.burst, scheduled)
+            tick += 1
+
+    async def _report(self):
+        previous = 0
+        while True:
+            await asyncio.sleep(self.report_interval)
+            answered = self.acked + self.nacked
+            print(f"sent {self.sent} answered {answered} ({(answered - previous) / self.report_interval:.0f}/s) "
+                  f"nacked {self.nacked} lost {self.lost} p99 {self.latency.quantile(0.99) / 1000:.1f}ms "
+                  f"connects {self.connects} errors {self.connect_errors}")
+            previous = answered
+
+    def summary(self) -> dict:
+        latency = self.latency.snapshot()
+
+        return dict(devices=self.devices, connections=self.connections, protocol=self.protocol,
+                    target_per_s=self.devices * self.rate, duration=self.elapsed, sent=self.sent, acked=self.acked,
+                    nacked=self.nacked, lost=self.lost, unexpected=self.unexpected,
+                    achieved_per_s=(self.acked + self.nacked) / self.elapsed if self.elapsed else 0.0,
+                    connects=self.connects, connect_errors=self.connect_errors, last_error=self.last_error,
+                    last_nack=self.last_nack,
+                    latency_ms={key: latency[key] / 1000 for key in ("mean", "p50", "p95", "p99", "p999", "max")})
+
+
+def main():
+    parser = argparse.ArgumentParser(description="simulated devices against a local ingest server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=ingest_port)
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--connections", type=int, default=100)
+    parser.add_argument("--rate", type=float, default=1.0, help="readings per second of one device")
+    parser.add_argument("--burst", type=int, default=1, help="readings a device sends at once")
+    parser.add_argument("--jitter", type=float, default=0.1, help="share of the interval a send may move")
+    parser.add_argument("--duration", type=float, default=30.0)
+    parser.add_argument("--churn", type=float, help="mean connection lifetime in seconds")
+    parser.add_argument("--protocol", choices=["text", "binary"], default="text")
+    parser.add_argument("--prefix", default="load-", help="serial numbers are <prefix><000000>")
+    parser.add_argument("--register", action="store_true", help="create the devices in the local database")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--report-interval", type=float, default=5.0)
+    parser.add_argument("--json", help="write the summary to this file")
+    args = parser.parse_args()
+
+    generator = LoadGenerator(args.host, args.port, args.devices, args.connections, args.rate, args.burst,
+                              args.jitter, args.duration, args.churn, args.protocol, args.prefix, args.seed,
+                              report_interval=args.report_interval)
+    if args.register:
+        print(f"registered {generator.register()} devices")
+
+    summary = asyncio.run(generator.run())
+    latency = summary["latency_ms"]
+    print(f"{summary['acked']} acked, {summary['nacked']} nacked, {summary['lost']} lost of {summary['sent']} sent "
+          f"in {summary['duration']:.1f}s: {summary['achieved_per_s']:.0f}/s of {summary['target_per_s']:.0f}/s")
+    print(f"ack latency p50 {latency['p50']:.2f}ms p95 {latency['p95']:.2f}ms p99 {latency['p99']:.2f}ms "
+          f"max {latency['max']:.2f}ms")
+    if summary["last_nack"] or summary["last_error"]:
+        print(f"last nack: {summary['last_nack']}, last connection error: {summary['last_error']}")
+
+    if args.json:
+        with open(args.json, "w") as file:
+            json.dump(summary, file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
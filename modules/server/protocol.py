@@ -0,0 +1,90 @@
+from __future__ import annotations
+
+import math
+import struct
+from typing import List, Tuple
+from dataclasses import dataclass
+
+
+class InvalidFrameError(Exception):
+    def __init__(self, version=None):
+        self.version = version
+
+    def __str__(self) -> str:
+        return f"Invalid frame version: {self.version!r}"
+
+
+@dataclass
+class ReadingFrame:
+    device_id: int
+    ts: int
+    temperature: float | None
+    humidity: float | None
+    pressure: float | None
+    hydration: float | None
+    waterlevel: float | None
+
+
+class BinaryProtocol:
+    # fixed little-endian frames, negotiated by the text line "PROTOCOL BINARY 1" (answer "OK BINARY 1"):
+    #   reading:  version u8, device id u32, ts i64 (epoch ms, 0 - server time), 5 x float32 (NaN - missing)
+    #   response: version u8, status u8, sensor reading id i64 (0 unless status is OK)
+    version = 1
+    negotiation = b"PROTOCOL BINARY 1"
+    negotiated = b"OK BINARY 1"
+
+    reading = struct.Struct("<BIq5f")
+    response = struct.Struct("<BBq")
+
+    OK = 0
+    INVALID = 1
+    UNKNOWN_DEVICE = 2
+    BUSY = 3
+    ERROR = 4
+
+    @staticmethod
+    def decode(buffer: memoryview) -> Tuple[List[ReadingFrame], int]:
+        # every complete frame of the buffer in one pass; returns the frames and the number of bytes used
+        frames = []
+        offset = 0
+        size = BinaryProtocol.reading.size
+
+        while offset + size <= len(buffer):
+            version, device_id, ts, *values = BinaryProtocol.reading.unpack_from(buffer, offset)
+            if version != BinaryProtocol.version:
+                raise InvalidFrameError(version)
+
+            frames.append(ReadingFrame(device_id, ts, *(None if math.isnan(value) else value for value in values)))
+            offset += size
+
+        return frames, offset
+
+    @staticmethod
+    def encode(device_id: int, ts: int, temperature: float = None, humidity: float = None, pressure: float = None,
+               hydration: float = None, waterlevel: float = None) -> bytes:
+        return BinaryProtocol.reading.pack(
+            BinaryProtocol.version, device_id, ts,
+            *(math.nan if value is None else value for value in (temperature, humidity, pressure, hydration,
+                                                                 waterlevel)))
+
+    @staticmethod
+    def encode_response(status: int, sensor_reading_id: int = 0) -> bytes:
+        return BinaryProtocol.response.pack(BinaryProtocol.version, status, sensor_reading_id)
+
+    @staticmethod
+    def decode_responses(buffer: memoryview) -> Tuple[List[Tuple[int, int]], int]:
+        # [(status, sensor reading id)] of the complete responses and the number of bytes used
+        responses = []
+        offset = 0
+        size = BinaryProtocol.response.size
+
+        while offset + size <= len(buffer):
+            _, status, sensor_reading_id = BinaryProtocol.response.unpack_from(buffer, offset)
+            responses.append((status, sensor_reading_id))
+            offset += size
+
+        return responses, offset
+
+
+if __name__ == "__main__":
+    pass
@@ -0,0 +1,367 @@
+from __future__ import annotations
+
+import time
+import signal
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Tuple, Set
+
+from modules.config.config import ingest_host, ingest_port
+from modules.database.device.device import DeviceFetcher, DeviceCache
+from modules.database.sensor_reading.ingest_buffer import IngestBuffer, IngestBufferFullError, \
+    IngestBufferClosedError
+from modules.database.timestamp.timestamp import Timestamp
+from modules.metrics.metrics import Histogram
+from modules.server.protocol import BinaryProtocol, ReadingFrame, InvalidFrameError
+
+
+class InvalidCommandError(Exception):
+    def __init__(self, line=None):
+        self.line = line
+
+    def __str__(self) -> str:
+        return f"Invalid command: {self.line!r}"
+
+
+class UnknownDeviceError(Exception):
+    def __init__(self, serial_number=None):
+        self.serial_number = serial_number
+
+    def __str__(self) -> str:
+        return f"Unknown device: {self.serial_number!r}"
+
+
+class IngestServer:
+    # newline framed commands, one response line per command in the order of the commands:
+    #   POST SENSOR READING {serial number} {temperature} {humidity} {pressure} {hydration} {waterlevel}
+    #     -> ACK {sensor reading id} | NACK {reason}
+    #   PING -> PONG
+    #   PROTOCOL BINARY 1 -> OK BINARY 1, after it the connection carries BinaryProtocol frames
+    # readings are stamped with the server time and committed by the IngestBuffer writer thread,
+    # the event loop itself never touches SQLite
+    command = b"POST SENSOR READING "
+    measurements = ["temperature", "humidity", "pressure", "hydration", "waterlevel"]
+
+    def __init__(self, host: str = ingest_host, port: int = ingest_port, buffer: IngestBuffer = None,
+                 max_line: int = 1024, max_pending: int = 64, lookup_threads: int = 4, report_interval: float = 60,
+                 reuse_port: bool = False):
+        self.host = host
+        self.port = port
+        self.buffer = buffer or IngestBuffer()
+        self.max_line = max_line
+        # unacknowledged commands per connection, reading stops while there are more
+        self.max_pending = max_pending
+        # None turns the periodic report off
+        self.report_interval = report_interval
+        # several processes may listen on the same port, the kernel spreads the connections between them
+        self.reuse_port = reuse_port
+
+        self.ack_latency = Histogram()
+        self.connections = 0
+        self.acked = 0
+        self.nacked = 0
+
+        self._lookup_executor = ThreadPoolExecutor(lookup_threads, thread_name_prefix="ingest-lookup")
+        self._server = None
+        # handler task -> writer of every connection, handlers still reading commands
+        self._clients = {}
+        self._reading = set()
+        self._stopping = False
+
+    @staticmethod
+    def parse(line: bytes) -> Tuple[str, List[float]]:
+        # serial number and the measurements of a POST SENSOR READING line
+        if not line.startswith(IngestServer.command):
+            raise InvalidCommandError(line)
+
+        arguments = line[len(IngestServer.command):].split()
+        if len(arguments) != len(IngestServer.measurements) + 1:
+            raise InvalidCommandError(line)
+
+        try:
+            return arguments[0].decode(), [float(value) for value in arguments[1:]]
+
+        except (UnicodeDecodeError, ValueError):
+            raise InvalidCommandError(line)
+
+    async def start(self):
+        self.buffer.start()
+        self._server = await asyncio.start_server(self.handle_client, self.host, self.port, limit=self.max_line,
+                                                  backlog=4096, reuse_port=self.reuse_port or None)
+
+        return self._server
+
+    async def serve(self):
+        server = await self.start()
+
+        loop = asyncio.get_running_loop()
+        stopped = loop.create_future()
+        for stop_signal in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(stop_signal, lambda: stopped.done() or stopped.set_result(None))
+
+        addresses = ", ".join(str(sock.getsockname()) for sock in server.sockets)
+        print(f"Ingest server listening on {addresses}")
+
+        reporter = asyncio.create_task(self._report()) if self.report_interval else None
+        try:
+            await stopped
+
+        finally:
+            if reporter is not None:
+                reporter.cancel()
+
+            await self.stop()
+
+    async def stop(self):
+        # stops accepting connections, then commits the readings already accepted
+        if self._server is not None:
+            self._server.close()
+            self._server = None
+
+        # open connections stop reading and send the responses they owe; only handlers waiting for commands are
+        # cancelled, one that already sends its last responses is left alone
+        self._stopping = True
+        for task in list(self._reading):
+            self._clients[task].transport.pause_reading()
+            task.cancel()
+
+        await asyncio.gather(*self._clients, return_exceptions=True)
+
+        await asyncio.get_running_loop().run_in_executor(None, self.buffer.close)
+        self._lookup_executor.shutdown()
+
+    def metrics(self) -> dict:
+        return dict(connections=self.connections, acked=self.acked, nacked=self.nacked,
+                    ack_latency=self.ack_latency.snapshot(), buffer=self.buffer.metrics(),
+                    device_cache=DeviceCache.metrics())
+
+    async def handle_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.connections += 1
+        task = asyncio.current_task()
+        self._clients[task] = writer
+        self._reading.add(task)
+        # awaitables of [(response, ACK or NACK or None, receive time)] in the order of the commands
+        responses = asyncio.Queue(self.max_pending)
+        responder = asyncio.create_task(self._respond(responses, writer))
+
+        try:
+            while True:
+                try:
+                    line = await reader.readuntil(b"\n")
+
+                except asyncio.IncompleteReadError:
+                    break
+
+                except asyncio.LimitOverrunError:
+                    await responses.put(self._done(b"NACK line too long\n", False))
+                    break
+
+                line = line.strip()
+                if line == BinaryProtocol.negotiation:
+                    # the rest of the connection is binary frames
+                    await responses.put(self._done(BinaryProtocol.negotiated + b"\n", None))
+                    await self._read_frames(reader, responses)
+                    break
+
+                await responses.put(self._handle(line, time.perf_counter()))
+
+        except ConnectionError:
+            pass
+
+        except asyncio.CancelledError:
+            # stop() ends the reading, anything else cancelling the handler goes on
+            if not self._stopping:
+                raise
+
+        finally:
+            self._reading.discard(task)
+
+            # pending responses are still sent before the connection is closed; a responder that is gone takes
+            # nothing from the queue, the end mark must not wait for room in it
+            if not responder.done():
+                closing = asyncio.ensure_future(responses.put(None))
+                await asyncio.wait([closing, responder], return_when=asyncio.FIRST_COMPLETED)
+                closing.cancel()
+
+            await asyncio.wait([responder])
+            self.connections -= 1
+            self._clients.pop(task, None)
+
+    async def _read_frames(self, reader: asyncio.StreamReader, responses: asyncio.Queue):
+        buffer = bytearray()
+        while True:
+            data = await reader.read(65536)
+            if not data:
+                break
+
+            received = time.perf_counter()
+            buffer += data
+
+            try:
+                with memoryview(buffer) as view:
+                    frames, used = BinaryProtocol.decode(view)
+
+            except InvalidFrameError:
+                # the frame boundaries are lost, the connection can not go on
+                await responses.put(self._done(BinaryProtocol.encode_response(BinaryProtocol.INVALID), False))
+                break
+
+            del buffer[:used]
+            if frames:
+                await responses.put(asyncio.ensure_future(self._post_frames(frames, received)))
+
+    def _handle(self, line: bytes, received: float) -> asyncio.Future:
+        if line == b"PING":
+            return self._done(b"PONG\n", None)
+
+        return asyncio.ensure_future(self._post(line, received))
+
+    async def _post(self, line: bytes, received: float) -> List[tuple]:
+        try:
+            serial_number, values = IngestServer.parse(line)
+            device_id = await self._device_id(serial_number)
+
+            future = self.buffer.put(dict(zip(IngestServer.measurements, values), device_id=device_id,
+                                          datetime=Timestamp.to_datetime_string(Timestamp.now())), timeout=0)
+            sensor_reading_id = await asyncio.wrap_future(future)
+
+        except (InvalidCommandError, UnknownDeviceError) as error:
+            return [(f"NACK {error}\n".encode(), False, received)]
+
+        except (IngestBufferFullError, IngestBufferClosedError):
+            return [(b"NACK busy\n", False, received)]
+
+        except Exception as error:
+            return [(f"NACK database error: {error}\n".encode(), False, received)]
+
+        return [(f"ACK {sensor_reading_id}\n".encode(), True, received)]
+
+    async def _post_frames(self, frames: List[ReadingFrame], received: float) -> List[tuple]:
+        # all frames of a packet are queued with one put_many
+        statuses = [BinaryProtocol.OK] * len(frames)
+        readings = []
+        now = Timestamp.now()
+
+        try:
+            devices_id = await self._known_devices({frame.device_id for frame in frames})
+
+        except Exception:
+            return [(BinaryProtocol.encode_response(BinaryProtocol.ERROR), False, received) for _ in frames]
+
+        for index, frame in enumerate(frames):
+            if frame.device_id not in devices_id:
+                statuses[index] = BinaryProtocol.UNKNOWN_DEVICE
+                continue
+
+            # the ms ts of the frame is stored as is, the datetime string only has whole seconds
+            ts = frame.ts or now
+            try:
+                datetime = Timestamp.to_datetime_string(ts)
+
+            except (OverflowError, OSError, ValueError):
+                statuses[index] = BinaryProtocol.INVALID
+                continue
+
+            readings.append((index, dict(device_id=frame.device_id, datetime=datetime, ts=ts,
+                                         **{metric: getattr(frame, metric) for metric in IngestServer.measurements})))
+
+        ids = [0] * len(frames)
+        try:
+            futures = self.buffer.put_many([reading for _, reading in readings], timeout=0)
+
+            for (index, _), future in zip(readings, futures):
+                try:
+                    ids[index] = await asyncio.wrap_future(future)
+
+                except Exception:
+                    statuses[index] = BinaryProtocol.ERROR
+
+        except (IngestBufferFullError, IngestBufferClosedError):
+            for index, _ in readings:
+                statuses[index] = BinaryProtocol.BUSY
+
+        return [(BinaryProtocol.encode_response(status, sensor_reading_id), status == BinaryProtocol.OK, received)
+                for status, sensor_reading_id in zip(statuses, ids)]
+
+    async def _device_id(self, serial_number: str) -> int:
+        # only cache misses leave the event loop
+        hit, device_id = DeviceCache.cached(serial_number)
+        if not hit:
+            device_id = await asyncio.get_running_loop().run_in_executor(self._lookup_executor, DeviceCache.load,
+                                                                         serial_number)
+
+        if device_id is None:
+            raise UnknownDeviceError(serial_number)
+
+        return device_id
+
+    async def _known_devices(self, devices_id: Set[int]) -> Set[int]:
+        devices = await asyncio.get_running_loop().run_in_executor(self._lookup_executor,
+                                                                   DeviceFetcher.fetch_by_ids, devices_id)
+
+        return {device.id for device in devices}
+
+    def _done(self, response: bytes, acknowledged: bool | None) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        future.set_result([(response, acknowledged, None)])
+
+        return future
+
+    async def _respond(self, responses: asyncio.Queue, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                pending = await responses.get()
+                if pending is None:
+                    break
+
+                results = await pending
+                for response, acknowledged, _ in results:
+                    if acknowledged is True:
+                        self.acked += 1
+
+                    elif acknowledged is False:
+                        self.nacked += 1
+
+                    writer.write(response)
+
+                await writer.drain()
+
+                now = time.perf_counter()
+                for _, _, received in results:
+                    if received is not None:
+                        self.ack_latency.observe(now - received)
+
+        except Exception as error:
+            # the rest of the responses has nowhere to go, the readings are committed anyway; the queue is still
+            # drained, so the handler never waits for room in it
+            if not isinstance(error, ConnectionError):
+                print(f"Ingest responder failed: {error!r}")
+
+            while True:
+                pending = await responses.get()
+                if pending is None:
+                    break
+
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+
+            except ConnectionError:
+                pass
+
+    async def _report(self):
+        while True:
+            await asyncio.sleep(self.report_interval)
+
+            latency = self.ack_latency.snapshot()
+            print(f"connections: {self.connections}, acked: {self.acked}, nacked: {self.nacked}, "
+                  f"ack p50: {latency['p50'] * 1000:.1f}ms, p99: {latency['p99'] * 1000:.1f}ms")
+
+
+def main():
+    asyncio.run(IngestServer().serve())
+
+
+if __name__ == "__main__":
+    main()
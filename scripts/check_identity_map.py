@@ -0,0 +1,81 @@
+from modules.database.database.database import DB
+from modules.database.device.device import Device, DeviceFetcher, DeviceNotFoundError
+from modules.database.user.user import User, UserFetcher, UserNotFoundError
+from modules.database.identity_map.identity_map import IdentityMap
+
+# usage: python scripts/check_identity_map.py
+# users and devices read through the identity map must match the database after every update and delete
+
+failed = []
+
+
+def check(name: str, condition: bool):
+    print(f"{'ok  ' if condition else 'FAIL'} {name}")
+    if not condition:
+        failed.append(name)
+
+
+def raises(error, function) -> bool:
+    try:
+        function()
+
+    except error:
+        return True
+
+    return False
+
+
+def stored(table_name: str, id: int) -> dict:
+    row = DB.fetch_one(table_name, id=id)
+
+    return dict(row) if row else None
+
+
+IdentityMap.configure(enabled=True)
+
+user = User.insert(login="identity_map_check", email="identity_map_check@example.com", password="1")
+check("insert is cached", User(id=user.id).email == user.email and UserFetcher.identity_map.hits > 0)
+
+User(email=user.email).login = "identity_map_check_2"
+check("login update", User(id=user.id).login == "identity_map_check_2")
+check("login update is stored", stored(DB.users_table_name, user.id)["login"] == "identity_map_check_2")
+
+user.email = "identity_map_check_2@example.com"
+check("email update by id", User(id=user.id).email == "identity_map_check_2@example.com")
+check("email update by email", User(email="identity_map_check_2@example.com").id == user.id)
+check("old email is gone", raises(UserNotFoundError, lambda: User(email="identity_map_check@example.com")))
+
+copy = User(id=user.id)
+copy._user.password = "changed without update"
+check("records are copies", User(id=user.id).password == "1")
+
+try:
+    with DB.transaction():
+        user.password = "rolled back"
+        raise RuntimeError
+
+except RuntimeError:
+    pass
+
+check("rolled back update", User(id=user.id).password == stored(DB.users_table_name, user.id)["password"] == "1")
+
+device = Device.insert("identity_map_check")
+check("device insert", Device(serial_number="identity_map_check").id == device.id)
+
+device.serial_number = "identity_map_check_2"
+check("serial number update", Device(id=device.id).serial_number == "identity_map_check_2")
+check("old serial number is gone", raises(DeviceNotFoundError, lambda: Device(serial_number="identity_map_check")))
+
+Device(id=device.id).delete()
+check("device delete", raises(DeviceNotFoundError, lambda: Device(id=device.id)))
+
+User(id=user.id).delete()
+check("user delete", raises(UserNotFoundError, lambda: User(id=user.id)))
+check("user delete by email",
+      raises(UserNotFoundError, lambda: User(email="identity_map_check_2@example.com")))
+
+print(UserFetcher.identity_map.metrics())
+print(DeviceFetcher.identity_map.metrics())
+
+if failed:
+    raise SystemExit(f"{len(failed)} identity map checks failed")
@@ -0,0 +1,110 @@
+import os
+import json
+import time
+import sqlite3
+
+from modules.database.connection.connection import ConnectionManager
+from modules.database.database.database import DB
+from modules.database.instrumentation.instrumentation import Instrumentation
+
+# usage: python scripts/check_instrumentation.py
+# DB calls must be counted per table and operation with their rows, slow calls logged with a query plan,
+# and nothing recorded while instrumentation is disabled
+
+failed = []
+
+
+def check(name: str, condition: bool):
+    print(f"{'ok  ' if condition else 'FAIL'} {name}")
+    if not condition:
+        failed.append(name)
+
+
+def per_call(function, count: int = 20000) -> float:
+    start = time.perf_counter()
+    for _ in range(count):
+        function()
+
+    return (time.perf_counter() - start) / count * 1e6
+
+
+table_name = DB.users_notifications_table_name
+user_id = 1000101
+
+events = []
+Instrumentation.add_hook(events.append)
+Instrumentation.configure(enabled=True, slow_query_ms=10 ** 6, slow_log_path=False)
+Instrumentation.reset()
+
+ids = DB.insert_many(table_name, [dict(user_id=user_id, value=f"check {index}") for index in range(30)])
+rows = DB.fetch_many(table_name, user_id=user_id)
+DB.fetch_one(table_name, id=ids[0])
+streamed = sum(1 for _ in DB.iter_rows(table_name, chunk_size=7, user_id=user_id))
+DB.update_one(table_name, dict(user_id=user_id), dict(value="updated"))
+
+stats = Instrumentation.stats()
+check("insert_many rows", stats[f"{table_name}.insert_many"]["rows"] == 30)
+check("fetch_many rows", stats[f"{table_name}.fetch_many"]["rows"] == len(rows) == 30)
+check("fetch_one counted", stats[f"{table_name}.fetch_one"]["count"] == 1)
+check("iter_rows rows", stats[f"{table_name}.iter_rows"]["rows"] == streamed == 30)
+check("update rows", stats[f"{table_name}.update_one"]["rows"] == 30)
+check("where keys", [event.where_keys for event in events if event.operation == "update_one"] == [("user_id",)])
+check("hook gets every call", len(events) == 5)
+check("fast calls are not slow", not Instrumentation.slow_queries())
+
+Instrumentation.configure(slow_query_ms=0)
+DB.fetch_many(table_name, user_id=user_id)
+slow = Instrumentation.slow_queries()
+check("slow query logged", len(slow) == 1 and str(user_id) in slow[0]["query"])
+check("slow query plan", bool(slow[0]["plan"]) and not slow[0]["plan"][0].startswith("no plan"))
+
+exposition = Instrumentation.to_prometheus()
+check("prometheus counters", f'zelenka_db_operations_total{{table="{table_name}",operation="fetch_many"}} 2'
+      in exposition)
+check("prometheus summaries", 'quantile="0.99"' in exposition and "zelenka_db_duration_seconds_count" in exposition)
+check("json", set(json.loads(Instrumentation.to_json())["operations"]) == set(stats) | {f"{table_name}.fetch_many"})
+
+# the trace callback of the application keeps getting statements and stays set
+traced = []
+conn = ConnectionManager.get()
+conn.set_trace_callback(traced.append)
+DB.fetch_many(table_name, user_id=user_id)
+conn.execute("SELECT 1")
+conn.set_trace_callback(None)
+check("application trace chained", any(table_name in statement for statement in traced))
+check("application trace restored", traced[-1] == "SELECT 1")
+
+
+# a failing hook or slow log never changes the outcome of the call
+def failing_hook(event):
+    raise RuntimeError("hook failed")
+
+
+Instrumentation.add_hook(failing_hook)
+Instrumentation.configure(slow_log_path=os.path.join(os.path.dirname(__file__), "missing", "slow.log"))
+check("failing hook keeps the result", len(DB.fetch_many(table_name, user_id=user_id)) == 30)
+try:
+    DB.fetch_query("SELECT * FROM missing_table")
+    check("failing hook keeps the error", False)
+
+except sqlite3.OperationalError as error:
+    check("failing hook keeps the error", "missing_table" in str(error))
+
+Instrumentation.remove_hook(failing_hook)
+Instrumentation.configure(slow_log_path=False)
+
+recorded = len(events)
+Instrumentation.configure(enabled=False)
+Instrumentation.reset()
+DB.fetch_many(table_name, user_id=user_id)
+DB.delete_one(table_name, user_id=user_id)
+check("disabled records nothing", not Instrumentation.stats() and len(events) == recorded)
+
+Instrumentation.remove_hook(events.append)
+
+# cost of the disabled wrapper on the cheapest call
+print(f"fetch_one disabled: {per_call(lambda: DB.fetch_one(table_name, id=0)):.2f}us, "
+      f"undecorated: {per_call(lambda: DB.fetch_one.__wrapped__(table_name, id=0)):.2f}us")
+
+if failed:
+    raise SystemExit(f"{len(failed)} instrumentation checks failed")
@@ -0,0 +1,85 @@
+import threading
+from collections import defaultdict
+
+from modules.database.connection.connection import ConnectionManager
+from modules.database.sensor_reading.user_notification import UserNotification
+
+# usage: python scripts/check_notifications.py
+# parallel delivery workers must send every notification once and the notifications of a user in id order
+
+users = list(range(1000001, 1000051))
+workers = 8
+failed = []
+
+
+def check(name: str, condition: bool):
+    print(f"{'ok  ' if condition else 'FAIL'} {name}")
+    if not condition:
+        failed.append(name)
+
+
+ids = UserNotification.insert_many([dict(user_id=user_id, value=f"check {index}")
+                                    for index in range(40) for user_id in users])
+check("insert_many", len(ids) == 40 * len(users) and ids == sorted(ids))
+
+sent = defaultdict(list)
+sent_lock = threading.Lock()
+failed_batches = set()
+
+
+def deliver(worker: str):
+    while True:
+        notifications = UserNotification.claim(users, 37, worker)
+        if not notifications:
+            break
+
+        with sent_lock:
+            for notification in notifications:
+                sent[notification.user_id].append(notification.id)
+
+        # some batches fail once and are released for a retry
+        if notifications[0].id % 3 == 0 and notifications[0].id not in failed_batches:
+            with sent_lock:
+                failed_batches.add(notifications[0].id)
+                for notification in notifications:
+                    sent[notification.user_id].remove(notification.id)
+
+            UserNotification.release(notifications, worker)
+            continue
+
+        UserNotification.delivered(notifications, worker)
+
+    ConnectionManager.close()
+
+
+threads = [threading.Thread(target=deliver, args=(f"check-worker-{index}",)) for index in range(workers)]
+for thread in threads:
+    thread.start()
+
+for thread in threads:
+    thread.join()
+
+delivered = [notification_id for user_id in users for notification_id in sent[user_id]]
+check("every notification sent once", sorted(delivered) == sorted(ids))
+check("notifications of a user in id order", all(sent[user_id] == sorted(sent[user_id]) for user_id in users))
+check("nothing pending", not UserNotification.claim(users, 1, "check-worker"))
+check("all delivered", all(notification.delivered_at is not None
+                           for user_id in users for notification in UserNotification.page(user_id, limit=1000)))
+
+stale = UserNotification.insert_many([dict(user_id=users[0], value="check lease")])
+claimed = UserNotification.claim([users[0]], 10, "check-worker-a", lease=60000)
+check("claimed by one worker", [notification.id for notification in claimed] == stale)
+check("other worker waits for the lease", not UserNotification.claim([users[0]], 10, "check-worker-b"))
+check("expired lease is claimed again",
+      [notification.id for notification in UserNotification.claim([users[0]], 10, "check-worker-b", lease=-1)]
+      == stale)
+check("late delivered of the old worker is ignored", UserNotification.delivered(claimed, "check-worker-a") == 0)
+
+UserNotification.insert_many([dict(user_id=users[1], value="check drain")])
+check("drain", [notification.value for notification in UserNotification.drain([users[1]], 10)] == ["check drain"])
+
+for user_id in users:
+    UserNotification.delete_user_notifications(user_id)
+
+if failed:
+    raise SystemExit(f"{len(failed)} notification checks failed")
@@ -0,0 +1,25 @@
+from modules.database.database.database import DB
+
+# every Fetcher lookup must be served by an index, not by a full table scan
+fetcher_queries = [
+    (DB.devices_table_name, dict(id=1)),
+    (DB.devices_table_name, dict(serial_number="123123")),
+    (DB.users_table_name, dict(id=1)),
+    (DB.users_table_name, dict(email="@gmail.com")),
+    (DB.users_table_name, dict(login="sarrz")),
+    (DB.users_devices_table_name, dict(user_id=1)),
+    (DB.users_devices_table_name, dict(device_id=1)),
+    (DB.sensor_readings_table_name, dict(id=1)),
+    (DB.sensor_readings_table_name, dict(device_id=1)),
+]
+
+failed = False
+for table_name, where in fetcher_queries:
+    plan = DB.query_plan(table_name, **where)
+    uses_index = all(detail.startswith("SEARCH") for detail in plan if detail.startswith(("SCAN", "SEARCH")))
+
+    print(f"{'ok  ' if uses_index else 'SCAN'} {table_name} {where}: {'; '.join(plan)}")
+    failed = failed or not uses_index
+
+if failed:
+    raise SystemExit("Some fetcher queries do a full table scan")
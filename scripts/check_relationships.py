@@ -0,0 +1,88 @@
+import re
+from contextlib import contextmanager
+
+from modules.database.connection.connection import ConnectionManager
+from modules.database.database.database import DB
+from modules.database.device.device import Device, DeviceFetcher
+from modules.database.sensor_reading.sensor_reading import SensorReading, SensorReadingFetcher
+from modules.database.user.user import User, UserFetcher
+
+# usage: python scripts/check_relationships.py
+# relationship reads must cost a fixed number of statements, whatever the number of users, devices or readings
+
+failed = []
+
+
+def check(name: str, condition: bool):
+    print(f"{'ok  ' if condition else 'FAIL'} {name}")
+    if not condition:
+        failed.append(name)
+
+
+@contextmanager
+def statements():
+    # every statement of the thread connection, transaction control left out
+    traced = []
+    conn = ConnectionManager.get()
+    conn.set_trace_callback(lambda statement: statement.startswith(("BEGIN", "COMMIT", "ROLLBACK"))
+                            or traced.append(statement))
+    try:
+        yield traced
+
+    finally:
+        conn.set_trace_callback(None)
+
+
+def count(function) -> int:
+    with statements() as traced:
+        function()
+
+    return len(traced)
+
+
+def reading(statement: str) -> bool:
+    return re.search(rf"\bFROM\s+(\w+\.)?{DB.sensor_readings_table_name}\b", statement) is not None
+
+
+users = [User.insert(login=f"relationships_check_{index}", email=f"relationships_check_{index}@example.com",
+                     password="1") for index in range(50)]
+devices = Device.insert_many([f"relationships-check-{index}" for index in range(50)])
+for index, user in enumerate(users):
+    for device in devices[index % 5::5]:
+        user.insert_device(device)
+
+SensorReading.insert_many([dict(device_id=devices[0].id, datetime=f"01.01.2025 00:{minute:02d}:00", temperature=1,
+                                humidity=2, pressure=3, hydration=0.5, waterlevel=0.1) for minute in range(60)])
+
+check("fetch_user_devices: one query", count(lambda: DeviceFetcher.fetch_user_devices(users[0].id)) == 1)
+check("fetch_by_device_id: one query", count(lambda: UserFetcher.fetch_by_device_id(devices[0].id)) == 1)
+
+# the registry of partitions and the archive index are read as well, the readings themselves with one query
+with statements() as traced:
+    history = SensorReadingFetcher.fetch_device_sensor_readings(devices[0].id)
+
+check("fetch_device_sensor_readings: one query on readings",
+      len(history) == 60 and len([statement for statement in traced if reading(statement)]) == 1)
+check("fetch_device_sensor_readings: same count without readings",
+      count(lambda: SensorReadingFetcher.fetch_device_sensor_readings(devices[1].id)) == len(traced))
+
+check("Device.for_users: constant",
+      count(lambda: Device.for_users([users[0].id])) == count(lambda: Device.for_users([user.id for user in users]))
+      == 1)
+check("User.for_devices: constant",
+      count(lambda: User.for_devices([devices[0].id]))
+      == count(lambda: User.for_devices([device.id for device in devices])) == 1)
+check("for_users result", all(len(users_devices) == 10 for users_devices in
+                              Device.for_users([user.id for user in users]).values()))
+
+for reading_info in SensorReading.by_device(devices[0].id):
+    reading_info.delete()
+
+for user in users:
+    user.delete()
+
+for device in devices:
+    device.delete()
+
+if failed:
+    raise SystemExit(f"{len(failed)} relationship checks failed")
@@ -0,0 +1,7 @@
+from modules.server.cluster import main
+
+# usage: python scripts/cluster.py --workers 4
+# ingest server on config.ingest_port in several processes sharing the port, readings go to one writer process
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,7 @@
+from modules.server.load_generator import main
+
+# usage: python scripts/load_generator.py --register --devices 5000 --connections 500 --rate 2 --duration 60
+# simulated devices against the ingest server on localhost, prints ACK latency percentiles and throughput
+
+if __name__ == '__main__':
+    main()
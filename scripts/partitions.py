@@ -0,0 +1,24 @@
+import sys
+
+from modules.database.partition.partition import Partition
+from modules.database.timestamp.timestamp import Timestamp
+
+# usage: python scripts/partitions.py list
+#        python scripts/partitions.py seal ["01.06.2025 00:00:00"]
+#        python scripts/partitions.py drop 2025_01
+# seal moves the finished months of sensor_readings into data/partitions, drop deletes a whole sealed month
+
+command = sys.argv[1] if len(sys.argv) > 1 else "list"
+
+if command == "seal":
+    before = Timestamp.from_datetime_string(sys.argv[2]) if len(sys.argv) > 2 else None
+    print(f"Sealed: {', '.join(Partition.seal(before)) or 'nothing'}")
+
+elif command == "drop":
+    Partition.drop(sys.argv[2])
+    print(f"Dropped {sys.argv[2]}")
+
+else:
+    for partition in Partition.fetch_all():
+        print(f"{partition.month}: {Timestamp.to_datetime_string(partition.start_ts)} - "
+              f"{Timestamp.to_datetime_string(partition.end_ts)}, ids {partition.min_id}..{partition.max_id}")
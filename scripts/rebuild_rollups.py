@@ -0,0 +1,15 @@
+import sys
+
+from modules.database.rollup.rollup import Rollup
+from modules.database.latest_reading.latest_reading import LatestReading
+
+# usage: python scripts/rebuild_rollups.py [device_id]
+# recomputes sensor_readings_rollups and device_latest_readings from raw readings, e.g. after upgrading
+# an existing database
+
+device_id = int(sys.argv[1]) if len(sys.argv) > 1 else None
+devices = Rollup.rebuild(device_id)
+print(f"Rollups rebuilt for {devices} devices")
+
+if device_id is None:
+    print(f"Latest readings rebuilt for {LatestReading.rebuild()} devices")
@@ -0,0 +1,10 @@
+import sys
+
+from modules.config.config import retention_days
+from modules.database.retention.retention import Retention
+
+# usage: python scripts/retention.py [days]
+# moves months older than `days` (config.retention_days by default) into data/database.tar.gz, run it from cron
+
+days = int(sys.argv[1]) if len(sys.argv) > 1 else retention_days
+print(f"Archived: {', '.join(Retention.run(days)) or 'nothing'}")